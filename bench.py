@@ -0,0 +1,420 @@
+import os
+import sys
+import time
+import json
+import argparse
+import tracemalloc
+from collections import defaultdict
+
+# Без окна и звука - бенчмарк должен работать в CI
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+from main import *
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class LinearIndex:
+    # Старое поведение: перебор всех платформ каждый кадр
+    def __init__(self, platforms):
+        self.platforms = list(platforms)
+
+    def query(self, rect):
+        return self.platforms
+
+
+def build_platforms(count):
+    # Платформы сеткой на уровне шириной в несколько экранов
+    platforms = pygame.sprite.Group()
+    platforms.add(Platform(0, HEIGHT - 50, WIDTH, 50))
+    cols = max(1, int(count ** 0.5))
+    for i in range(count):
+        x = (i % cols) * 250
+        y = 100 + (i // cols) * 120
+        platforms.add(Platform(x, y, 200, 20))
+    return platforms
+
+
+def bench_collisions(platform_counts=(10, 100, 1000, 5000), enemy_count=50, frames=200):
+    results = []
+    for count in platform_counts:
+        platforms = build_platforms(count)
+        for name, index in (("linear", LinearIndex(platforms)), ("grid", SpatialHash(platforms))):
+            random.seed(0)
+            player = Player(100, 300)
+            # Игрок далеко от врагов, чтобы не было атак
+            player.rect.topleft = (-10000, -10000)
+            enemies = pygame.sprite.Group()
+            for _ in range(enemy_count):
+                enemies.add(Enemy(random.randint(0, 5000), random.randint(0, 5000)))
+
+            start = time.perf_counter()
+            for _ in range(frames):
+                player.update(index, enemies)
+                enemies.update(index, player)
+            elapsed = time.perf_counter() - start
+
+            results.append((count, name, elapsed / frames * 1000))
+            print(f"{count:6d} платформ  {name:6s}  {elapsed / frames * 1000:8.3f} мс/кадр")
+    return results
+
+
+class GeneratedLevel(Level):
+    # Сцена для бенчмарка: число платформ, врагов и монет растёт вместе со scale
+    def __init__(self, game_state, scale, seed=0):
+        self.scale = scale
+        self.seed = seed
+        super().__init__(game_state)
+
+    def build(self, number):
+        # Плотность объектов постоянна: уровень становится шире вместе со scale.
+        # Платформы стоят рядами по сетке и не пересекаются, как на настоящем уровне
+        rng = random.Random(self.seed)
+        width = WIDTH * self.scale
+        data = LevelData(-(-width // TILE_SIZE), -(-HEIGHT // TILE_SIZE))
+        data.add_object({"type": "platform", "x": 0, "y": HEIGHT - 50, "w": width, "h": 50})
+        slots = [(col * 256, 150 + row * 120) for col in range(width // 256) for row in range(5)]
+        platforms = [pygame.Rect(x + rng.randint(0, 40), y, rng.randint(60, 200), 20)
+                     for x, y in rng.sample(slots, min(len(slots), 20 * self.scale))]
+        for rect in platforms:
+            data.add_object({"type": "platform", "x": rect.x, "y": rect.y, "w": rect.w, "h": rect.h})
+        for _ in range(10 * self.scale):
+            data.add_object({"type": "coin", "x": rng.randint(20, width - 20), "y": rng.randint(20, HEIGHT - 70)})
+        # Враги стоят на платформах
+        platforms.append(pygame.Rect(0, HEIGHT - 50, width, 50))
+        for _ in range(5 * self.scale):
+            rect = rng.choice(platforms)
+            data.add_object({"type": "enemy", "x": rng.randint(rect.left, max(rect.left, rect.right - 50)),
+                             "y": rect.top - 80, "enemy_type": "slime"})
+        return data
+
+
+class ScriptedInput:
+    # Детерминированный ввод: вместо клавиатуры - расписание по номеру тика
+    def __init__(self, level):
+        self.level = level
+
+    def keys(self, tick):
+        keys = defaultdict(bool)
+        if tick % 240 < 120:
+            keys[K_RIGHT] = True
+        else:
+            keys[K_LEFT] = True
+        return keys
+
+    def events(self, tick):
+        if tick % 45 == 0:
+            self.level.handle_key(K_SPACE)
+        if tick % 30 == 0:
+            self.level.handle_key(K_f)
+
+
+def bench_projectiles(counts=(100, 500, 2000), enemy_count=200, ticks=300):
+    # Стрельба без перерыва: пул держит count снарядов в полёте, враги стоят рядами
+    results = []
+    ParticleSystem()  # в игре частицы создаются вместе с уровнем, а не на первом попадании
+    for count in counts:
+        random.seed(0)
+        platforms = SpatialHash(build_platforms(200))
+        enemies = pygame.sprite.Group()
+        for _ in range(enemy_count):
+            enemy = Enemy(random.randint(0, 5000), random.randint(0, 2000))
+            enemy.health = 10 ** 9  # враги не умирают - нагрузка постоянна
+            enemies.add(enemy)
+        bounds = pygame.Rect(0, 0, 5000, 2000)
+        pool = ProjectilePool(count)
+        gc.collect()
+        gc_runs = 0
+        allocated = 0  # прирост отслеживаемых gc объектов за тики без сборки
+        worst = 0.0
+        elapsed = 0.0
+        for _ in range(ticks):
+            while pool.free:
+                pool.fire(random.choice(["mage", "archer"]), random.randint(0, 5000), random.randint(0, 2000),
+                          random.choice([-1, 1]))
+            # Меряется только тик пула (и сборки мусора внутри него), без генерации выстрелов
+            collections = gc.get_stats()[0]["collections"]
+            objects = gc.get_count()[0]
+            tick_start = time.perf_counter()
+            pool.update(platforms, enemies, bounds)
+            tick = time.perf_counter() - tick_start
+            if gc.get_stats()[0]["collections"] != collections:
+                gc_runs += gc.get_stats()[0]["collections"] - collections
+            else:
+                allocated += gc.get_count()[0] - objects
+            elapsed += tick
+            worst = max(worst, tick)
+        results.append((count, elapsed / ticks * 1000, worst * 1000, gc_runs, allocated / ticks))
+        print(f"{count:6d} снарядов  {elapsed / ticks * 1000:8.3f} мс/тик  худший {worst * 1000:7.3f} мс  "
+              f"сборок gc(0): {gc_runs}  объектов gc: {allocated / ticks:6.1f}/тик  попаданий: {pool.stats['hits']}")
+    return results
+
+
+def bench_particles(counts=(1000, 10000, 30000), ticks=300):
+    # Постоянно count живых частиц: умершие тут же заменяются новыми вспышками по экрану
+    results = []
+    system = ParticleSystem()
+    if not system.enabled:
+        print("NumPy не установлен - частицы выключены")
+        return results
+    rng = random.Random(0)
+    surface = pygame.Surface((WIDTH, HEIGHT)).convert()
+    for count in counts:
+        system.clear()
+        update_time = draw_time = 0.0
+        for _ in range(ticks):
+            missing = count - system.live_count()
+            while missing > 0:
+                burst = min(missing, PARTICLE_EMITTERS["death"]["count"])
+                system.emit(rng.choice(list(PARTICLE_EMITTERS)), rng.randint(0, WIDTH), rng.randint(0, HEIGHT), burst)
+                missing -= burst
+            start = time.perf_counter()
+            system.update()
+            update_time += time.perf_counter() - start
+            start = time.perf_counter()
+            system.draw(surface)
+            draw_time += time.perf_counter() - start
+        results.append((count, update_time / ticks * 1000, draw_time / ticks * 1000))
+        print(f"{count:6d} частиц  обновление {update_time / ticks * 1000:7.3f} мс/тик  "
+              f"отрисовка {draw_time / ticks * 1000:7.3f} мс/кадр")
+    system.clear()
+    return results
+
+
+def bench_snapshots(scales=(1, 5, 20), ticks=300, repeats=200, seed=0):
+    # Откат к снимку против перестройки уровня с нуля, на сцене после ticks тиков игры
+    results = []
+    for scale in scales:
+        random.seed(seed)
+        game_state = GameState()
+        level = GeneratedLevel(game_state, scale, seed)
+        script = ScriptedInput(level)
+        for tick in range(ticks):
+            script.events(tick)
+            if level.step(script.keys(tick)) is not None:
+                break
+        blob = level.snapshot()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            level.snapshot()
+        captured = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        for _ in range(repeats):
+            level.restore(blob)
+        restored = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        GeneratedLevel(game_state, scale, seed)
+        rebuilt = time.perf_counter() - start
+        results.append((scale, len(blob), captured * 1000, restored * 1000, rebuilt * 1000))
+        print(f"масштаб {scale:3d}: снимок {len(blob):6d} Б  запись {captured * 1000:6.3f} мс  "
+              f"откат {restored * 1000:6.3f} мс  перестройка {rebuilt * 1000:8.2f} мс")
+    return results
+
+
+def bench_levels(seed=0):
+    # Подготовка сгенерированных уровней: на месте (как было бы при переходе)
+    # и забор результата, заранее посчитанного процессом-помощником
+    game_state = GameState()
+    game_state.world_seed = seed
+    loader = LevelLoader()
+    results = []
+    for number in range(HANDMADE_LEVELS + 1, game_state.max_level + 1):
+        key = game_state.level_key(number)
+        start = time.perf_counter()
+        data, nav = prepare_level(*key)
+        built = time.perf_counter() - start
+        loader.prefetch(key)
+        loader.pending[key].result()
+        start = time.perf_counter()
+        loader.take(key)
+        taken = time.perf_counter() - start
+        results.append((number, built * 1000, taken * 1000))
+        print(f"уровень {number}: {data.cols}x{data.rows} тайлов, {data.enemy_count():3d} врагов, "
+              f"{len(nav.nodes):4d} узлов  на месте {built * 1000:8.2f} мс  готовый {taken * 1000:6.2f} мс")
+    return results
+
+
+def run_scene(scale, ticks, render_mode, trace_memory, seed=0, player_class="warrior"):
+    random.seed(seed)
+    game_state = GameState()
+    game_state.player_class = player_class
+    level = GeneratedLevel(game_state, scale, seed)
+    player = level.player
+    script = ScriptedInput(level)
+    # Загружены только чанки рядом с игроком - в отчёт идёт весь уровень
+    counts = {"chunks": len(level.data.chunks), "enemies": level.data.enemy_count(),
+              "loaded_platforms": len(level.platforms)}
+
+    renderer_class = DirtyRenderer if render_mode == "dirty" else FullRenderer
+    renderer = renderer_class(screen, level.platform_grid, [level.coins, level.enemies, player, level.projectiles],
+                              level.camera)
+    hud = Hud()
+    timer = PhaseTimer()
+    layout_version = level.layout_version
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for tick in range(ticks):
+        # Часы не ограничивают скорость: тик симуляции и кадр идут подряд
+        timer.begin()
+        pygame.event.pump()
+        script.events(tick)
+        timer.mark("events")
+        result = level.step(script.keys(tick), timer)
+        if result == "dead":
+            # Сцена должна оставаться нагруженной - игрок воскресает
+            player.health = player.max_health
+            player.alive = True
+        elif result == "exit":
+            player.rect.x = 100
+            player.begin_step()
+        if level.layout_version != layout_version:
+            layout_version = level.layout_version
+            renderer.rebuild_static()
+        hud.update(player, game_state)
+        timer.mark("hud")
+        renderer.draw(hud)
+        timer.mark("draw")
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "scale": scale,
+        **counts,
+        "ticks": ticks,
+        "seconds": round(elapsed, 4),
+        "ticks_per_second": round(ticks / elapsed, 1),
+        "phases_ms_per_tick": {name: round(total / ticks * 1000, 4) for name, total in timer.totals.items()}
+    }
+    if trace_memory:
+        report["python_peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return report
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # На macOS ru_maxrss в байтах, на Linux - в килобайтах
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def compare_with_baseline(report, baseline_path, tolerance):
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    old_scenes = {scene["scale"]: scene for scene in baseline["scenes"]}
+    regressions = []
+    for scene in report["scenes"]:
+        old = old_scenes.get(scene["scale"])
+        if old is None:
+            continue
+        ratio = scene["ticks_per_second"] / old["ticks_per_second"]
+        scene["baseline_ratio"] = round(ratio, 3)
+        if ratio < 1 - tolerance:
+            regressions.append(f"scale {scene['scale']}: {old['ticks_per_second']} -> "
+                               f"{scene['ticks_per_second']} тиков/с ({ratio:.0%})")
+    return regressions
+
+
+def bench_headless(args):
+    scales = [int(scale) for scale in args.scales.split(",")]
+    if args.no_enemy_engine:
+        import main
+        main.ENEMY_ENGINE_THRESHOLD = None
+    report = {
+        "render_mode": args.render_mode,
+        "enemy_engine": not args.no_enemy_engine and np is not None,
+        "player_class": args.player_class,
+        "scenes": [run_scene(scale, args.ticks, args.render_mode, args.trace_memory, player_class=args.player_class)
+                   for scale in scales]
+    }
+    report["peak_rss_kb"] = peak_rss_kb()
+
+    regressions = []
+    if args.baseline:
+        regressions = compare_with_baseline(report, args.baseline, args.tolerance)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    for line in regressions:
+        print(f"Регрессия: {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def bench_replays(args):
+    # Записи (--record) как фикстуры: скорость прогона и совпадение итогового состояния
+    report = {"replays": []}
+    failed = False
+    for path in args.paths:
+        replay = Replay.load(path)
+        timer = PhaseTimer()
+        start = time.perf_counter()
+        final_hash, ticks = run_replay(replay, timer)
+        elapsed = time.perf_counter() - start
+        matched = final_hash == replay.final_hash
+        failed = failed or not matched
+        report["replays"].append({
+            "path": path,
+            "level": replay.level,
+            "ticks": ticks,
+            "seconds": round(elapsed, 4),
+            "ticks_per_second": round(ticks / elapsed, 1),
+            "phases_ms_per_tick": {name: round(total / ticks * 1000, 4) for name, total in timer.totals.items()},
+            "state_matches": matched
+        })
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    screen = init_display()
+    parser = argparse.ArgumentParser(description="Бенчмарки игрового цикла без окна")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("collisions", help="линейный перебор платформ против SpatialHash")
+    headless = commands.add_parser("headless", help="прогон Level.step и отрисовки на сгенерированных сценах")
+    headless.add_argument("--ticks", type=int, default=600)
+    headless.add_argument("--scales", default="1,5,20", help="множители размера сцены через запятую")
+    headless.add_argument("--render-mode", choices=["dirty", "full"], default=RENDER_MODE)
+    headless.add_argument("--player-class", choices=["warrior", "mage", "archer"], default="warrior")
+    headless.add_argument("--no-enemy-engine", action="store_true", help="всегда обновлять врагов по одному")
+    headless.add_argument("--trace-memory", action="store_true", help="пик памяти Python через tracemalloc (медленнее)")
+    headless.add_argument("--json", help="куда записать отчёт (по умолчанию stdout)")
+    headless.add_argument("--baseline", help="отчёт для сравнения; при регрессии код выхода 1")
+    headless.add_argument("--tolerance", type=float, default=0.15, help="допустимое падение тиков/с")
+    commands.add_parser("projectiles", help="пул снарядов под постоянной стрельбой")
+    commands.add_parser("levels", help="генерация уровней на месте против заранее подготовленных")
+    commands.add_parser("particles", help="система частиц с постоянным числом живых частиц")
+    commands.add_parser("snapshots", help="откат уровня к бинарному снимку против перестройки")
+    replays = commands.add_parser("replay", help="прогон записей уровней со сверкой итогового состояния")
+    replays.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "headless":
+        sys.exit(bench_headless(args))
+    if args.command == "replay":
+        sys.exit(bench_replays(args))
+    if args.command == "projectiles":
+        bench_projectiles()
+        sys.exit(0)
+    if args.command == "levels":
+        bench_levels()
+        sys.exit(0)
+    if args.command == "particles":
+        bench_particles()
+        sys.exit(0)
+    if args.command == "snapshots":
+        bench_snapshots()
+        sys.exit(0)
+    bench_collisions()
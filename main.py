@@ -3,21 +3,100 @@ import sys
 import os
 import random
 import json
+import gc
+import struct
+import time
+import threading
+import queue
+import tracemalloc
+import heapq
+import atexit
+import hashlib
+import zlib
+import math
+import array
+import bisect
+import multiprocessing
+from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pygame.locals import *
 
-# Инициализация
-pygame.init()
-pygame.mixer.init()
+try:
+    import numpy as np
+except ImportError:  # без NumPy враги обновляются по одному
+    np = None
+
 WIDTH, HEIGHT = 1024, 768
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Epic Platformer Adventure")
 
 # Константы
-FPS = 60
+FPS = 60  # частота отрисовки
+SIM_RATE = 60  # тиков симуляции в секунду, можно понизить на слабом железе
+STEP = 60 / SIM_RATE  # длина тика в кадрах по 60 Гц - на неё рассчитаны константы физики
+MAX_CATCHUP_STEPS = 5  # больше тиков за кадр не догоняем, чтобы не уйти в "спираль смерти"
 GRAVITY = 0.5
 JUMP_FORCE = -15
 PLAYER_SPEED = 7
-ATTACK_COOLDOWN = 500  # мс
+ATTACK_COOLDOWN = 500.0  # мс
+ASSET_MEMORY_BUDGET = 64 * 1024 * 1024  # байт на кэш исходных изображений (атлас кадров - вне бюджета)
+CHARACTER_ANIMATIONS = ["idle", "run", "jump", "attack", "death"]
+TEXT_CACHE_SIZE = 256  # поверхностей текста в кэше
+ATLAS_PAGE_SIZE = 1024  # сторона страницы атласа; кадры крупнее рисуются отдельными поверхностями
+ENEMY_ENGINE_THRESHOLD = 64  # с какого числа врагов включать NumPy-движок (None - никогда)
+PROJECTILE_POOL_SIZE = 512  # снарядов в полёте одновременно; сверх этого выстрел пропускается
+# Снаряды дальнобойных классов: скорость, гравитация, урон, время жизни (тиков по 60 Гц), размер, цвет
+PROJECTILES = {
+    "mage": {"speed": 9, "gravity": 0, "damage": 25, "ttl": 90, "size": (16, 16), "color": (255, 120, 0)},
+    "archer": {"speed": 14, "gravity": 0.15, "damage": 15, "ttl": 120, "size": (20, 4), "color": (200, 200, 200)}
+}
+# Ближний бой: урон и хитбокс на каждом кадре анимации attack - (x, y, ширина, высота)
+# от rect.topleft бойца, смотрящего вправо (влево - зеркально); None - кадр не бьёт.
+# Враги бьют хитбоксом первого кадра в момент начала атаки
+MELEE = {
+    "warrior": {"damage": 35, "boxes": [None, (35, 10, 55, 60), (35, 10, 55, 60), None]},
+    "mage": {"damage": 10, "boxes": [None, (35, 20, 30, 40), None, None]},
+    "archer": {"damage": 10, "boxes": [None, (35, 20, 30, 40), None, None]},
+    "slime": {"damage": 5, "boxes": [(30, 0, 45, 80)]}
+}
+KILL_SCORE = 50
+PARTICLE_CAPACITY = 32768  # частиц в кольце; новые вспышки затирают самые старые
+PARTICLE_SIZE = 3  # сторона квадратика частицы, пикселей
+PARTICLE_SHADES = 8  # ступеней угасания цвета к концу жизни
+PARTICLE_DIRTY_CELL = 64  # частицы обновляются на экране прямоугольниками по ячейкам такого размера
+# Вспышки частиц: число частиц, скорость (мин, макс), направление в градусах (0 - вправо,
+# -90 - вверх), время жизни в тиках по 60 Гц (мин, макс), гравитация, цвет
+PARTICLE_EMITTERS = {
+    "coin": {"count": 24, "speed": (1.5, 4), "angle": (-160, -20), "life": (20, 40), "gravity": 0.15, "color": (255, 230, 60)},
+    "hit": {"count": 16, "speed": (2, 6), "angle": (-180, 180), "life": (10, 20), "gravity": 0.3, "color": (255, 90, 90)},
+    "death": {"count": 90, "speed": (1, 7), "angle": (-170, -10), "life": (30, 60), "gravity": 0.25, "color": (170, 0, 0)}
+}
+TILE_SIZE = 32  # пикселей в тайле
+CHUNK_SIZE = 16  # тайлов в стороне чанка
+STREAM_MARGIN = (WIDTH, HEIGHT)  # вокруг игрока держим загруженными чанки на экран в каждую сторону
+UPDATE_MARGIN = 256  # враги дальше этого от края экрана не обновляются
+PROFILER_FRAMES = 600  # кадров в кольцевом буфере профайлера
+PROFILER_OVERLAY_REFRESH = 15  # раз во столько кадров обновляются цифры на оверлее
+PROFILER_OVERLAY_KEY = K_F3
+PROFILER_EXPORT_KEY = K_F4  # выгрузить буфер в profile_trace.json
+QUICKSAVE_KEY = K_F5  # снимок уровня в памяти
+QUICKLOAD_KEY = K_F9  # вернуться к снимку, без него - к началу уровня
+REPLAY_DIR = "replays"  # куда пишутся записи уровней при запуске с --record
+REPLAY_KEYS = (K_LEFT, K_RIGHT, K_SPACE, K_f)  # клавиши, которые читает симуляция
+RENDER_MODE = "dirty"  # "dirty" - только изменившиеся области, "full" - весь кадр
+SPRITE_CACHE_DIR = "assets/cache"
+# Заголовок запечённого спрайта: метка, масштаб, mtime и размер исходника, ширина, высота
+SPRITE_CACHE_HEADER = struct.Struct("<4sdqqII")
+SPRITE_CACHE_MAGIC = b"SPR1"
+AUDIO_CHANNELS = 16  # каналов микшера на все звуковые эффекты
+AUDIO_RETRIGGER_MS = 40  # тот же звук чаще не запускается - 50 ударов за тик звучат как один
+HIGHSCORE_FILE = "highscores.json"  # сжатый снимок таблиц рекордов
+HIGHSCORE_LOG = "highscores.log"  # новые результаты, по строке JSON, пока их не сожмут в снимок
+HIGHSCORE_TOP = 10  # мест в каждой таблице
+HIGHSCORE_COMPACT_EVERY = 50  # строк журнала до сжатия
+UI_IDLE_TIMEOUT = 500  # мс: сколько меню без изменений ждёт события, прежде чем проснуться
+HANDMADE_LEVELS = 3  # levels/level1.json ... level3.json, дальше уровни генерируются
+GENERATED_LEVELS = 5  # процедурных уровней после готовых
+LEVEL_GEN_ATTEMPTS = 8  # попыток собрать проходимый уровень, после них - пол без ям
 
 # Цвета
 WHITE = (255, 255, 255)
@@ -28,10 +107,93 @@ BLUE = (0, 0, 255)
 YELLOW = (255, 255, 0)
 PURPLE = (128, 0, 128)
 
-# Шрифты
-font_small = pygame.font.Font(None, 24)
-font_medium = pygame.font.Font(None, 36)
-font_large = pygame.font.Font(None, 72)
+# Окно и шрифты - после init_display()
+screen = None
+font_small = font_medium = font_large = None
+
+def init_display():
+    # Инициализация окна, звука и шрифтов. Не при импорте: процесс-помощник LevelLoader
+    # импортирует main.py заново, и ему не нужны ни окно, ни потоки SDL
+    global screen, font_small, font_medium, font_large
+    pygame.init()
+    pygame.mixer.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Epic Platformer Adventure")
+    font_small = pygame.font.Font(None, 24)
+    font_medium = pygame.font.Font(None, 36)
+    font_large = pygame.font.Font(None, 72)
+    return screen
+
+class TextCache:
+    # Готовые поверхности текста: (шрифт, текст, цвет, сглаживание) -> Surface, вытеснение LRU
+    def __init__(self, max_size=TEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+    
+    def render(self, font, text, color, antialias=True):
+        key = (font, text, tuple(color), antialias)
+        surf = self.cache.get(key)
+        if surf is not None:
+            self.cache.move_to_end(key)
+            return surf
+        surf = font.render(text, antialias, color)
+        self.cache[key] = surf
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return surf
+
+text_cache = TextCache()
+
+def render_text(font, text, color, antialias=True):
+    return text_cache.render(font, text, color, antialias)
+
+class TextureAtlas:
+    # Кадры спрайтов (персонажи, враги, монеты, снаряды), уложенные полками в несколько
+    # больших страниц: отдельно непрозрачные и с альфой, чтобы непрозрачные рисовались
+    # без смешивания. Кадр остаётся поверхностью - подповерхностью страницы, а
+    # sources[кадр] = (страница, область) позволяет рендеру рисовать все спрайты
+    # кадра одним blits прямо из страниц
+    def __init__(self, page_size=ATLAS_PAGE_SIZE):
+        self.page_size = page_size
+        self.pages = {False: [], True: []}  # с альфой? -> страницы
+        self.shelves = {False: None, True: None}  # x, y и высота текущей полки последней страницы
+        self.sources = {}
+    
+    def _new_page(self, alpha):
+        page = pygame.Surface((self.page_size, self.page_size), pygame.SRCALPHA if alpha else 0)
+        if pygame.display.get_surface() is not None:
+            page = page.convert_alpha() if alpha else page.convert()
+        page.fill((0, 0, 0, 0))
+        self.pages[alpha].append(page)
+        return page
+    
+    def pack(self, image):
+        width, height = image.get_size()
+        if not 0 < width <= self.page_size or not 0 < height <= self.page_size:
+            return image
+        alpha = bool(image.get_flags() & pygame.SRCALPHA)
+        shelf = self.shelves[alpha]
+        if shelf is not None:
+            x, y, shelf_height = shelf
+            if x + width > self.page_size:
+                x, y, shelf_height = 0, y + shelf_height, 0
+        if shelf is None or y + height > self.page_size:
+            self._new_page(alpha)
+            x, y, shelf_height = 0, 0, 0
+        page = self.pages[alpha][-1]
+        area = pygame.Rect(x, y, width, height)
+        # Страница изначально пустая (нули), области не пересекаются - MAX копирует пиксели как есть
+        page.blit(image, area, special_flags=pygame.BLEND_RGBA_MAX)
+        self.shelves[alpha] = (x + width, y, max(shelf_height, height))
+        frame = page.subsurface(area)
+        self.sources[frame] = (page, area)
+        return frame
+    
+    def pack_all(self, images):
+        return [self.pack(image) for image in images]
+    
+    def page_count(self):
+        return len(self.pages[False]) + len(self.pages[True])
 
 class AssetManager:
     _instance = None
@@ -43,11 +205,26 @@ class AssetManager:
         return cls._instance
     
     def _init(self):
+        # Манифест: имя -> путь (и масштаб). Сами ресурсы грузятся по требованию
         self.assets = {
             "images": {},
-            "sounds": {},
-            "music": {}
+            "music": {},
+            "character_animations": {},
+            "enemy_animations": {}
         }
+        # Атлас, нарезанные полосы кадров и одноцветные кадры живут до конца игры и в
+        # memory_budget не входят: их набор задан содержимым игры (три класса, типы врагов,
+        # монеты и снаряды) и со временем не растёт, а кадры держат живые спрайты.
+        # Бюджет и LRU-выгрузка - только для кэша исходных изображений (спрайтшитов)
+        self.atlas = TextureAtlas()
+        self.solids = {}  # (размер, цвет) -> одноцветный кадр в атласе
+        self.memory_budget = ASSET_MEMORY_BUDGET
+        self.cache = OrderedDict()  # (вид, имя) -> (ресурс, байты), от старых к свежим
+        self.bytes_resident = 0  # только cache, без атласа
+        self.stats = {"hits": 0, "misses": 0, "prefetched": 0, "evictions": 0, "load_time": {}}
+        self.lock = threading.RLock()
+        self.loading = {}  # (вид, имя) -> threading.Event для загрузок в процессе
+        self.prefetch_queue = None
         self._load_assets()
     
     def _load_assets(self):
@@ -56,47 +233,241 @@ class AssetManager:
         os.makedirs("assets/sounds", exist_ok=True)
         os.makedirs("assets/music", exist_ok=True)
         
-        # Загрузка изображений
+        # Изображения
         for char_type in ["warrior", "mage", "archer"]:
-            self.assets["images"][f"{char_type}_idle"] = self._load_image(f"assets/images/{char_type}_idle.png", 2)
-            self.assets["images"][f"{char_type}_run"] = self._load_image(f"assets/images/{char_type}_run.png", 2)
-            self.assets["images"][f"{char_type}_jump"] = self._load_image(f"assets/images/{char_type}_jump.png", 2)
-            self.assets["images"][f"{char_type}_attack"] = self._load_image(f"assets/images/{char_type}_attack.png", 2)
-            self.assets["images"][f"{char_type}_death"] = self._load_image(f"assets/images/{char_type}_death.png", 2)
-        
-        # Загрузка звуков
-        for sound in ["jump", "attack", "hurt", "coin", "victory"]:
-            self.assets["sounds"][sound] = self._load_sound(f"assets/sounds/{sound}.wav")
+            for anim in CHARACTER_ANIMATIONS:
+                self.assets["images"][f"{char_type}_{anim}"] = (f"assets/images/{char_type}_{anim}.png", 2)
         
-        # Загрузка музыки
+        # Музыка
         for music in ["menu", "level1", "level2", "level3"]:
             self.assets["music"][music] = f"assets/music/{music}.mp3"
     
+    def _load(self, kind, name):
+        path, scale = self.assets["images"][name]
+        image = self._load_image(path, scale)
+        return image, image.get_pitch() * image.get_height()
+    
+    def _get(self, kind, name, prefetch=False):
+        key = (kind, name)
+        with self.lock:
+            if key in self.cache:
+                if not prefetch:
+                    self.cache.move_to_end(key)
+                    self.stats["hits"] += 1
+                return self.cache[key][0]
+            if name not in self.assets[kind]:
+                return None
+            event = self.loading.get(key)
+            if event is None:
+                event = self.loading[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        
+        # Этот ресурс уже грузит другой поток - дождаться его
+        if not owner:
+            event.wait()
+            return self._get(kind, name, prefetch)
+        
+        start = time.perf_counter()
+        try:
+            asset, size = self._load(kind, name)
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+        elapsed = time.perf_counter() - start
+        
+        with self.lock:
+            self.stats["prefetched" if prefetch else "misses"] += 1
+            self.stats["load_time"][name] = elapsed
+            if key not in self.cache:
+                self.cache[key] = (asset, size)
+                self.bytes_resident += size
+                self._evict()
+        return asset
+    
+    def _evict(self):
+        # Выгрузка давно не использованных ресурсов сверх бюджета (самый свежий остаётся)
+        while self.bytes_resident > self.memory_budget and len(self.cache) > 1:
+            _, (_, size) = self.cache.popitem(last=False)
+            self.bytes_resident -= size
+            self.stats["evictions"] += 1
+    
+    def set_memory_budget(self, budget):
+        with self.lock:
+            self.memory_budget = budget
+            self._evict()
+    
+    def prefetch(self, kind, names):
+        # Подсказка: загрузить ресурсы в фоне, пока они ещё не нужны
+        if self.prefetch_queue is None:
+            self.prefetch_queue = queue.Queue()
+            threading.Thread(target=self._prefetch_worker, daemon=True).start()
+        for name in names:
+            self.prefetch_queue.put((kind, name))
+    
+    def prefetch_character(self, char_type):
+        self.prefetch("images", [f"{char_type}_{anim}" for anim in CHARACTER_ANIMATIONS])
+    
+    def _prefetch_worker(self):
+        while True:
+            kind, name = self.prefetch_queue.get()
+            try:
+                self._get(kind, name, prefetch=True)
+            except Exception as e:
+                print(f"Error prefetching {name}: {e}")
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                "hits": self.stats["hits"],
+                "misses": self.stats["misses"],
+                "prefetched": self.stats["prefetched"],
+                "evictions": self.stats["evictions"],
+                "resident": len(self.cache),
+                "bytes_resident": self.bytes_resident,
+                "memory_budget": self.memory_budget,
+                "load_time": dict(self.stats["load_time"])
+            }
+    
     def _load_image(self, path, scale=1):
         try:
-            image = pygame.image.load(path).convert_alpha()
-            if scale != 1:
-                size = (int(image.get_width() * scale), int(image.get_height() * scale))
-                return pygame.transform.scale(image, size)
+            stat = os.stat(path)
+            image = self._read_sprite_cache(path, scale, stat)
+            if image is None:
+                image = pygame.image.load(path).convert_alpha()
+                if scale != 1:
+                    size = (int(image.get_width() * scale), int(image.get_height() * scale))
+                    image = pygame.transform.scale(image, size)
+                self._write_sprite_cache(path, scale, stat, image)
             return image
         except:
             print(f"Error loading: {path}")
+            # Цвет заглушки - от имени файла: общий random засеян записью уровня, его не трогаем
+            rng = random.Random(zlib.crc32(path.encode()))
             surf = pygame.Surface((50, 50), pygame.SRCALPHA)
-            surf.fill((random.randint(50, 200), random.randint(50, 200), random.randint(50, 200)))
+            surf.fill((rng.randint(50, 200), rng.randint(50, 200), rng.randint(50, 200)))
             return surf
     
-    def _load_sound(self, path):
+    def _sprite_cache_path(self, path, scale):
+        name = path.replace("/", "_").replace("\\", "_")
+        return os.path.join(SPRITE_CACHE_DIR, f"{name}.x{scale}.spr")
+    
+    def _read_sprite_cache(self, path, scale, stat):
+        # Готовые пиксели после масштабирования: без декодирования PNG и scale
         try:
-            return pygame.mixer.Sound(path)
-        except:
-            print(f"Error loading sound: {path}")
+            with open(self._sprite_cache_path(path, scale), "rb") as f:
+                data = f.read()
+            magic, cached_scale, mtime, size, width, height = SPRITE_CACHE_HEADER.unpack_from(data)
+        except (OSError, struct.error):
             return None
+        if (magic != SPRITE_CACHE_MAGIC or cached_scale != scale
+                or mtime != stat.st_mtime_ns or size != stat.st_size
+                or len(data) != SPRITE_CACHE_HEADER.size + width * height * 4):
+            return None
+        pixels = memoryview(data)[SPRITE_CACHE_HEADER.size:]
+        return pygame.image.frombuffer(pixels, (width, height), "RGBA").convert_alpha()
+    
+    def _write_sprite_cache(self, path, scale, stat, image):
+        cache_path = self._sprite_cache_path(path, scale)
+        header = SPRITE_CACHE_HEADER.pack(SPRITE_CACHE_MAGIC, float(scale), stat.st_mtime_ns,
+                                          stat.st_size, image.get_width(), image.get_height())
+        try:
+            os.makedirs(SPRITE_CACHE_DIR, exist_ok=True)
+            # Через временный файл, чтобы не оставить битый кэш
+            with open(cache_path + ".tmp", "wb") as f:
+                f.write(header)
+                f.write(pygame.image.tobytes(image, "RGBA"))
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError as e:
+            print(f"Error writing sprite cache: {cache_path} ({e})")
+    
+    def bake_images(self):
+        # Запечь все изображения из манифеста в кэш (устаревшие записи перезаписываются)
+        baked = 0
+        for name, (path, scale) in self.assets["images"].items():
+            if os.path.exists(path):
+                self._load_image(path, scale)
+                baked += 1
+        print(f"Baked {baked} images into {SPRITE_CACHE_DIR}")
+        return baked
     
     def get_image(self, name):
-        return self.assets["images"].get(name, None)
+        return self._get("images", name)
+    
+    def get_character_animations(self, char_type):
+        # Кадры персонажа нарезаются из спрайтшитов в атлас один раз на класс
+        strips = self.assets["character_animations"].get(char_type)
+        if strips is None:
+            strips = self._build_character_animations(char_type)
+            self.assets["character_animations"][char_type] = strips
+        return strips
+    
+    def _build_character_animations(self, char_type):
+        # Разделение спрайтшитов на кадры (в реальной игре загружайте отдельные файлы)
+        def split_sprite(sprite, cols, rows):
+            frames = []
+            frame_width = sprite.get_width() // cols
+            frame_height = sprite.get_height() // rows
+            for row in range(rows):
+                for col in range(cols):
+                    frame = sprite.subsurface(pygame.Rect(
+                        col * frame_width,
+                        row * frame_height,
+                        frame_width,
+                        frame_height
+                    ))
+                    frames.append(frame)
+            return frames
+        
+        def strip(anim, cols, speed, loop=True):
+            return FrameStrip(split_sprite(self.get_image(f"{char_type}_{anim}"), cols, 1), speed, loop, self.atlas)
+        
+        return {
+            "idle": strip("idle", 4, 0.1),
+            "run": strip("run", 6, 0.15),
+            "jump": strip("jump", 1, 0.1, False),
+            "attack": strip("attack", 4, 0.2, False),
+            "death": strip("death", 4, 0.15, False)
+        }
+    
+    def get_solid(self, size, color):
+        # Одноцветный прямоугольник (монета, снаряд): один кадр в атласе на размер и цвет
+        key = (tuple(size), tuple(color))
+        image = self.solids.get(key)
+        if image is None:
+            image = pygame.Surface(size)
+            image.fill(color)
+            image = self.solids[key] = self.atlas.pack(image)
+        return image
+    
+    def get_enemy_animations(self, enemy_type):
+        # Кадры врагов создаются один раз на тип и разделяются всеми экземплярами
+        strips = self.assets["enemy_animations"].get(enemy_type)
+        if strips is None:
+            strips = self._build_enemy_animations(enemy_type)
+            self.assets["enemy_animations"][enemy_type] = strips
+        return strips
     
-    def get_sound(self, name):
-        return self.assets["sounds"].get(name, None)
+    def _build_enemy_animations(self, enemy_type):
+        # Заглушка - в реальной игре загружайте спрайты
+        idle = pygame.Surface((50, 50))
+        run = pygame.Surface((50, 50))
+        attack = pygame.Surface((60, 50))
+        death = pygame.Surface((50, 50))
+        
+        idle.fill(RED)
+        run.fill((200, 0, 0))
+        attack.fill((255, 100, 100))
+        death.fill((100, 0, 0))
+        
+        return {
+            "idle": FrameStrip([idle], 0.1, atlas=self.atlas),
+            "run": FrameStrip([run], 0.15, atlas=self.atlas),
+            "attack": FrameStrip([attack], 0.2, False, self.atlas),
+            "death": FrameStrip([death], 0.15, False, self.atlas)
+        }
     
     def play_music(self, name, loops=-1, volume=0.5):
         try:
@@ -106,30 +477,267 @@ class AssetManager:
         except:
             print(f"Error playing music: {name}")
 
-class Animation:
-    def __init__(self, frames, speed=0.1, loop=True):
-        self.frames = frames
+class AudioManager:
+    # Звуковые эффекты. Звук - это семейство вариантов из assets/sounds, каждый
+    # вариант декодируется в PCM (pygame.mixer.Sound) один раз и дальше лежит в памяти.
+    # У звука есть приоритет и лимит одновременных голосов: при лимите новый голос
+    # вытесняет самый старый голос того же звука, а без свободных каналов - самый
+    # старый из менее важных звуков
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._init()
+        return cls._instance
+    
+    def _init(self):
+        self.sounds = {}  # имя -> {"paths", "priority", "voices", "volume"}
+        self.buffers = {}  # путь -> декодированный Sound
+        self.buffer_bytes = 0
+        self.lock = threading.Lock()
+        self.rng = random.Random()  # свой генератор: выбор варианта не трогает random игры
+        self.last_variant = {}
+        self.last_played = {}  # имя -> время последнего запуска, мс
+        self.stats = {"played": 0, "dropped": 0, "stolen": 0, "decode_stalls": 0}
+        self.enabled = pygame.mixer.get_init() is not None
+        self.channels = []
+        self.owners = []  # для каждого канала: (приоритет, время старта, имя, Sound) или None
+        if self.enabled:
+            pygame.mixer.set_num_channels(AUDIO_CHANNELS)
+            self.channels = [pygame.mixer.Channel(i) for i in range(AUDIO_CHANNELS)]
+            self.owners = [None] * AUDIO_CHANNELS
+        self._load_manifest()
+    
+    def _load_manifest(self):
+        def family(folder):
+            folder = os.path.join("assets/sounds", folder)
+            try:
+                return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith(".ogg")]
+            except OSError:
+                return []
+        
+        def files(*names):
+            return [f"assets/sounds/{name}.ogg" for name in names]
+        
+        # Имя: варианты, приоритет, голосов одновременно, громкость
+        manifest = {
+            "jump": (family("8-Bit jingles"), 3, 1, 0.4),
+            "attack": (family("Steel jingles"), 4, 2, 0.5),
+            "hurt": (family("Hit jingles"), 5, 3, 0.6),
+            "coin": (family("Pizzicato jingles"), 2, 2, 0.5),
+            "victory": (files("you_win", "winner"), 10, 1, 0.8),
+            "game_over": (files("game_over", "you_lose", "loser"), 10, 1, 0.8),
+        }
+        for number in range(1, 6):
+            manifest[f"round_{number}"] = (files(f"round_{number}"), 8, 1, 0.8)
+        
+        for name, (paths, priority, voices, volume) in manifest.items():
+            paths = [path for path in paths if os.path.exists(path)]
+            if not paths:
+                print(f"Error loading sound: {name}")
+                continue
+            self.sounds[name] = {"paths": paths, "priority": priority, "voices": voices, "volume": volume}
+    
+    def _decode(self, path):
+        sound = self.buffers.get(path)
+        if sound is not None:
+            return sound
+        try:
+            sound = pygame.mixer.Sound(path)
+        except pygame.error:
+            print(f"Error loading sound: {path}")
+            return None
+        frequency, size, channels = pygame.mixer.get_init()
+        with self.lock:
+            if path not in self.buffers:
+                self.buffers[path] = sound
+                self.buffer_bytes += int(sound.get_length() * frequency * channels * abs(size) // 8)
+            return self.buffers[path]
+    
+    def preload(self, background=True):
+        # Декодировать все варианты заранее, чтобы первый play() не ждал декодера
+        if not self.enabled:
+            return
+        paths = [path for spec in self.sounds.values() for path in spec["paths"]]
+        if background:
+            threading.Thread(target=lambda: [self._decode(path) for path in paths], daemon=True).start()
+        else:
+            for path in paths:
+                self._decode(path)
+    
+    def _variant(self, name):
+        # Случайный вариант из семейства, но не тот же, что в прошлый раз
+        paths = self.sounds[name]["paths"]
+        index = self.rng.randrange(len(paths))
+        if len(paths) > 1 and index == self.last_variant.get(name):
+            index = (index + 1) % len(paths)
+        self.last_variant[name] = index
+        sound = self.buffers.get(paths[index])
+        if sound is None:
+            self.stats["decode_stalls"] += 1
+            sound = self._decode(paths[index])
+        return sound
+    
+    def _pick_channel(self, name, priority, voices):
+        # Занятые нашими звуками каналы (звук мог доиграть или его прервали)
+        playing = []
+        for index, owner in enumerate(self.owners):
+            if owner is not None and self.channels[index].get_busy() and self.channels[index].get_sound() is owner[3]:
+                playing.append(index)
+            else:
+                self.owners[index] = None
+        
+        own = [index for index in playing if self.owners[index][2] == name]
+        if len(own) >= voices:
+            return min(own, key=lambda index: self.owners[index][1])
+        for index, owner in enumerate(self.owners):
+            if owner is None:
+                return index
+        victim = min(playing, key=lambda index: self.owners[index][:2])
+        if self.owners[victim][0] > priority:
+            return None
+        return victim
+    
+    def play(self, name):
+        # Отсутствующий звук просто не играет
+        spec = self.sounds.get(name)
+        if spec is None or not self.enabled:
+            return None
+        now = pygame.time.get_ticks()
+        last = self.last_played.get(name)
+        if last is not None and now - last < AUDIO_RETRIGGER_MS:
+            self.stats["dropped"] += 1
+            return None
+        
+        index = self._pick_channel(name, spec["priority"], spec["voices"])
+        if index is None:
+            self.stats["dropped"] += 1
+            return None
+        sound = self._variant(name)
+        if sound is None:
+            return None
+        if self.owners[index] is not None:
+            self.stats["stolen"] += 1
+        
+        channel = self.channels[index]
+        channel.play(sound)
+        channel.set_volume(spec["volume"])
+        self.owners[index] = (spec["priority"], now, name, sound)
+        self.last_played[name] = now
+        self.stats["played"] += 1
+        return channel
+    
+    def stop_all(self):
+        for index, channel in enumerate(self.channels):
+            channel.stop()
+            self.owners[index] = None
+    
+    def get_stats(self):
+        with self.lock:
+            decoded = len(self.buffers)
+            buffer_bytes = self.buffer_bytes
+        return dict(self.stats, decoded=decoded, buffer_bytes=buffer_bytes,
+                    voices=sum(owner is not None for owner in self.owners))
+
+class FrameStrip:
+    # Кадры анимации, общие для всех сущностей (flyweight): хранятся один раз.
+    # С атласом кадры (и отражённые тоже) копируются в его страницы
+    def __init__(self, frames, speed=0.1, loop=True, atlas=None):
+        self.atlas = atlas
+        self.frames = atlas.pack_all(frames) if atlas is not None else frames
+        self.flipped_frames = None  # Отражённые кадры, создаются при первом запросе
         self.speed = speed
         self.loop = loop
+    
+    def get_frames(self, facing_right=True):
+        if facing_right:
+            return self.frames
+        if self.flipped_frames is None:
+            flipped = [pygame.transform.flip(frame, True, False) for frame in self.frames]
+            self.flipped_frames = self.atlas.pack_all(flipped) if self.atlas is not None else flipped
+        return self.flipped_frames
+
+class Animation:
+    # Курсор воспроизведения: у каждой сущности свой, кадры - общие
+    __slots__ = ("strip", "current_frame", "done")
+    
+    def __init__(self, frames, speed=0.1, loop=True):
+        self.strip = frames if isinstance(frames, FrameStrip) else FrameStrip(frames, speed, loop)
         self.current_frame = 0
         self.done = False
     
+    @property
+    def frames(self):
+        return self.strip.frames
+    
+    @property
+    def speed(self):
+        return self.strip.speed
+    
+    @property
+    def loop(self):
+        return self.strip.loop
+    
     def reset(self):
         self.current_frame = 0
         self.done = False
     
     def update(self):
         if not self.done:
-            self.current_frame += self.speed
-            if self.current_frame >= len(self.frames):
-                if self.loop:
+            self.current_frame += self.strip.speed * STEP
+            if self.current_frame >= len(self.strip.frames):
+                if self.strip.loop:
                     self.current_frame = 0
                 else:
-                    self.current_frame = len(self.frames) - 1
+                    self.current_frame = len(self.strip.frames) - 1
                     self.done = True
     
-    def get_current_frame(self):
-        return self.frames[int(self.current_frame)]
+    def get_current_frame(self, facing_right=True):
+        return self.strip.get_frames(facing_right)[int(self.current_frame)]
+
+class CombatMasks:
+    # Маски для боя, общие для всех бойцов и посчитанные один раз. Хартбокс - непрозрачные
+    # пиксели кадра (ключ - сама поверхность кадра; отражённый кадр - отдельная
+    # поверхность, так что сторона взгляда учтена), хитбокс - прямоугольник удара из
+    # MELEE на кадр и сторону. Проверка удара: широкая фаза - хитбокс против rect цели,
+    # узкая - Mask.overlap с пикселями её кадра
+    def __init__(self):
+        self.hurt = {}
+        self.hit = {}
+    
+    def hurtbox(self, image):
+        mask = self.hurt.get(image)
+        if mask is None:
+            mask = self.hurt[image] = pygame.mask.from_surface(image)
+        return mask
+    
+    def hitbox(self, kind, frame, facing_right, width):
+        # (смещение и размер от rect.topleft, маска) или None, если кадр не бьёт
+        key = (kind, frame, facing_right, width)
+        if key not in self.hit:
+            boxes = MELEE[kind]["boxes"] if kind in MELEE else ()
+            box = boxes[frame] if frame < len(boxes) else None
+            if box is not None:
+                x, y, w, h = box
+                if not facing_right:
+                    x = width - x - w
+                box = (pygame.Rect(x, y, w, h), pygame.mask.Mask((w, h), fill=True))
+            self.hit[key] = box
+        return self.hit[key]
+    
+    def strike(self, x, y, hit, target):
+        # Задевает ли хитбокс бойца с rect.topleft = (x, y) цель; кадр цели рисуется от её rect.topleft
+        box, mask = hit
+        left = x + box.x
+        top = y + box.y
+        rect = target.rect
+        if not (left < rect.right and rect.left < left + box.width
+                and top < rect.bottom and rect.top < top + box.height):
+            return False
+        return mask.overlap(self.hurtbox(target.image), (rect.left - left, rect.top - top)) is not None
+
+combat_masks = CombatMasks()
 
 class Entity(pygame.sprite.Sprite):
     def __init__(self, x, y):
@@ -139,10 +747,11 @@ class Entity(pygame.sprite.Sprite):
         self.state = "idle"
         self.facing_right = True
         self.rect = pygame.Rect(x, y, 50, 80)
+        self.prev_position = self.rect.topleft  # позиция на прошлом тике, для интерполяции
         self.velocity = pygame.math.Vector2(0, 0)
         self.health = 100
         self.max_health = 100
-        self.attack_cooldown = 0
+        self.attack_cooldown = 0.0
         self.attack_power = 10
         self.alive = True
     
@@ -150,13 +759,12 @@ class Entity(pygame.sprite.Sprite):
         if name in self.animations and self.current_animation != self.animations[name]:
             self.current_animation = self.animations[name]
             self.current_animation.reset()
+            self.image = self.current_animation.get_current_frame(self.facing_right)
     
     def update_animation(self):
         if self.current_animation:
             self.current_animation.update()
-            self.image = self.current_animation.get_current_frame()
-            if not self.facing_right:
-                self.image = pygame.transform.flip(self.image, True, False)
+            self.image = self.current_animation.get_current_frame(self.facing_right)
     
     def take_damage(self, amount):
         if self.alive:
@@ -165,12 +773,22 @@ class Entity(pygame.sprite.Sprite):
                 self.health = 0
                 self.alive = False
                 self.set_animation("death")
+                ParticleSystem().emit("death", *self.rect.center)
                 return True
+            ParticleSystem().emit("hit", *self.rect.center)
         return False
     
     def update_cooldowns(self):
         if self.attack_cooldown > 0:
-            self.attack_cooldown -= 1000 / FPS
+            self.attack_cooldown -= 1000 / SIM_RATE
+    
+    def begin_step(self):
+        self.prev_position = self.rect.topleft
+    
+    def interpolated_rect(self, alpha):
+        # Позиция между двумя тиками симуляции: alpha = 0 - прошлый тик, 1 - текущий
+        x, y = self.prev_position
+        return self.rect.move(round((x - self.rect.x) * (1 - alpha)), round((y - self.rect.y) * (1 - alpha)))
 
 class Player(Entity):
     def __init__(self, x, y, char_type="warrior"):
@@ -180,42 +798,13 @@ class Player(Entity):
         self.set_animation("idle")
         self.jumping = False
         self.attacking = False
+        self.struck = set()  # враги, уже получившие текущий удар
         self.coins = 0
         self.score = 0
     
     def load_animations(self):
-        asset_manager = AssetManager()
-        
-        # Загрузка анимаций для выбранного персонажа
-        idle = asset_manager.get_image(f"{self.char_type}_idle")
-        run = asset_manager.get_image(f"{self.char_type}_run")
-        jump = asset_manager.get_image(f"{self.char_type}_jump")
-        attack = asset_manager.get_image(f"{self.char_type}_attack")
-        death = asset_manager.get_image(f"{self.char_type}_death")
-        
-        # Разделение спрайтшитов на кадры (в реальной игре загружайте отдельные файлы)
-        def split_sprite(sprite, cols, rows):
-            frames = []
-            frame_width = sprite.get_width() // cols
-            frame_height = sprite.get_height() // rows
-            for row in range(rows):
-                for col in range(cols):
-                    frame = sprite.subsurface(pygame.Rect(
-                        col * frame_width,
-                        row * frame_height,
-                        frame_width,
-                        frame_height
-                    ))
-                    frames.append(frame)
-            return frames
-        
-        self.animations = {
-            "idle": Animation(split_sprite(idle, 4, 1), 0.1),
-            "run": Animation(split_sprite(run, 6, 1), 0.15),
-            "jump": Animation(split_sprite(jump, 1, 1), 0.1, False),
-            "attack": Animation(split_sprite(attack, 4, 1), 0.2, False),
-            "death": Animation(split_sprite(death, 4, 1), 0.15, False)
-        }
+        strips = AssetManager().get_character_animations(self.char_type)
+        self.animations = {name: Animation(strip) for name, strip in strips.items()}
     
     def update(self, platforms, enemies):
         if not self.alive:
@@ -224,11 +813,12 @@ class Player(Entity):
             return
         
         # Физика
-        self.velocity.y += GRAVITY
-        self.rect.y += self.velocity.y
+        self.velocity.y += GRAVITY * STEP
+        self.rect.x += self.velocity.x * STEP
+        self.rect.y += self.velocity.y * STEP
         
         # Коллизия с платформами
-        for platform in platforms:
+        for platform in platforms.query(self.rect):
             if self.rect.colliderect(platform.rect):
                 if self.velocity.y > 0:  # Падение вниз
                     self.rect.bottom = platform.rect.top
@@ -255,21 +845,44 @@ class Player(Entity):
         if not self.jumping and not self.attacking and self.alive:
             self.velocity.y = JUMP_FORCE
             self.jumping = True
-            AssetManager().get_sound("jump").play()
+            AudioManager().play("jump")
     
     def attack(self):
         if not self.attacking and self.attack_cooldown <= 0 and self.alive:
             self.attacking = True
             self.attack_cooldown = ATTACK_COOLDOWN
             self.set_animation("attack")
-            AssetManager().get_sound("attack").play()
+            self.struck.clear()
+            AudioManager().play("attack")
             return True
         return False
     
+    def melee(self, enemies, engine=None):
+        # Удар на активных кадрах атаки: каждый враг получает урон раз за замах.
+        # Возвращает убитых
+        if not self.attacking or not self.alive:
+            return []
+        hit = combat_masks.hitbox(self.char_type, int(self.current_animation.current_frame),
+                                  self.facing_right, self.rect.width)
+        if hit is None:
+            return []
+        x, y = self.rect.topleft
+        candidates = enemies if engine is None else engine.in_rect(hit[0].move(x, y))
+        killed = []
+        for enemy in candidates:
+            if enemy.alive and enemy not in self.struck and combat_masks.strike(x, y, hit, enemy):
+                self.struck.add(enemy)
+                if enemy.take_damage(MELEE[self.char_type]["damage"]):
+                    killed.append(enemy)
+        return killed
+    
     def add_coin(self):
         self.coins += 1
         self.score += 100
-        AssetManager().get_sound("coin").play()
+        AudioManager().play("coin")
+    
+    def add_kill(self):
+        self.score += KILL_SCORE
 
 class Enemy(Entity):
     def __init__(self, x, y, enemy_type="slime"):
@@ -279,29 +892,26 @@ class Enemy(Entity):
         self.set_animation("idle")
         self.speed = 1.5
         self.direction = 1
-        self.attack_range = 50
         self.detection_range = 300
+        self.grounded = False  # стоит на опоре; в воздухе падает (только при навигации)
+        self.engine = None  # EnemyEngine, если враг обновляется векторно
+        self.engine_index = -1
     
     def load_animations(self):
-        # Заглушка - в реальной игре загружайте спрайты
-        idle = pygame.Surface((50, 50))
-        run = pygame.Surface((50, 50))
-        attack = pygame.Surface((60, 50))
-        death = pygame.Surface((50, 50))
-        
-        idle.fill(RED)
-        run.fill((200, 0, 0))
-        attack.fill((255, 100, 100))
-        death.fill((100, 0, 0))
-        
-        self.animations = {
-            "idle": Animation([idle], 0.1),
-            "run": Animation([run], 0.15),
-            "attack": Animation([attack], 0.2, False),
-            "death": Animation([death], 0.15, False)
-        }
+        strips = AssetManager().get_enemy_animations(self.enemy_type)
+        self.animations = {name: Animation(strip) for name, strip in strips.items()}
+    
+    def take_damage(self, amount):
+        if self.engine is not None:
+            return self.engine.damage(self, amount)
+        return super().take_damage(amount)
+    
+    def kill(self):
+        if self.engine is not None:
+            self.engine.remove(self)
+        super().kill()
     
-    def update(self, platforms, player):
+    def update(self, platforms, player, nav=None):
         if not self.alive:
             self.set_animation("death")
             if self.current_animation.done:
@@ -309,15 +919,23 @@ class Enemy(Entity):
             self.update_animation()
             return
         
-        # Простой ИИ
-        if abs(self.rect.x - player.rect.x) < self.detection_range:
-            self.direction = 1 if player.rect.x > self.rect.x else -1
+        # Простой ИИ; с графом навигации - путь к игроку по платформам
+        chasing = abs(self.rect.x - player.rect.x) < self.detection_range
+        toward = 1 if player.rect.x > self.rect.x else -1
+        if nav is None:
+            if chasing:
+                self.direction = toward
+        elif self.grounded:
+            self.direction, jump = nav.steer(self.rect.centerx, self.rect.bottom, self.direction, chasing, toward)
+            if jump:
+                self.velocity.y = JUMP_FORCE
+                self.grounded = False
         
         self.velocity.x = self.speed * self.direction
-        self.rect.x += self.velocity.x
+        self.rect.x += self.velocity.x * STEP
         
         # Коллизия с платформами
-        for platform in platforms:
+        for platform in platforms.query(self.rect):
             if self.rect.colliderect(platform.rect):
                 if self.direction > 0:
                     self.rect.right = platform.rect.left
@@ -325,12 +943,20 @@ class Enemy(Entity):
                     self.rect.left = platform.rect.right
                 self.direction *= -1
         
-        # Атака игрока
-        if abs(self.rect.x - player.rect.x) < self.attack_range and self.attack_cooldown <= 0:
+        if nav is not None:
+            self.fall(platforms)
+            if self.rect.top > nav.kill_y:  # Упал за уровень
+                self.kill()
+                return
+        
+        # Атака игрока: удар, если хитбокс задевает его
+        hit = combat_masks.hitbox(self.enemy_type, 0, self.direction > 0, self.rect.width)
+        if (self.attack_cooldown <= 0 and hit is not None
+                and combat_masks.strike(self.rect.x, self.rect.y, hit, player)):
             self.set_animation("attack")
             if player.alive:
-                player.take_damage(5)
-                AssetManager().get_sound("hurt").play()
+                player.take_damage(MELEE[self.enemy_type]["damage"])
+                AudioManager().play("hurt")
             self.attack_cooldown = ATTACK_COOLDOWN
         elif abs(self.velocity.x) > 0.1:
             self.set_animation("run")
@@ -341,6 +967,420 @@ class Enemy(Entity):
         self.update_cooldowns()
         self.update_animation()
 
+    def fall(self, platforms):
+        # Вертикальная физика: сошёл с опоры - падает, приземляется на платформы, бьётся о них головой
+        if self.grounded:
+            below = self.rect.move(0, 1)
+            self.grounded = any(below.colliderect(platform.rect) for platform in platforms.query(below))
+        if self.grounded:
+            return
+        self.velocity.y += GRAVITY * STEP
+        self.rect.y += self.velocity.y * STEP
+        for platform in platforms.query(self.rect):
+            if self.rect.colliderect(platform.rect):
+                if self.velocity.y > 0:
+                    self.rect.bottom = platform.rect.top
+                    self.grounded = True
+                else:
+                    self.rect.top = platform.rect.bottom
+                self.velocity.y = 0
+
+class EnemyEngine:
+    # Векторизованный ИИ живых врагов: состояние лежит в массивах NumPy,
+    # логика та же, что в Enemy.update, но сразу для всех. Спрайтам каждый тик
+    # достаются только позиция и кадр; остальное - через flush_sprite.
+    # Умирающие враги отдаются обратно в обычный Enemy.update (группа detached)
+    ANIMATIONS = ("idle", "run", "attack")
+    IDLE, RUN, ATTACK = 0, 1, 2
+    FIELDS = {
+        "x": "i8", "y": "i8", "w": "i8", "h": "i8", "direction": "i8", "health": "i8",
+        "velocity_x": "f8", "velocity_y": "f8", "grounded": "?", "speed": "f8", "cooldown": "f8",
+        "detection_range": "f8", "frame": "f8", "anim": "i8", "type": "i8",
+        "done": "?", "moved": "?", "shown": "i8"
+    }
+    
+    def __init__(self, enemies, capacity=256):
+        self.sprites = []
+        self.count = 0
+        self.capacity = 0
+        self.type_index = {}
+        self.strips = []  # [тип][анимация] -> FrameStrip
+        self.speed_table = np.zeros((0, len(self.ANIMATIONS)))
+        self.length_table = np.zeros((0, len(self.ANIMATIONS)), dtype="i8")
+        self.loop_table = np.zeros((0, len(self.ANIMATIONS)), dtype="?")
+        self.hit_table = np.zeros((0, 4), dtype="i8")  # [тип] -> хитбокс атаки (x, y, w, h) вправо
+        self.damage_table = []
+        self.detached = pygame.sprite.Group()
+        self.platform_source = None
+        self.platform_version = None
+        self.platform_count = 0
+        self._grow(capacity)
+        for enemy in enemies:
+            self.add(enemy)
+    
+    def _grow(self, capacity):
+        for name, dtype in self.FIELDS.items():
+            array = np.zeros(capacity, dtype=dtype)
+            if self.capacity:
+                array[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, array)
+        self.capacity = capacity
+    
+    def _type_of(self, sprite):
+        index = self.type_index.get(sprite.enemy_type)
+        if index is None:
+            index = self.type_index[sprite.enemy_type] = len(self.strips)
+            strips = [sprite.animations[name].strip for name in self.ANIMATIONS]
+            self.strips.append(strips)
+            self.speed_table = np.vstack([self.speed_table, [strip.speed for strip in strips]])
+            self.length_table = np.vstack([self.length_table, [len(strip.frames) for strip in strips]])
+            self.loop_table = np.vstack([self.loop_table, [strip.loop for strip in strips]])
+            melee = MELEE.get(sprite.enemy_type)
+            box = melee["boxes"][0] if melee else None
+            self.hit_table = np.vstack([self.hit_table, box or (0, 0, 0, 0)])
+            self.damage_table.append(melee["damage"] if melee else 0)
+        return index
+    
+    def add(self, sprite):
+        if not sprite.alive:
+            self.detached.add(sprite)
+            return
+        if self.count == self.capacity:
+            self._grow(self.capacity * 2)
+        i = self.count
+        self.x[i], self.y[i] = sprite.rect.topleft
+        self.w[i], self.h[i] = sprite.rect.size
+        self.direction[i] = sprite.direction
+        self.health[i] = sprite.health
+        self.velocity_x[i] = sprite.velocity.x
+        self.velocity_y[i] = sprite.velocity.y
+        self.grounded[i] = sprite.grounded
+        self.speed[i] = sprite.speed
+        self.cooldown[i] = sprite.attack_cooldown
+        self.detection_range[i] = sprite.detection_range
+        self.type[i] = self._type_of(sprite)
+        
+        anim = self.IDLE
+        for index, name in enumerate(self.ANIMATIONS):
+            if sprite.current_animation is sprite.animations[name]:
+                anim = index
+        self.anim[i] = anim
+        self.frame[i] = sprite.animations[self.ANIMATIONS[anim]].current_frame
+        self.done[i] = sprite.animations[self.ANIMATIONS[anim]].done
+        self.moved[i] = False
+        self.shown[i] = -1
+        
+        sprite.engine = self
+        sprite.engine_index = i
+        self.sprites.append(sprite)
+        self.count += 1
+    
+    def flush_sprite(self, i):
+        # Записать всё состояние из массивов обратно в спрайт
+        sprite = self.sprites[i]
+        sprite.rect.topleft = (int(self.x[i]), int(self.y[i]))
+        sprite.direction = int(self.direction[i])
+        sprite.health = int(self.health[i])
+        sprite.velocity.x = float(self.velocity_x[i])
+        sprite.velocity.y = float(self.velocity_y[i])
+        sprite.grounded = bool(self.grounded[i])
+        sprite.attack_cooldown = float(self.cooldown[i])
+        sprite.facing_right = sprite.direction > 0
+        sprite.current_animation = sprite.animations[self.ANIMATIONS[self.anim[i]]]
+        sprite.current_animation.current_frame = float(self.frame[i])
+        sprite.current_animation.done = bool(self.done[i])
+        sprite.image = sprite.current_animation.get_current_frame(sprite.facing_right)
+    
+    def flush(self):
+        for i in range(self.count):
+            self.flush_sprite(i)
+    
+    def _release(self, i):
+        # Убрать врага из массивов: на его место встаёт последний
+        sprite = self.sprites[i]
+        last = self.count - 1
+        if i != last:
+            for name in self.FIELDS:
+                array = getattr(self, name)
+                array[i] = array[last]
+            self.sprites[i] = self.sprites[last]
+            self.sprites[i].engine_index = i
+        self.sprites.pop()
+        self.count -= 1
+        sprite.engine = None
+        sprite.engine_index = -1
+    
+    def remove(self, sprite):
+        self.flush_sprite(sprite.engine_index)
+        self._release(sprite.engine_index)
+    
+    def damage(self, sprite, amount):
+        i = sprite.engine_index
+        self.flush_sprite(i)
+        died = Entity.take_damage(sprite, amount)
+        if sprite.alive:
+            self.health[i] = sprite.health
+        else:
+            # Анимацию смерти и kill() ведёт обычный Enemy.update
+            self._release(i)
+            self.detached.add(sprite)
+        return died
+    
+    def _index_platforms(self, platforms):
+        # Пары (ячейка сетки, платформа), отсортированные по ячейке - та же сетка,
+        # что в SpatialHash, но в массивах, чтобы искать кандидатов через searchsorted
+        size = getattr(platforms, "cell_size", 128)
+        rects = [platform.rect for platform in platforms]
+        keys = []
+        owners = []
+        for index, rect in enumerate(rects):
+            for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+                for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                    keys.append(self._cell_key(cx, cy))
+                    owners.append(index)
+        keys = np.array(keys, dtype="i8")
+        order = np.argsort(keys, kind="stable")
+        self.platform_source = platforms
+        self.platform_version = getattr(platforms, "version", None)
+        self.platform_count = len(rects)
+        self.cell_size = size
+        self.cell_keys = keys[order]
+        self.cell_owners = np.array(owners, dtype="i8")[order]
+        self.platform_rects = (
+            np.array([rect.left for rect in rects], dtype="i8"),
+            np.array([rect.top for rect in rects], dtype="i8"),
+            np.array([rect.right for rect in rects], dtype="i8"),
+            np.array([rect.bottom for rect in rects], dtype="i8")
+        )
+    
+    @staticmethod
+    def _cell_key(cx, cy):
+        return (cx + (1 << 20)) * (1 << 21) + cy + (1 << 20)
+    
+    def in_rect(self, rect):
+        # Живые враги, чьи прямоугольники пересекают rect
+        n = self.count
+        x, y = self.x[:n], self.y[:n]
+        inside = ((x < rect.right) & (x + self.w[:n] > rect.left)
+                  & (y < rect.bottom) & (y + self.h[:n] > rect.top))
+        return [self.sprites[i] for i in np.flatnonzero(inside).tolist()]
+    
+    def _reaches(self, player, n, candidates):
+        # Хитбоксы первого кадра атаки против игрока: прямоугольники - сразу для всех
+        # кандидатов, маски (как в Enemy.update) - только для задевших
+        x, y, w = self.x[:n], self.y[:n], self.w[:n]
+        types = self.type[:n]
+        bx, by, bw, bh = (self.hit_table[types, k] for k in range(4))
+        facing = self.direction[:n] > 0
+        left = x + np.where(facing, bx, w - bx - bw)
+        top = y + by
+        rect = player.rect
+        near = (candidates & (bw > 0) & (left < rect.right) & (left + bw > rect.left)
+                & (top < rect.bottom) & (top + bh > rect.top))
+        reach = np.zeros(n, dtype="?")
+        for i in np.flatnonzero(near).tolist():
+            hit = combat_masks.hitbox(self.sprites[i].enemy_type, 0, bool(facing[i]), int(w[i]))
+            reach[i] = combat_masks.strike(int(x[i]), int(y[i]), hit, player)
+        return reach
+    
+    def _platform_hits(self, platforms, rows, dy=0):
+        # Какие враги из rows (срез или индексы), сдвинутые на dy вниз, пересекают
+        # хоть одну платформу (широкая фаза по сетке)
+        if (self.platform_source is not platforms or self.platform_count != len(platforms)
+                or self.platform_version != getattr(platforms, "version", None)):
+            self._index_platforms(platforms)
+        x = self.x[rows]
+        hits = np.zeros(len(x), dtype="?")
+        if not self.platform_count or not len(x):
+            return hits
+        
+        size = self.cell_size
+        y = self.y[rows] + dy
+        right = x + self.w[rows]
+        bottom = y + self.h[rows]
+        cx0, cy0 = x // size, y // size
+        cx1, cy1 = (right - 1) // size, (bottom - 1) // size
+        left_p, top_p, right_p, bottom_p = self.platform_rects
+        
+        for ox in range(int((cx1 - cx0).max()) + 1):
+            for oy in range(int((cy1 - cy0).max()) + 1):
+                inside = np.flatnonzero((cx0 + ox <= cx1) & (cy0 + oy <= cy1))
+                keys = self._cell_key(cx0[inside] + ox, cy0[inside] + oy)
+                lo = np.searchsorted(self.cell_keys, keys, "left")
+                counts = np.searchsorted(self.cell_keys, keys, "right") - lo
+                total = int(counts.sum())
+                if not total:
+                    continue
+                # Развернуть диапазоны [lo, lo + count) в плоский список пар враг-платформа
+                starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+                owners = self.cell_owners[starts + np.arange(total)]
+                enemies = np.repeat(inside, counts)
+                overlap = ((x[enemies] < right_p[owners]) & (right[enemies] > left_p[owners])
+                           & (y[enemies] < bottom_p[owners]) & (bottom[enemies] > top_p[owners]))
+                hits[enemies[overlap]] = True
+        return hits
+    
+    def _partition(self, area):
+        # Переставить врагов так, чтобы попавшие в area шли первыми; вернуть их число.
+        # Порядок меняется только при входе/выходе врага из области
+        n = self.count
+        x, y = self.x[:n], self.y[:n]
+        inside = ((x < area.right) & (x + self.w[:n] > area.left)
+                  & (y < area.bottom) & (y + self.h[:n] > area.top))
+        k = int(np.count_nonzero(inside))
+        if inside[:k].all():
+            return k
+        order = np.argsort(~inside, kind="stable")
+        for name in self.FIELDS:
+            array = getattr(self, name)
+            array[:n] = array[:n][order]
+        self.sprites = [self.sprites[i] for i in order.tolist()]
+        for i, sprite in enumerate(self.sprites):
+            sprite.engine_index = i
+        return k
+    
+    def update(self, platforms, player, area=None, nav=None):
+        n = self.count if area is None or not self.count else self._partition(area)
+        if n:
+            self._update_alive(platforms, player, n, nav)
+        for enemy in self.detached:
+            enemy.begin_step()
+        self.detached.update(platforms, player, nav)
+    
+    @staticmethod
+    def _round(values):
+        # Rect округляет половины от нуля - так же, как при rect.x += ...
+        return np.where(values >= 0, np.floor(values + 0.5), np.ceil(values - 0.5))
+    
+    def _update_alive(self, platforms, player, n, nav):
+        x = self.x[:n]
+        y = self.y[:n]
+        direction = self.direction[:n]
+        cooldown = self.cooldown[:n]
+        anim = self.anim[:n]
+        frame = self.frame[:n]
+        done = self.done[:n]
+        old_x = x.copy()
+        old_y = y.copy()
+        px = player.rect.x
+        
+        # Простой ИИ; с графом навигации - путь к игроку по платформам
+        chase = np.abs(x - px) < self.detection_range[:n]
+        toward = np.where(px > x, 1, -1)
+        if nav is None:
+            np.copyto(direction, toward, where=chase)
+        else:
+            standing = np.flatnonzero(self.grounded[:n])
+            if standing.size:
+                centerx = x[standing] + self.w[standing] // 2
+                bottom = y[standing] + self.h[standing]
+                steered, jump = nav.steer_many(centerx, bottom, direction[standing], chase[standing], toward[standing])
+                direction[standing] = steered
+                jumped = standing[jump]
+                self.velocity_y[jumped] = JUMP_FORCE
+                self.grounded[jumped] = False
+        
+        velocity_x = self.speed[:n] * direction
+        self.velocity_x[:n] = velocity_x
+        x[:] = self._round(old_x + velocity_x * STEP)
+        
+        # Коллизия с платформами: точная обработка (как в Enemy.update) только для задевших
+        for i in np.flatnonzero(self._platform_hits(platforms, slice(0, n))).tolist():
+            rect = pygame.Rect(int(x[i]), int(self.y[i]), int(self.w[i]), int(self.h[i]))
+            d = int(direction[i])
+            for platform in platforms.query(rect):
+                if rect.colliderect(platform.rect):
+                    if d > 0:
+                        rect.right = platform.rect.left
+                    else:
+                        rect.left = platform.rect.right
+                    d *= -1
+            x[i] = rect.x
+            direction[i] = d
+        
+        fallen = np.zeros(n, dtype="?")
+        if nav is not None:
+            self._fall(platforms, n, nav)
+            fallen = y > nav.kill_y  # Упал за уровень
+        
+        # Атака игрока: удар, если хитбокс задевает его
+        attacking = self._reaches(player, n, (cooldown <= 0) & ~fallen)
+        target = np.where(attacking, self.ATTACK, np.where(np.abs(velocity_x) > 0.1, self.RUN, self.IDLE))
+        for i in np.flatnonzero(attacking).tolist():
+            if player.alive:
+                player.take_damage(self.damage_table[self.type[i]])
+                AudioManager().play("hurt")
+        cooldown[attacking] = ATTACK_COOLDOWN
+        
+        # Кулдауны
+        active = cooldown > 0
+        cooldown[active] -= 1000 / SIM_RATE
+        
+        # Смена анимации (set_animation) и продвижение кадра (Animation.update)
+        changed = anim != target
+        anim[changed] = target[changed]
+        frame[changed] = 0
+        done[changed] = False
+        types = self.type[:n]
+        playing = ~done
+        frame[playing] += self.speed_table[types, anim][playing] * STEP
+        length = self.length_table[types, anim]
+        loop = self.loop_table[types, anim]
+        over = playing & (frame >= length)
+        frame[over & loop] = 0
+        stop = over & ~loop
+        frame[stop] = length[stop] - 1
+        done[stop] = True
+        
+        # В спрайты - только то, что нужно для отрисовки
+        facing = direction > 0
+        frame_index = frame.astype("i8")
+        shown = (anim * 2 + facing) * 65536 + frame_index
+        sprites = self.sprites
+        for i in np.flatnonzero(shown != self.shown[:n]).tolist():
+            sprites[i].image = self.strips[self.type[i]][anim[i]].get_frames(bool(facing[i]))[frame_index[i]]
+        self.shown[:n] = shown
+        
+        moved = (x != old_x) | (y != old_y)
+        for i in np.flatnonzero(moved | self.moved[:n]).tolist():
+            sprites[i].prev_position = (int(old_x[i]), int(old_y[i]))
+            sprites[i].rect.topleft = (int(x[i]), int(y[i]))
+        self.moved[:n] = moved
+        
+        # С конца, чтобы перестановки при удалении не задели ещё не удалённых
+        for i in np.flatnonzero(fallen)[::-1].tolist():
+            sprites[i].kill()
+    
+    def _fall(self, platforms, n, nav):
+        # Enemy.fall для всех: проверка опоры, гравитация и вертикальные коллизии
+        grounded = self.grounded[:n]
+        y = self.y[:n]
+        standing = np.flatnonzero(grounded)
+        if standing.size:
+            # Центр над узлом графа - значит, над платформой; опору проверяем только у сходящих с края
+            off = standing[nav.nodes_at(self.x[standing] + self.w[standing] // 2, y[standing] + self.h[standing]) < 0]
+            grounded[off] = self._platform_hits(platforms, off, 1)
+        airborne = np.flatnonzero(~grounded)
+        if not airborne.size:
+            return
+        velocity_y = self.velocity_y[:n]
+        velocity_y[airborne] += GRAVITY * STEP
+        y[airborne] = self._round(y[airborne] + velocity_y[airborne] * STEP)
+        
+        for i in airborne[self._platform_hits(platforms, airborne)].tolist():
+            rect = pygame.Rect(int(self.x[i]), int(y[i]), int(self.w[i]), int(self.h[i]))
+            vy = float(velocity_y[i])
+            for platform in platforms.query(rect):
+                if rect.colliderect(platform.rect):
+                    if vy > 0:
+                        rect.bottom = platform.rect.top
+                        grounded[i] = True
+                    else:
+                        rect.top = platform.rect.bottom
+                    vy = 0
+            y[i] = rect.y
+            velocity_y[i] = vy
+
 class Platform(pygame.sprite.Sprite):
     def __init__(self, x, y, width, height, color=GREEN):
         super().__init__()
@@ -351,267 +1391,1525 @@ class Platform(pygame.sprite.Sprite):
 class Coin(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.image = pygame.Surface((20, 20))
-        self.image.fill(YELLOW)
+        self.image = AssetManager().get_solid((20, 20), YELLOW)
         self.rect = self.image.get_rect(center=(x, y))
         self.value = 1
 
-class GameState:
-    def __init__(self):
-        self.current_level = 1
-        self.max_level = 3
-        self.player_name = "Player"
-        self.player_class = "warrior"
-        self.highscores = self.load_highscores()
+class SpatialHash:
+    # Индекс платформ (равномерная сетка). Платформы статичны: меняется он только
+    # при загрузке уровня или подгрузке/выгрузке чанков, тогда растёт version
+    def __init__(self, sprites=(), cell_size=128):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.order = {}
+        self.counter = 0
+        self.version = 0
+        for sprite in sprites:
+            self.insert(sprite)
     
-    def load_highscores(self):
-        try:
-            with open("highscores.json", "r") as f:
-                return json.load(f)
-        except:
-            return []
+    def _cells_for(self, rect):
+        size = self.cell_size
+        left = rect.left // size
+        top = rect.top // size
+        right = (rect.left + max(rect.width, 1) - 1) // size
+        bottom = (rect.top + max(rect.height, 1) - 1) // size
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                yield cx, cy
     
-    def save_highscore(self, score):
-        self.highscores.append({
-            "name": self.player_name,
-            "class": self.player_class,
-            "score": score,
-            "level": self.current_level
-        })
-        self.highscores.sort(key=lambda x: x["score"], reverse=True)
-        self.highscores = self.highscores[:10]  # Топ-10
-        
-        with open("highscores.json", "w") as f:
-            json.dump(self.highscores, f)
+    def insert(self, sprite):
+        self.order[sprite] = self.counter
+        self.counter += 1
+        self.version += 1
+        for key in self._cells_for(sprite.rect):
+            self.cells.setdefault(key, []).append(sprite)
     
-    def next_level(self):
-        if self.current_level < self.max_level:
-            self.current_level += 1
-            return True
-        return False
-
-class Button:
-    def __init__(self, x, y, width, height, text, color, hover_color):
-        self.rect = pygame.Rect(x, y, width, height)
-        self.text = text
-        self.color = color
-        self.hover_color = hover_color
-        self.is_hovered = False
+    def remove(self, sprite):
+        del self.order[sprite]
+        self.version += 1
+        for key in self._cells_for(sprite.rect):
+            cell = self.cells[key]
+            cell.remove(sprite)
+            if not cell:
+                del self.cells[key]
     
-    def draw(self, surface):
-        color = self.hover_color if self.is_hovered else self.color
-        pygame.draw.rect(surface, color, self.rect, border_radius=10)
-        pygame.draw.rect(surface, WHITE, self.rect, 2, border_radius=10)
-        
-        text_surf = font_medium.render(self.text, True, WHITE)
-        text_rect = text_surf.get_rect(center=self.rect.center)
-        surface.blit(text_surf, text_rect)
+    def query(self, rect):
+        # Кандидаты из ячеек, которые задевает rect, в порядке добавления (как в Group)
+        found = set()
+        for key in self._cells_for(rect):
+            cell = self.cells.get(key)
+            if cell:
+                found.update(cell)
+        if len(found) > 1:
+            return sorted(found, key=self.order.__getitem__)
+        return list(found)
     
-    def check_hover(self, pos):
-        self.is_hovered = self.rect.collidepoint(pos)
-        return self.is_hovered
+    def __iter__(self):
+        return iter(self.order)
     
-    def is_clicked(self, pos, click):
-        return self.rect.collidepoint(pos) and click
+    def __len__(self):
+        return len(self.order)
 
-def main_menu():
-    game_state = GameState()
-    asset_manager = AssetManager()
-    asset_manager.play_music("menu")
+def rect_step(value):
+    # На сколько сдвинется целая неотрицательная координата Rect от += value:
+    # Rect округляет половины от нуля, и x + 1.5 даёт +2, а x - 1.5 - только -1
+    return math.floor(value + 0.5)
+
+class NavGraph:
+    # Граф проходимых поверхностей уровня для ИИ врагов, строится один раз на уровень.
+    # Узел - отрезок верхней грани платформы, над которым может стоять центр врага
+    # (без мест у стен, куда враг не пройдёт). Связи: шаг на соседнюю платформу той же
+    # высоты (walk), сход с края (fall) и прыжок (jump). Падения и прыжки проверяются
+    # потиковой симуляцией той же физики, что в Enemy.update (GRAVITY, JUMP_FORCE,
+    # скорость, округление Rect), так что связь проходима на деле.
+    # Маршруты кэшируются по (откуда, куда); кэш сбрасывается, когда игрок переходит
+    # на другой узел. Поиск идёт от цели сразу ко всем узлам, так что враги
+    # делят одно дерево маршрутов, а векторный движок берёт из него таблицы next_*
+    WALK, FALL, JUMP = 1, 2, 3
+    KEY_SHIFT = 1 << 24  # ключ узла: y * KEY_SHIFT + левый край
     
-    title = font_large.render("EPIC PLATFORMER", True, PURPLE)
-    subtitle = font_medium.render("Выберите действие:", True, WHITE)
+    def __init__(self, rects, agent_size=(50, 80), speed=1.5, cell_size=128):
+        self.rects = [pygame.Rect(rect) for rect in rects]
+        self.agent_width, self.agent_height = agent_size
+        self.speed = speed
+        self.cell_size = cell_size
+        self.step_right = rect_step(speed * STEP)
+        self.step_left = rect_step(-speed * STEP)
+        self.jump_tolerance = max(self.step_right, -self.step_left)
+        self.kill_y = max((rect.bottom for rect in self.rects), default=0) + 200  # ниже - упал за уровень
+        
+        self.rect_cells = {}
+        self.near_cache = {}
+        for index, rect in enumerate(self.rects):
+            for key in self._cells(rect):
+                self.rect_cells.setdefault(key, []).append(index)
+        
+        self._build_nodes()
+        # Из каждого узла: (вид, куда, x центра при старте, направление, цена)
+        self.links = [[] for _ in self.nodes]
+        self._build_links()
+        self.incoming = [[] for _ in self.nodes]
+        for source, links in enumerate(self.links):
+            for kind, target, takeoff, direction, cost in links:
+                self.incoming[target].append((source, kind, takeoff, direction, cost))
+        
+        self.near_cache = None
+        self.target = -1
+        self.trees = {}  # цель -> первая связь маршрута для каждого узла
+        self.paths = {}  # (откуда, куда) -> список связей
+        self.stats = {"queries": 0, "cache_hits": 0, "searches": 0}
+        if np is not None:
+            self.node_key_array = np.array(self.node_keys, dtype="i8")
+            self.node_y_array = np.array([y for y, _, _ in self.nodes], dtype="i8")
+            self.node_left_array = np.array([left for _, left, _ in self.nodes], dtype="i8")
+            self.node_right_array = np.array([right for _, _, right in self.nodes], dtype="i8")
+            self.walk_left_array = np.array(self.walk_left, dtype="?")
+            self.walk_right_array = np.array(self.walk_right, dtype="?")
+            self._sync_arrays()
     
-    buttons = [
-        Button(WIDTH//2 - 100, HEIGHT//2 - 50, 200, 50, "Играть", BLUE, (0, 100, 255)),
-        Button(WIDTH//2 - 100, HEIGHT//2 + 20, 200, 50, "Рекорды", GREEN, (0, 200, 100)),
-        Button(WIDTH//2 - 100, HEIGHT//2 + 90, 200, 50, "Выход", RED, (200, 0, 0))
-    ]
+    def _cells(self, rect):
+        size = self.cell_size
+        for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                yield cx, cy
     
-    running = True
-    while running:
-        mouse_pos = pygame.mouse.get_pos()
-        mouse_click = False
-        
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == MOUSEBUTTONDOWN:
-                if event.button == 1:
-                    mouse_click = True
-        
-        screen.fill(BLACK)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
-        screen.blit(subtitle, (WIDTH//2 - subtitle.get_width()//2, 200))
-        
-        for button in buttons:
-            button.check_hover(mouse_pos)
-            button.draw(screen)
-            
-            if button.is_clicked(mouse_pos, mouse_click):
-                if button.text == "Играть":
-                    character_select(game_state)
-                elif button.text == "Рекорды":
-                    show_highscores(game_state)
-                elif button.text == "Выход":
-                    pygame.quit()
-                    sys.exit()
-        
-        pygame.display.flip()
-        pygame.time.Clock().tick(FPS)
-
-def character_select(game_state):
-    asset_manager = AssetManager()
+    def _overlapping(self, rect):
+        found = set()
+        for key in self._cells(rect):
+            found.update(self.rect_cells.get(key, ()))
+        return [self.rects[index] for index in sorted(found) if self.rects[index].colliderect(rect)]
     
-    title = font_large.render("Выберите персонажа", True, WHITE)
+    def _near(self, span):
+        # Платформы из ячеек span = (cx0, cy0, cx1, cy1), с кэшем:
+        # симуляция много тиков подряд остаётся в тех же ячейках
+        near = self.near_cache.get(span)
+        if near is None:
+            found = set()
+            for cx in range(span[0], span[2] + 1):
+                for cy in range(span[1], span[3] + 1):
+                    found.update(self.rect_cells.get((cx, cy), ()))
+            near = self.near_cache[span] = [self.rects[index] for index in sorted(found)]
+        return near
     
-    classes = [
-        {"name": "Воин", "type": "warrior", "desc": "Сильный и выносливый"},
-        {"name": "Маг", "type": "mage", "desc": "Мощные атаки"},
-        {"name": "Лучник", "type": "archer", "desc": "Быстрый и ловкий"}
-    ]
+    def _build_nodes(self):
+        # Враг с центром cx задевает стену cover, если cover.left - half < cx < cover.right + (w - half)
+        half = self.agent_width // 2
+        nodes = []
+        for rect in self.rects:
+            band = pygame.Rect(rect.left - self.agent_width, rect.top - self.agent_height,
+                               rect.width + self.agent_width * 2, self.agent_height)
+            segments = [(rect.left, rect.right)]
+            for cover in self._overlapping(band):
+                blocked_left = cover.left - half + 1
+                blocked_right = cover.right + self.agent_width - half
+                cut = []
+                for left, right in segments:
+                    if blocked_right <= left or blocked_left >= right:
+                        cut.append((left, right))
+                        continue
+                    if left < blocked_left:
+                        cut.append((left, blocked_left))
+                    if blocked_right < right:
+                        cut.append((blocked_right, right))
+                segments = cut
+            nodes.extend((rect.top, left, right) for left, right in segments)
+        nodes.sort()
+        self.nodes = nodes
+        self.node_keys = [y * self.KEY_SHIFT + left for y, left, _ in nodes]
     
-    buttons = []
-    for i, cls in enumerate(classes):
-        buttons.append(Button(
-            WIDTH//2 - 150, 
-            200 + i*120, 
-            300, 
-            100, 
-            cls["name"], 
-            (50, 50, 150), 
-            (100, 100, 255)
-        ))
-    
-    back_button = Button(50, HEIGHT - 70, 150, 50, "Назад", RED, (200, 0, 0))
-    
-    running = True
-    while running:
-        mouse_pos = pygame.mouse.get_pos()
-        mouse_click = False
-        
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == MOUSEBUTTONDOWN:
-                if event.button == 1:
-                    mouse_click = True
-        
-        screen.fill(BLACK)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 50))
-        
-        for i, button in enumerate(buttons):
-            button.check_hover(mouse_pos)
-            button.draw(screen)
-            
-            # Описание класса
-            desc = font_small.render(classes[i]["desc"], True, WHITE)
-            screen.blit(desc, (WIDTH//2 - desc.get_width()//2, button.rect.bottom + 5))
+    def node_at(self, centerx, bottom):
+        # Узел, над которым стоит центр врага, или -1
+        index = bisect.bisect_right(self.node_keys, bottom * self.KEY_SHIFT + centerx) - 1
+        if index >= 0:
+            y, left, right = self.nodes[index]
+            if y == bottom and left <= centerx < right:
+                return index
+        return -1
+    
+    def _simulate(self, source, centerx, bottom, velocity_y, direction, grounded):
+        # Тики Enemy.update для врага, идущего в одну сторону: сдвиг по x, затем fall().
+        # Возвращает (узел, тиков), как только враг окажется на другом узле, или None,
+        # если он упрётся в стену, приземлится мимо узлов или упадёт за уровень
+        rect = pygame.Rect(centerx - self.agent_width // 2, bottom - self.agent_height,
+                           self.agent_width, self.agent_height)
+        size = self.cell_size
+        for tick in range(1, 600):
+            rect.x += self.speed * direction * STEP
+            # Ячейки берутся на пиксель ниже rect - для проверки опоры
+            near = self._near((rect.left // size, rect.top // size, (rect.right - 1) // size, rect.bottom // size))
+            if rect.collidelist(near) >= 0:
+                return None
+            if grounded:
+                grounded = rect.move(0, 1).collidelist(near) >= 0
+                if grounded:
+                    node = self.node_at(rect.centerx, rect.bottom)
+                    if node >= 0 and node != source:
+                        return node, tick
+                    continue
+            velocity_y += GRAVITY * STEP
+            rect.y += velocity_y * STEP
+            for platform in self._near((rect.left // size, rect.top // size, (rect.right - 1) // size, rect.bottom // size)):
+                if not rect.colliderect(platform):
+                    continue
+                if velocity_y > 0:
+                    rect.bottom = platform.top
+                    grounded = True
+                else:
+                    rect.top = platform.bottom
+                velocity_y = 0
+            if grounded:
+                node = self.node_at(rect.centerx, rect.bottom)
+                return (node, tick) if node >= 0 and node != source else None
+            if rect.top > self.kill_y:
+                return None
+        return None
+    
+    def _verified(self, source, target, starts, velocity_y, direction):
+        # Связь годится, только если из каждой возможной точки старта враг попадает в target
+        ticks = 0
+        for start in starts:
+            result = self._simulate(source, start, self.nodes[source][0], velocity_y, direction, velocity_y == 0)
+            if result is None or result[0] != target:
+                return None
+            ticks = max(ticks, result[1])
+        return ticks
+    
+    def _jump_arc(self):
+        # Прыжок вправо с места: (тик, смещение центра по x, по y, скорость по y),
+        # пока враг не опустится на две своих высоты ниже точки старта
+        arc = []
+        x = y = 0
+        velocity_y = JUMP_FORCE
+        for tick in range(1, 600):
+            x += self.step_right
+            velocity_y += GRAVITY * STEP
+            y += rect_step(velocity_y * STEP)
+            arc.append((tick, x, y, velocity_y))
+            if y > self.agent_height * 2:
+                break
+        return arc
+    
+    def _build_links(self):
+        nodes = self.nodes
+        by_left = {(y, left): index for index, (y, left, _) in enumerate(nodes)}
+        by_right = {(y, right): index for index, (y, _, right) in enumerate(nodes)}
+        self.walk_right = [False] * len(nodes)
+        self.walk_left = [False] * len(nodes)
+        speed = self.speed
+        
+        for index, (y, left, right) in enumerate(nodes):
+            middle = (left + right) // 2
+            links = self.links[index]
+            # Соседняя платформа вплотную - просто идём
+            neighbour = by_left.get((y, right))
+            if neighbour is not None:
+                links.append((self.WALK, neighbour, right - 1, 1, (right - middle) / speed))
+                self.walk_right[index] = True
+            neighbour = by_right.get((y, left))
+            if neighbour is not None:
+                links.append((self.WALK, neighbour, left, -1, (middle - left) / speed))
+                self.walk_left[index] = True
             
-            if button.is_clicked(mouse_pos, mouse_click):
-                game_state.player_class = classes[i]["type"]
-                name_input(game_state)
+            # Сход с края: враг идёт дальше, пока не сойдёт с опоры, и падает.
+            # Последняя точка центра на узле зависит от шага, поэтому проверяются все
+            for direction, walked in ((1, self.walk_right[index]), (-1, self.walk_left[index])):
+                if walked:
+                    continue
+                if direction > 0:
+                    starts = range(max(left, right - self.step_right), right)
+                    edge = right - 1
+                else:
+                    starts = range(left, min(right, left - self.step_left))
+                    edge = left
+                landing = self._simulate(index, edge, y, 0.0, direction, True)
+                if landing is None:
+                    continue
+                ticks = self._verified(index, landing[0], starts, 0.0, direction)
+                if ticks is not None:
+                    links.append((self.FALL, landing[0], edge, direction, abs(edge - middle) / speed + ticks))
         
-        back_button.check_hover(mouse_pos)
-        back_button.draw(screen)
-        if back_button.is_clicked(mouse_pos, mouse_click):
+        # Прыжки: траектория относительно точки старта одна, поэтому старт
+        # подбирается так, чтобы центр приземлился у ближнего края цели
+        arc = self._jump_arc()
+        reach = arc[-1][1] + self.agent_width
+        rise = -min(y for _, _, y, _ in arc)
+        node_cells = {}
+        for index, (y, left, right) in enumerate(nodes):
+            for key in self._cells(pygame.Rect(left, y, max(right - left, 1), 1)):
+                node_cells.setdefault(key, []).append(index)
+        for index, (y, left, right) in enumerate(nodes):
+            area = pygame.Rect(left - reach, y - rise, right - left + reach * 2, rise + self.agent_height * 2)
+            candidates = set()
+            for key in self._cells(area):
+                candidates.update(node_cells.get(key, ()))
+            reached = {link[1] for link in self.links[index]}
+            for target in sorted(candidates):
+                if target != index and target not in reached:
+                    link = self._jump_link(index, target, arc)
+                    if link is not None:
+                        self.links[index].append(link)
+    
+    def _jump_link(self, source, target, arc):
+        y, left, right = self.nodes[source]
+        target_y, target_left, target_right = self.nodes[target]
+        # Тик, на котором ноги при снижении доходят до высоты цели
+        landing_tick = next((tick for tick, _, dy, vy in arc if vy > 0 and dy >= target_y - y), None)
+        if landing_tick is None:
+            return None
+        tolerance = self.jump_tolerance
+        margin = tolerance * 2 + 2
+        for direction in (1, -1):
+            step = self.step_right if direction > 0 else self.step_left
+            distance = step * landing_tick
+            # Центр приземляется у ближнего края цели или над её серединой
+            for aim in ((target_left + margin, (target_left + target_right) // 2) if direction > 0
+                        else (target_right - 1 - margin, (target_left + target_right) // 2)):
+                takeoff = min(max(aim - distance, left + tolerance), right - 1 - tolerance)
+                if (takeoff - aim) * direction > 0 or not left <= takeoff < right:
+                    continue
+                # Дуга без препятствий и так не долетает или перелетает - не симулировать
+                if not target_left <= takeoff + distance < target_right:
+                    continue
+                starts = range(max(left, takeoff - tolerance), min(right, takeoff + tolerance + 1))
+                ticks = self._verified(source, target, starts, JUMP_FORCE, direction)
+                if ticks is not None:
+                    cost = abs(takeoff - (left + right) // 2) / self.speed + ticks + 30
+                    return (self.JUMP, target, takeoff, direction, cost)
+        return None
+    
+    def _tree(self, target):
+        # Дейкстра от цели по входящим связям: для каждого узла - первая связь маршрута
+        tree = self.trees.get(target)
+        if tree is not None:
+            return tree
+        self.stats["searches"] += 1
+        tree = {target: None}
+        distance = {target: 0.0}
+        queue = [(0.0, target)]
+        while queue:
+            cost, current = heapq.heappop(queue)
+            if cost > distance[current]:
+                continue
+            for source, kind, takeoff, direction, link_cost in self.incoming[current]:
+                total = cost + link_cost
+                if total < distance.get(source, float("inf")):
+                    distance[source] = total
+                    tree[source] = (kind, current, takeoff, direction, link_cost)
+                    heapq.heappush(queue, (total, source))
+        self.trees[target] = tree
+        return tree
+    
+    def path(self, source, target):
+        # Список связей от узла до узла; пустой - уже на месте, None - не добраться
+        self.stats["queries"] += 1
+        key = (source, target)
+        if key in self.paths:
+            self.stats["cache_hits"] += 1
+            return self.paths[key]
+        tree = self._tree(target)
+        if source not in tree:
+            path = None
+        else:
+            path = []
+            node = source
+            while node != target:
+                link = tree[node]
+                path.append(link)
+                node = link[1]
+        self.paths[key] = path
+        return path
+    
+    def set_target(self, node):
+        # Игрок перешёл на другой узел - прежние маршруты больше не нужны
+        if node == self.target:
             return
+        self.target = node
+        self.trees.clear()
+        self.paths.clear()
+        if np is not None:
+            self._sync_arrays()
+    
+    def _sync_arrays(self):
+        # Первая связь маршрута к игроку для каждого узла - для steer_many
+        count = len(self.nodes)
+        self.next_kind_array = np.zeros(count, dtype="i8")
+        self.next_x_array = np.zeros(count, dtype="i8")
+        self.next_dir_array = np.zeros(count, dtype="i8")
+        if self.target < 0:
+            return
+        for source, link in self._tree(self.target).items():
+            if link is not None:
+                self.next_kind_array[source], _, self.next_x_array[source], self.next_dir_array[source], _ = link
+    
+    def steer(self, centerx, bottom, direction, chasing, toward):
+        # Решение стоящего на опоре врага: (направление, прыгать ли)
+        node = self.node_at(centerx, bottom)
+        if node < 0:  # сходит с края - не передумывать на полпути
+            return direction, False
+        if chasing:
+            path = self.path(node, self.target) if self.target >= 0 else None
+            if not path:  # игрок на этом же узле или до него не добраться
+                return toward, False
+            kind, _, takeoff, link_direction, _ = path[0]
+            if kind == self.JUMP:
+                if abs(centerx - takeoff) <= self.jump_tolerance:
+                    return link_direction, True
+                return (1 if takeoff > centerx else -1), False
+            return link_direction, False
+        # Патруль: не сходить с края платформы
+        y, left, right = self.nodes[node]
+        if direction > 0 and centerx + self.step_right >= right and not self.walk_right[node]:
+            return -1, False
+        if direction < 0 and centerx + self.step_left < left and not self.walk_left[node]:
+            return 1, False
+        return direction, False
+    
+    def nodes_at(self, centerx, bottom):
+        # node_at для массивов NumPy
+        index = np.searchsorted(self.node_key_array, bottom * self.KEY_SHIFT + centerx, "right") - 1
+        safe = np.maximum(index, 0)
+        found = ((index >= 0) & (self.node_y_array[safe] == bottom)
+                 & (self.node_left_array[safe] <= centerx) & (centerx < self.node_right_array[safe]))
+        return np.where(found, index, -1)
+    
+    def steer_many(self, centerx, bottom, direction, chasing, toward):
+        # steer для массивов NumPy: (направление, маска прыжка)
+        node = self.nodes_at(centerx, bottom)
+        on_node = node >= 0
+        safe = np.maximum(node, 0)
+        kind = np.where(on_node & chasing, self.next_kind_array[safe], 0)
+        takeoff = self.next_x_array[safe]
+        link_dir = self.next_dir_array[safe]
         
-        pygame.display.flip()
-        pygame.time.Clock().tick(FPS)
-
-def name_input(game_state):
-    input_active = True
-    name = ""
-    
-    title = font_large.render("Введите имя", True, WHITE)
-    prompt = font_medium.render("Имя персонажа:", True, WHITE)
-    
-    while input_active:
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == KEYDOWN:
-                if event.key == K_RETURN:
-                    input_active = False
-                elif event.key == K_BACKSPACE:
-                    name = name[:-1]
+        result = direction.copy()
+        # Погоня без маршрута - прямо к игроку
+        np.copyto(result, toward, where=on_node & chasing & (kind == 0))
+        np.copyto(result, link_dir, where=(kind == self.WALK) | (kind == self.FALL))
+        at_takeoff = np.abs(centerx - takeoff) <= self.jump_tolerance
+        jump = (kind == self.JUMP) & at_takeoff
+        np.copyto(result, link_dir, where=jump)
+        np.copyto(result, np.where(takeoff > centerx, 1, -1), where=(kind == self.JUMP) & ~at_takeoff)
+        
+        patrol = on_node & ~chasing
+        turn_left = patrol & (direction > 0) & (centerx + self.step_right >= self.node_right_array[safe]) & ~self.walk_right_array[safe]
+        turn_right = patrol & (direction < 0) & (centerx + self.step_left < self.node_left_array[safe]) & ~self.walk_left_array[safe]
+        result[turn_left] = -1
+        result[turn_right] = 1
+        return result, jump
+
+class Projectile:
+    # Слот пула снарядов. Объекты создаются один раз и переиспользуются
+    __slots__ = ("image", "rect", "x", "y", "vx", "vy", "gravity", "damage", "ttl", "prev_position")
+    
+    def __init__(self):
+        self.image = None
+        self.rect = pygame.Rect(0, 0, 0, 0)
+        self.x = self.y = self.vx = self.vy = self.gravity = 0.0
+        self.damage = 0
+        self.ttl = 0.0
+        self.prev_position = (0, 0)
+    
+    def interpolated_rect(self, alpha):
+        x0, y0 = self.prev_position
+        return self.rect.move(round((x0 - self.rect.x) * (1 - alpha)), round((y0 - self.rect.y) * (1 - alpha)))
+
+class ProjectilePool:
+    # Снаряды мага и лучника: PROJECTILE_POOL_SIZE заранее созданных слотов,
+    # выстрел берёт свободный, попадание возвращает его обратно - без Sprite и kill().
+    # Снаряды обходятся обычным циклом, но без лишней работы на каждый: враги
+    # раскладываются по ячейкам сетки платформ один раз за тик, снаряд смотрит только
+    # свою ячейку. Платформы проверяются по отрезку пути за тик, а не по точке центра,
+    # чтобы быстрый снаряд не проскакивал тонкую платформу
+    def __init__(self, capacity=PROJECTILE_POOL_SIZE):
+        self.images = {kind: AssetManager().get_solid(spec["size"], spec["color"]) for kind, spec in PROJECTILES.items()}
+        self.free = [Projectile() for _ in range(capacity)]
+        self.active = []
+        self.enemy_cells = {}  # ячейка -> враги в ней; списки живут между тиками
+        self.filled_cells = []  # непустые на этом тике списки - их и очищать
+        self.stats = {"fired": 0, "dropped": 0, "hits": 0}
+    
+    def fire(self, kind, x, y, direction):
+        if not self.free:
+            self.stats["dropped"] += 1
+            return None
+        spec = PROJECTILES[kind]
+        projectile = self.free.pop()
+        projectile.image = self.images[kind]
+        projectile.rect.size = spec["size"]
+        projectile.x = float(x)
+        projectile.y = float(y)
+        projectile.vx = float(spec["speed"] * direction)
+        projectile.vy = 0.0
+        projectile.gravity = spec["gravity"]
+        projectile.damage = spec["damage"]
+        projectile.ttl = spec["ttl"]
+        projectile.rect.center = (int(x), int(y))
+        projectile.prev_position = projectile.rect.topleft
+        self.active.append(projectile)
+        self.stats["fired"] += 1
+        return projectile
+    
+    def fire_from(self, player):
+        # Выстрел из-за плеча персонажа в сторону взгляда; у воина снарядов нет
+        if player.char_type not in PROJECTILES:
+            return None
+        direction = 1 if player.facing_right else -1
+        x = player.rect.right if player.facing_right else player.rect.left
+        return self.fire(player.char_type, x, player.rect.centery - 10, direction)
+    
+    def _index_enemies(self, enemies, cell_size):
+        # Враг попадает во все ячейки, которые задевает его прямоугольник, расширенный
+        # на половину снаряда, - тогда хватает проверить ячейку центра снаряда.
+        # Списки ячеек не пересоздаются, а очищаются на месте: за тик ничего не выделяется
+        cells = self.enemy_cells
+        filled = self.filled_cells
+        for cell in filled:
+            cell.clear()
+        filled.clear()
+        margin = max(max(spec["size"]) for spec in PROJECTILES.values()) // 2 + 1
+        for enemy in enemies:
+            if not enemy.alive:
+                continue
+            rect = enemy.rect
+            for cx in range((rect.left - margin) // cell_size, (rect.right + margin) // cell_size + 1):
+                for cy in range((rect.top - margin) // cell_size, (rect.bottom + margin) // cell_size + 1):
+                    cell = cells.get((cx, cy))
+                    if cell is None:
+                        cell = cells[(cx, cy)] = []
+                    if not cell:
+                        filled.append(cell)
+                    cell.append(enemy)
+    
+    def update(self, platforms, enemies, bounds):
+        # Возвращает врагов, убитых за тик
+        active = self.active
+        if not active:
+            return []
+        size = platforms.cell_size
+        self._index_enemies(enemies, size)
+        enemy_cells = self.enemy_cells
+        platform_cells = platforms.cells
+        left, top, right, bottom = bounds.left, bounds.top, bounds.right, bounds.bottom
+        free = self.free
+        killed = []
+        kept = 0
+        for projectile in active:
+            rect = projectile.rect
+            projectile.prev_position = rect.topleft
+            px = projectile.x
+            py = projectile.y
+            vy = projectile.vy + projectile.gravity * STEP
+            projectile.vy = vy
+            x = projectile.x + projectile.vx * STEP
+            y = projectile.y + vy * STEP
+            projectile.x = x
+            projectile.y = y
+            projectile.ttl -= STEP
+            ix = int(x)
+            iy = int(y)
+            rect.center = (ix, iy)
+            
+            hit = projectile.ttl <= 0 or not (left <= x < right and top <= y < bottom)
+            if not hit:
+                key = (ix // size, iy // size)
+                start = (int(px) // size, int(py) // size)
+                if start == key:
+                    candidates = platform_cells.get(key, ())
                 else:
-                    if len(name) < 15:
-                        name += event.unicode
+                    # Отрезок пересёк границу ячеек - смотрим все ячейки между концами
+                    candidates = platforms.query(pygame.Rect(min(px, x), min(py, y), abs(x - px) + 1, abs(y - py) + 1))
+                for platform in candidates:
+                    if platform.rect.clipline(px, py, x, y):
+                        hit = True
+                        break
+                else:
+                    for enemy in enemy_cells.get(key, ()):
+                        if enemy.alive and rect.colliderect(enemy.rect):
+                            if enemy.take_damage(projectile.damage):
+                                killed.append(enemy)
+                            self.stats["hits"] += 1
+                            hit = True
+                            break
+            
+            if hit:
+                free.append(projectile)
+            else:
+                active[kept] = projectile
+                kept += 1
+        del active[kept:]
+        return killed
+    
+    def clear(self):
+        self.free.extend(self.active)
+        self.active.clear()
+    
+    def __iter__(self):
+        return iter(self.active)
+    
+    def __len__(self):
+        return len(self.active)
+
+class ParticleSystem:
+    # Частицы эффектов (монеты, удары, смерти) в заранее выделенных массивах NumPy:
+    # кольцо на PARTICLE_CAPACITY мест, вспышка пишет следующие count мест (затирая
+    # самые старые). Тик двигает разом всю занятую часть кольца - от самой старой
+    # живой частицы до head, отрисовка пишет квадратики прямо
+    # в пиксели экрана через surfarray - ни спрайтов, ни циклов по частицам.
+    # Случайность своя (не random), так что записи уровней от частиц не зависят
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._init()
+        return cls._instance
+    
+    def _init(self, capacity=PARTICLE_CAPACITY):
+        self.enabled = np is not None
+        if not self.enabled:
+            return
+        self.capacity = capacity
+        self.kinds = list(PARTICLE_EMITTERS)
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.vx = np.zeros(capacity)
+        self.vy = np.zeros(capacity)
+        self.gravity = np.zeros(capacity)
+        self.life = np.zeros(capacity)  # тиков осталось; <= 0 - место свободно
+        self.max_life = np.ones(capacity)
+        self.kind = np.zeros(capacity, dtype="i8")
+        self.head = 0  # куда пишет следующая вспышка
+        self.span = 0  # мест перед head, где ещё могут быть живые частицы
+        self.rng = np.random.default_rng(0)
+        self.palette = None
+        self.palette_format = None
+    
+    @property
+    def active(self):
+        return self.enabled and self.span > 0
+    
+    def clear(self):
+        if self.enabled:
+            self.life[:] = 0
+            self.span = 0
+    
+    def _spans(self):
+        # Занятая часть кольца - один или (через конец массива) два среза
+        start = (self.head - self.span) % self.capacity
+        if start + self.span <= self.capacity:
+            return [slice(start, start + self.span)]
+        return [slice(start, self.capacity), slice(0, self.head)]
+    
+    def emit(self, kind, x, y, count=None):
+        if not self.enabled:
+            return
+        spec = PARTICLE_EMITTERS[kind]
+        count = min(count or spec["count"], self.capacity)
+        index = (self.head + np.arange(count)) % self.capacity
+        self.head = (self.head + count) % self.capacity
+        self.span = min(self.span + count, self.capacity)
+        rng = self.rng
+        angle = np.radians(rng.uniform(*spec["angle"], count))
+        speed = rng.uniform(*spec["speed"], count)
+        life = rng.uniform(*spec["life"], count)
+        self.x[index] = x
+        self.y[index] = y
+        self.vx[index] = np.cos(angle) * speed
+        self.vy[index] = np.sin(angle) * speed
+        self.gravity[index] = spec["gravity"]
+        self.life[index] = life
+        self.max_life[index] = life
+        self.kind[index] = self.kinds.index(kind)
+    
+    def update(self):
+        if not self.active:
+            return
+        for part in self._spans():
+            self.vy[part] += self.gravity[part] * STEP
+            self.x[part] += self.vx[part] * STEP
+            self.y[part] += self.vy[part] * STEP
+            self.life[part] -= STEP
+        # Отмершее начало занятой части больше не трогаем
+        skipped = 0
+        for part in self._spans():
+            alive = self.life[part] > 0
+            if alive.any():
+                skipped += int(alive.argmax())
+                break
+            skipped += part.stop - part.start
+        self.span -= skipped
+    
+    def live_count(self):
+        return int(np.count_nonzero(self.life > 0)) if self.enabled else 0
+    
+    def _palette(self, surface):
+        # Цвета вида x ступень угасания в формате пикселей поверхности
+        fmt = (surface.get_bitsize(), surface.get_masks())
+        if fmt != self.palette_format:
+            self.palette_format = fmt
+            self.palette = np.array([[surface.map_rgb([c * (shade + 1) // PARTICLE_SHADES for c in spec["color"]])
+                                      for shade in range(PARTICLE_SHADES)]
+                                     for spec in PARTICLE_EMITTERS.values()], dtype="i8")
+        return self.palette
+    
+    def project(self, surface, offset=(0, 0)):
+        # Видимые частицы: (занятые ими прямоугольники экрана, x, y, цвета) или None.
+        # Прямоугольник - на каждую ячейку PARTICLE_DIRTY_CELL с частицами: две вспышки
+        # в разных углах экрана не сливаются в одну область на весь экран
+        if not self.active:
+            return None
+        live = np.concatenate([np.flatnonzero(self.life[part] > 0) + part.start for part in self._spans()])
+        size = PARTICLE_SIZE
+        width, height = surface.get_size()
+        sx = self.x[live].astype("i8") - offset[0]
+        sy = self.y[live].astype("i8") - offset[1]
+        visible = (sx >= 0) & (sx <= width - size) & (sy >= 0) & (sy <= height - size)
+        if not visible.any():
+            return None
+        live = live[visible]
+        sx = sx[visible]
+        sy = sy[visible]
+        shade = (self.life[live] * PARTICLE_SHADES / self.max_life[live]).astype("i8")
+        colors = self._palette(surface)[self.kind[live], np.minimum(shade, PARTICLE_SHADES - 1)]
+        # Квадратик частицы у края ячейки заходит в соседнюю - прямоугольник ячейки шире на size
+        cell = PARTICLE_DIRTY_CELL
+        columns = width // cell + 1
+        occupied = np.flatnonzero(np.bincount((sy // cell) * columns + sx // cell))
+        rects = [pygame.Rect(index % columns * cell, index // columns * cell, cell + size, cell + size)
+                 for index in occupied.tolist()]
+        return rects, sx, sy, colors
+    
+    def draw(self, surface, offset=(0, 0), projected=None):
+        # Возвращает прямоугольники, занятые частицами на экране (пустой список, если их нет)
+        if projected is None:
+            projected = self.project(surface, offset)
+            if projected is None:
+                return []
+        rects, sx, sy, colors = projected
+        pixels = pygame.surfarray.pixels2d(surface)
+        for dx in range(PARTICLE_SIZE):
+            for dy in range(PARTICLE_SIZE):
+                pixels[sx + dx, sy + dy] = colors
+        del pixels  # снять блокировку поверхности
+        return rects
+
+def set_sim_rate(rate):
+    if not 0 < rate <= 240:
+        raise ValueError(f"sim rate out of range: {rate}")
+    global SIM_RATE, STEP
+    SIM_RATE = rate
+    STEP = 60 / rate
+
+class PhaseTimer:
+    # Время по фазам кадра: mark(name) закрывает фазу, начатую предыдущей отметкой
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.totals = {}
+        self.last = 0.0
+    
+    def begin(self):
+        if self.enabled:
+            self.last = time.perf_counter()
+    
+    def mark(self, name):
+        if self.enabled:
+            now = time.perf_counter()
+            self.totals[name] = self.totals.get(name, 0.0) + now - self.last
+            self.last = now
+
+NULL_TIMER = PhaseTimer(enabled=False)
+
+class FrameProfiler(PhaseTimer):
+    # Фазы каждого кадра в кольцевом буфере на PROFILER_FRAMES кадров: оверлей
+    # со средним и p99 по фазам, экспорт в trace-event JSON (chrome://tracing, Perfetto)
+    # и cProfile на выбранном отрезке кадров
+    def __init__(self, capacity=PROFILER_FRAMES, cprofile_range=None, trace_path=None):
+        super().__init__()
+        self.capacity = capacity
+        self.frames = [None] * capacity  # (начало кадра, [(фаза, начало, конец), ...])
+        self.frame_number = 0
+        self.frame_start = 0.0
+        self.events = []
+        self.origin = time.perf_counter()
+        self.overlay_visible = False
+        self.overlay = None
+        self.cprofile_range = cprofile_range  # (первый кадр, последний кадр) включительно
+        self.cprofile = None
+        self.trace_path = trace_path  # куда выгрузить трассу при выходе
+    
+    def begin_frame(self):
+        if self.cprofile_range is not None and self.frame_number == self.cprofile_range[0]:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.events = []
+        self.begin()
+        self.frame_start = self.last
+    
+    def mark(self, name):
+        now = time.perf_counter()
+        self.events.append((name, self.last, now))
+        self.totals[name] = self.totals.get(name, 0.0) + now - self.last
+        self.last = now
+    
+    def end_frame(self):
+        self.frames[self.frame_number % self.capacity] = (self.frame_start, self.events)
+        if self.cprofile is not None and self.frame_number == self.cprofile_range[1]:
+            self._stop_cprofile()
+        self.frame_number += 1
+        if self.overlay_visible and self.frame_number % PROFILER_OVERLAY_REFRESH == 0:
+            self.overlay = None
+    
+    def _stop_cprofile(self):
+        self.cprofile.disable()
+        first, last = self.cprofile_range
+        path = f"frames_{first}-{last}.prof"
+        self.cprofile.dump_stats(path)
+        self.cprofile = None
+        print(f"cProfile for frames {first}-{last} saved to {path}")
+    
+    def recent_frames(self):
+        # Кадры из буфера от старых к новым
+        count = min(self.frame_number, self.capacity)
+        for number in range(self.frame_number - count, self.frame_number):
+            yield number, self.frames[number % self.capacity]
+    
+    def summary(self):
+        # Фаза -> (среднее, p99) в мс за кадр; фаза, которой в кадре не было, считается нулём
+        per_frame = []
+        phases = []
+        for _, (start, events) in self.recent_frames():
+            frame = {"frame": (events[-1][2] - start) if events else 0.0}
+            for name, begin, end in events:
+                if name not in frame:
+                    frame[name] = 0.0
+                    if name not in phases:
+                        phases.append(name)
+                frame[name] += end - begin
+            per_frame.append(frame)
+        if not per_frame:
+            return {}
+        result = {}
+        for name in phases + ["frame"]:
+            values = sorted(frame.get(name, 0.0) for frame in per_frame)
+            p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+            result[name] = (sum(values) / len(values) * 1000, p99 * 1000)
+        return result
+    
+    def toggle_overlay(self):
+        self.overlay_visible = not self.overlay_visible
+        self.overlay = None
+        return self.overlay_visible
+    
+    def draw_overlay(self, surface):
+        # Текст пересобирается раз в PROFILER_OVERLAY_REFRESH кадров, а не каждый кадр
+        if not self.overlay_visible:
+            return None
+        if self.overlay is None:
+            lines = [f"{'фаза':<10}{'ср.':>8}{'p99':>8}  мс"]
+            lines += [f"{name:<10}{avg:8.2f}{p99:8.2f}" for name, (avg, p99) in self.summary().items()]
+            images = [font_small.render(line, True, WHITE) for line in lines]
+            width = max(image.get_width() for image in images) + 10
+            self.overlay = pygame.Surface((width, len(images) * 20 + 10), SRCALPHA)
+            self.overlay.fill((0, 0, 0, 180))
+            for i, image in enumerate(images):
+                self.overlay.blit(image, (5, 5 + i * 20))
+        return surface.blit(self.overlay, (WIDTH - self.overlay.get_width() - 10, 60))
+    
+    def export_chrome_trace(self, path):
+        # Кадр - событие "X" на всю длину, фазы вложены в него по времени
+        events = []
+        for number, (start, phases) in self.recent_frames():
+            if not phases:
+                continue
+            events.append({"name": f"frame {number}", "cat": "frame", "ph": "X", "pid": 1, "tid": 1,
+                           "ts": (start - self.origin) * 1e6, "dur": (phases[-1][2] - start) * 1e6})
+            for name, begin, end in phases:
+                events.append({"name": name, "cat": "phase", "ph": "X", "pid": 1, "tid": 1,
+                               "ts": (begin - self.origin) * 1e6, "dur": (end - begin) * 1e6})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print(f"Trace of {len(events)} events saved to {path}")
+    
+    def close(self):
+        if self.cprofile is not None:
+            self._stop_cprofile()
+        if self.trace_path:
+            self.export_chrome_trace(self.trace_path)
+
+def sprite_draw_rect(sprite, alpha):
+    if isinstance(sprite, (Entity, Projectile)):
+        return sprite.interpolated_rect(alpha)
+    return sprite.rect
+
+def iter_sprites(items):
+    # Группы (и пул снарядов) и отдельные спрайты вперемешку; группы читаются "вживую"
+    for item in items:
+        if isinstance(item, pygame.sprite.Sprite):
+            yield item
+        else:
+            yield from item
+
+class Camera:
+    # Окно на уровень: держит игрока в центре, не выходя за края уровня.
+    # Двигается на тиках симуляции, при отрисовке интерполируется, как спрайты
+    def __init__(self, level_width, level_height, width=WIDTH, height=HEIGHT):
+        self.view = pygame.Rect(0, 0, width, height)
+        self.bounds = pygame.Rect(0, 0, max(level_width, width), max(level_height, height))
+        self.prev_position = self.view.topleft
+    
+    def follow(self, rect):
+        self.prev_position = self.view.topleft
+        self.view.center = rect.center
+        self.view.clamp_ip(self.bounds)
+    
+    def snap(self, rect):
+        # Без интерполяции - после телепорта
+        self.follow(rect)
+        self.prev_position = self.view.topleft
+    
+    def offset(self, alpha=1.0):
+        x0, y0 = self.prev_position
+        return (round(x0 + (self.view.x - x0) * alpha), round(y0 + (self.view.y - y0) * alpha))
+    
+    def active_area(self, margin=UPDATE_MARGIN):
+        return self.view.inflate(margin * 2, margin * 2)
+
+def visible_static(static_sprites, view):
+    # Статика в пределах view: через индекс, если он есть
+    if hasattr(static_sprites, "query"):
+        return static_sprites.query(view)
+    return [sprite for sprite in static_sprites if view.colliderect(sprite.rect)]
+
+def visible_items(moving_sprites, alpha, offset, screen_rect, sources):
+    # Элементы blits для спрайтов, попавших в экран: кадр из атласа - (страница,
+    # позиция, область), иначе (картинка, позиция). Порядок спрайтов сохраняется
+    ox, oy = offset
+    items = []
+    for sprite in iter_sprites(moving_sprites):
+        rect = sprite_draw_rect(sprite, alpha).move(-ox, -oy)
+        if screen_rect.colliderect(rect):
+            source = sources.get(sprite.image)
+            items.append((source[0], rect, source[1]) if source is not None else (sprite.image, rect))
+    return items
+
+class FullRenderer:
+    # Полная перерисовка кадра каждый тик
+    def __init__(self, surface, static_sprites, moving_sprites, camera=None):
+        self.surface = surface
+        self.static_sprites = static_sprites
+        self.moving_sprites = moving_sprites
+        self.camera = camera
+        self.sources = AssetManager().atlas.sources
+        self.particles = ParticleSystem()
+    
+    def rebuild_static(self):
+        pass
+    
+    def draw(self, hud, alpha=1.0, timer=NULL_TIMER):
+        offset = self.camera.offset(alpha) if self.camera is not None else (0, 0)
+        screen_rect = self.surface.get_rect()
+        view = screen_rect.move(offset)
+        self.surface.fill(BLACK)
+        self.surface.blits([(sprite.image, sprite.rect.move(-offset[0], -offset[1]))
+                            for sprite in visible_static(self.static_sprites, view)], False)
+        self.surface.blits(visible_items(self.moving_sprites, alpha, offset, screen_rect, self.sources), False)
+        self.particles.draw(self.surface, offset)
+        timer.mark("draw")
+        hud.draw(self.surface)
+        timer.mark("hud")
+        pygame.display.flip()
+        timer.mark("flip")
+
+class DirtyRenderer:
+    # Статика (платформы) собирается в фон под текущее положение камеры - заново,
+    # только когда меняется набор платформ. При сдвиге камеры фон прокручивается,
+    # а платформы дорисовываются лишь в открывшихся полосах. Пока камера стоит,
+    # перерисовываются движущиеся спрайты и HUD и на экран уходят лишь изменённые области
+    def __init__(self, surface, static_sprites, moving_sprites, camera=None):
+        self.surface = surface
+        self.static_sprites = static_sprites
+        self.moving_sprites = moving_sprites
+        self.camera = camera
+        self.sources = AssetManager().atlas.sources
+        self.particles = ParticleSystem()
+        self.background = pygame.Surface(surface.get_size()).convert()
+        self.offset = (0, 0)
+        self.drawn = []  # области, занятые спрайтами (и частицами) на прошлом кадре
+        self.hud_rects = []
+        self.rebuild_static()
+    
+    def paint_static(self, area):
+        # Платформы в области фона area (экранные координаты); за её край не рисуем
+        ox, oy = self.offset
+        self.background.set_clip(area)
+        self.background.fill(BLACK, area)
+        self.background.blits([(sprite.image, sprite.rect.move(-ox, -oy))
+                               for sprite in visible_static(self.static_sprites, area.move(ox, oy))], False)
+        self.background.set_clip(None)
+    
+    def rebuild_static(self):
+        self.paint_static(self.background.get_rect())
+        self.first_frame = True
+    
+    def scroll_static(self, offset):
+        dx, dy = offset[0] - self.offset[0], offset[1] - self.offset[1]
+        self.offset = offset
+        width, height = self.background.get_size()
+        if abs(dx) >= width or abs(dy) >= height:
+            self.rebuild_static()
+            return
+        self.background.scroll(-dx, -dy)
+        if dx:
+            self.paint_static(pygame.Rect(width - dx if dx > 0 else 0, 0, abs(dx), height))
+        if dy:
+            self.paint_static(pygame.Rect(0, height - dy if dy > 0 else 0, width, abs(dy)))
+        # Сдвинулась вся картинка - экран собирается из фона целиком
+        self.first_frame = True
+    
+    def draw(self, hud, alpha=1.0, timer=NULL_TIMER):
+        if self.camera is not None:
+            offset = self.camera.offset(alpha)
+            if offset != self.offset:
+                self.scroll_static(offset)
         
-        screen.fill(BLACK)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
-        screen.blit(prompt, (WIDTH//2 - prompt.get_width()//2, 200))
+        items = visible_items(self.moving_sprites, alpha, self.offset, self.surface.get_rect(), self.sources)
+        particles = self.particles.project(self.surface, self.offset)
+        # Спрайт (или частицы) заходил или заходит под HUD - после очистки HUD нужно вернуть
+        touched = self.drawn + [item[1] for item in items]
+        if particles is not None:
+            touched.extend(particles[0])
+        redraw_hud = (self.first_frame or hud.dirty
+                      or any(rect.collidelist(touched) != -1 for rect in self.hud_rects))
         
-        name_text = font_medium.render(name, True, WHITE)
-        screen.blit(name_text, (WIDTH//2 - name_text.get_width()//2, 250))
+        if self.first_frame:
+            self.surface.blit(self.background, (0, 0))
+        else:
+            for rect in self.drawn:
+                self.surface.blit(self.background, rect, rect)
+            if redraw_hud:
+                for rect in self.hud_rects:
+                    self.surface.blit(self.background, rect, rect)
         
-        enter_text = font_small.render("Нажмите ENTER для продолжения", True, WHITE)
-        screen.blit(enter_text, (WIDTH//2 - enter_text.get_width()//2, 350))
+        dirty = self.drawn
+        self.drawn = self.surface.blits(items)
+        # Частицы - поверх спрайтов областями по ячейкам, которые на следующем кадре стираются, как спрайты
+        if particles is not None:
+            self.drawn.extend(self.particles.draw(self.surface, projected=particles))
+        dirty.extend(self.drawn)
+        timer.mark("draw")
+        if redraw_hud:
+            hud_rects = hud.draw(self.surface)
+            dirty.extend(self.hud_rects)
+            dirty.extend(hud_rects)
+            self.hud_rects = hud_rects
+        timer.mark("hud")
         
-        pygame.display.flip()
-        pygame.time.Clock().tick(FPS)
+        if self.first_frame:
+            pygame.display.flip()
+            self.first_frame = False
+        elif dirty:
+            pygame.display.update(dirty)
+        timer.mark("flip")
+
+class Hud:
+    # Текст HUD пересоздаётся только когда меняются HP, монеты, счёт или уровень
+    def __init__(self):
+        self.values = None
+        self.items = []
+        self.dirty = True
+    
+    def update(self, player, game_state):
+        values = (player.health, player.coins, player.score, game_state.current_level)
+        if values == self.values:
+            return
+        self.values = values
+        health, coins, score, level = values
+        
+        level_text = render_text(font_medium, f"Уровень: {level}", WHITE)
+        self.items = [
+            (render_text(font_medium, f"HP: {health}", WHITE), (10, 10)),
+            (render_text(font_medium, f"Монеты: {coins}", YELLOW), (10, 50)),
+            (render_text(font_medium, f"Счёт: {score}", WHITE), (10, 90)),
+            (level_text, (WIDTH - level_text.get_width() - 10, 10))
+        ]
+        self.dirty = True
+    
+    def draw(self, surface):
+        self.dirty = False
+        return [surface.blit(image, pos) for image, pos in self.items]
+
+class LevelData:
+    # Уровень в файле levels/levelN.json: сетка тайлов ("#" - твёрдый, "." - пусто)
+    # и слой объектов, разбитые на чанки CHUNK_SIZE x CHUNK_SIZE тайлов.
+    # Чанк хранит свои строки тайлов и объекты в абсолютных координатах:
+    # {"type": "coin", "x", "y"}, {"type": "enemy", "x", "y", "enemy_type"},
+    # {"type": "platform", "x", "y", "w", "h"} - платформа не по сетке
+    def __init__(self, cols, rows, tile_size=TILE_SIZE, chunk_size=CHUNK_SIZE, player=(100, 300)):
+        self.cols = cols
+        self.rows = rows
+        self.tile_size = tile_size
+        self.chunk_size = chunk_size
+        self.player = tuple(player)
+        self.chunks = {}  # (cx, cy) -> {"tiles": [строки] или None, "objects": [...]}
+    
+    @property
+    def chunk_pixels(self):
+        return self.tile_size * self.chunk_size
+    
+    @property
+    def pixel_size(self):
+        return self.cols * self.tile_size, self.rows * self.tile_size
+    
+    @property
+    def chunk_count(self):
+        return -(-self.cols // self.chunk_size), -(-self.rows // self.chunk_size)
+    
+    def _chunk(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = {"tiles": None, "objects": []}
+        return chunk
+    
+    def set_tile(self, col, row, tile="#"):
+        size = self.chunk_size
+        chunk = self._chunk((col // size, row // size))
+        if chunk["tiles"] is None:
+            chunk["tiles"] = ["." * size] * size
+        line = chunk["tiles"][row % size]
+        chunk["tiles"][row % size] = line[:col % size] + tile + line[col % size + 1:]
+    
+    def add_object(self, obj):
+        step = self.chunk_pixels
+        if obj["type"] != "platform":
+            self._chunk((int(obj["x"]) // step, int(obj["y"]) // step))["objects"].append(obj)
+            return
+        # Платформа, задевающая несколько чанков, режется по их границам
+        rect = pygame.Rect(obj["x"], obj["y"], obj["w"], obj["h"])
+        for cx in range(rect.left // step, (rect.right - 1) // step + 1):
+            for cy in range(rect.top // step, (rect.bottom - 1) // step + 1):
+                part = rect.clip(pygame.Rect(cx * step, cy * step, step, step))
+                self._chunk((cx, cy))["objects"].append(
+                    {"type": "platform", "x": part.x, "y": part.y, "w": part.w, "h": part.h})
+    
+    def chunk_keys_in(self, rect):
+        step = self.chunk_pixels
+        max_cx, max_cy = self.chunk_count
+        return {(cx, cy)
+                for cx in range(max(0, rect.left // step), min(max_cx, (rect.right - 1) // step + 1))
+                for cy in range(max(0, rect.top // step), min(max_cy, (rect.bottom - 1) // step + 1))}
+    
+    def colliders(self, key):
+        # Твёрдые тайлы чанка, слитые в как можно меньше прямоугольников:
+        # сначала отрезки подряд в строке, затем одинаковые отрезки соседних строк
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            return []
+        rects = [pygame.Rect(obj["x"], obj["y"], obj["w"], obj["h"])
+                 for obj in chunk["objects"] if obj["type"] == "platform"]
+        if not chunk["tiles"]:
+            return rects
+        
+        tile = self.tile_size
+        origin_x = key[0] * self.chunk_pixels
+        origin_y = key[1] * self.chunk_pixels
+        merged = []
+        open_runs = {}  # (начало, конец) -> [столбец, строка, ширина, высота] в тайлах
+        for row, line in enumerate(chunk["tiles"] + [""]):
+            runs = {}
+            col = 0
+            while col < len(line):
+                if line[col] == "#":
+                    start = col
+                    while col < len(line) and line[col] == "#":
+                        col += 1
+                    run = (start, col)
+                    if run in open_runs:
+                        box = open_runs.pop(run)
+                        box[3] += 1
+                    else:
+                        box = [start, row, col - start, 1]
+                    runs[run] = box
+                else:
+                    col += 1
+            merged.extend(open_runs.values())
+            open_runs = runs
+        for col, row, width, height in merged:
+            rects.append(pygame.Rect(origin_x + col * tile, origin_y + row * tile, width * tile, height * tile))
+        return rects
+    
+    def objects(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            return []
+        return [obj for obj in chunk["objects"] if obj["type"] != "platform"]
+    
+    def all_colliders(self):
+        return [rect for key in sorted(self.chunks) for rect in self.colliders(key)]
+    
+    def enemy_count(self):
+        return sum(1 for chunk in self.chunks.values() for obj in chunk["objects"] if obj["type"] == "enemy")
+    
+    def to_dict(self):
+        return {
+            "version": 1,
+            "tile_size": self.tile_size,
+            "chunk_size": self.chunk_size,
+            "size": [self.cols, self.rows],
+            "player": list(self.player),
+            "chunks": {f"{cx},{cy}": chunk for (cx, cy), chunk in sorted(self.chunks.items())}
+        }
+    
+    @classmethod
+    def from_dict(cls, data):
+        level = cls(data["size"][0], data["size"][1], data["tile_size"], data["chunk_size"], data["player"])
+        for key, chunk in data["chunks"].items():
+            cx, cy = key.split(",")
+            level.chunks[(int(cx), int(cy))] = {"tiles": chunk.get("tiles"), "objects": chunk.get("objects", [])}
+        return level
+    
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, separators=(",", ":"))
+    
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+def layout_level(rng, difficulty, pits=True):
+    # Пол с ямами, парящие платформы над ним, монеты и враги. С ростом сложности
+    # уровень длиннее, ямы шире и чаще, врагов больше
+    cols = 64 + 16 * difficulty
+    rows = HEIGHT // TILE_SIZE
+    ground = rows - 2
+    data = LevelData(cols, rows, player=(100, 500))
+    
+    # Первые и последние тайлы без ям: старт и выход всегда на полу
+    holes = set()
+    col = 8
+    while pits and col < cols - 10:
+        col += rng.randint(6, 14)
+        if col < cols - 10 and rng.random() < 0.3 + 0.1 * difficulty:
+            width = rng.randint(2, 2 + min(difficulty, 3))
+            holes.update(range(col, col + width))
+            col += width
+    for col in range(cols):
+        if col not in holes:
+            data.set_tile(col, ground)
+            data.set_tile(col, ground + 1)
+    
+    surfaces = [(col * TILE_SIZE, (col + 1) * TILE_SIZE, ground * TILE_SIZE) for col in range(cols) if col not in holes]
+    col = 8
+    while col < cols - 8:
+        length = rng.randint(3, 7)
+        row = rng.randint(ground - 6, ground - 3)
+        tiers = [row, row - 4] if rng.random() < 0.25 else [row]
+        for tier in tiers:
+            for offset in range(length):
+                data.set_tile(col + offset, tier)
+            surfaces.append((col * TILE_SIZE, (col + length) * TILE_SIZE, tier * TILE_SIZE))
+        col += length + rng.randint(2, 6)
+    
+    for left, right, top in rng.sample(surfaces, min(len(surfaces), 12 + 4 * difficulty)):
+        data.add_object({"type": "coin", "x": (left + right) // 2, "y": top - 40})
+    # Враги не ближе 400 пикселей к старту
+    far = [surface for surface in surfaces if surface[0] >= 400]
+    for _ in range(2 + 2 * difficulty):
+        left, right, top = rng.choice(far)
+        data.add_object({"type": "enemy", "x": rng.randint(left, max(left, right - 50)), "y": top - 80,
+                         "enemy_type": "slime"})
+    return data
+
+def level_reachable(data, floor):
+    # Дойдёт ли игрок от старта (над полом на высоте floor) до выхода: граф навигации
+    # с его скоростью и прыжком. Граф не знает, что игрок управляет полётом
+    # и проходит платформы снизу, поэтому он строже настоящей игры
+    nav = NavGraph(data.all_colliders(), speed=PLAYER_SPEED)
+    start = nav.node_at(data.player[0] + 25, floor)
+    width = data.pixel_size[0]
+    return start >= 0 and any(right > width - 25 and nav.path(start, node) is not None
+                              for node, (_, _, right) in enumerate(nav.nodes))
+
+def generate_level(seed, difficulty):
+    # Уровень целиком определяется зерном и сложностью. Непроходимый вариант
+    # отбрасывается и собирается следующий
+    rng = random.Random(seed)
+    for _ in range(LEVEL_GEN_ATTEMPTS):
+        data = layout_level(rng, difficulty)
+        if level_reachable(data, (data.rows - 2) * data.tile_size):
+            return data
+    return layout_level(rng, difficulty, pits=False)
+
+def load_level_data(number, seed=None, difficulty=0):
+    # Готовый уровень из levels/ или, если задано зерно, сгенерированный
+    if seed is not None:
+        return generate_level(seed, difficulty)
+    try:
+        return LevelData.load(f"levels/level{number}.json")
+    except (OSError, ValueError, KeyError):
+        print(f"Error loading level: {number}")
+        # Пустой уровень: только пол
+        data = LevelData(WIDTH // TILE_SIZE, HEIGHT // TILE_SIZE)
+        data.add_object({"type": "platform", "x": 0, "y": HEIGHT - 50, "w": WIDTH, "h": 50})
+        return data
+
+def prepare_level(number, seed=None, difficulty=0):
+    # Всё, что уровень строит до первого тика: данные и граф навигации врагов
+    data = load_level_data(number, seed, difficulty)
+    return data, NavGraph(data.all_colliders())
+
+class LevelLoader:
+    # Следующий уровень готовится заранее в процессе-помощнике, пока идёт текущий:
+    # генерация и граф навигации - чистый Python, в потоке их тормозил бы GIL.
+    # Процесс запускается через spawn, а не fork: к этому моменту SDL уже поднял свои
+    # потоки (таймер, звук), и копия такого процесса небезопасна. Помощник импортирует
+    # main.py заново, но окно и звук там не открываются - они в init_display()
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._init()
+        return cls._instance
+    
+    def _init(self):
+        self.pending = {}  # (номер, зерно, сложность) -> Future
+        os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")  # без приветствия pygame в помощнике
+        self.pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        self.pool.submit(int)  # помощник запускается и импортирует main.py сразу, а не на первом уровне
+        atexit.register(self.shutdown)
+    
+    def prefetch(self, key):
+        if self.pool is None or key in self.pending:
+            return
+        try:
+            self.pending[key] = self.pool.submit(prepare_level, *key)
+        except RuntimeError as e:  # помощник упал - дальше уровни строятся на месте
+            print(f"Error starting level prefetch: {e}")
+            self.pool = None
     
-    game_state.player_name = name if name else "Player"
-    game_loop(game_state)
+    def take(self, key):
+        # Готовый результат, если он уже посчитан; иначе ждём его или строим сами
+        future = self.pending.pop(key, None)
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                print(f"Error preparing level: {key[0]}")
+        return prepare_level(*key)
+    
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
 
-def game_loop(game_state):
-    asset_manager = AssetManager()
-    asset_manager.play_music(f"level{game_state.current_level}")
+class Level:
+    # Содержимое уровня и один тик его симуляции, без окна и ввода с клавиатуры.
+    # Спрайты существуют только для чанков рядом с игроком: остальные подгружаются
+    # и выгружаются по мере движения
+    def __init__(self, game_state, data=None, nav=None):
+        self.game_state = game_state
+        self.data = data if data is not None else self.build(game_state.current_level)
+        self.width, self.height = self.data.pixel_size
+        self.player = Player(*self.data.player, game_state.player_class)
+        self.platforms = pygame.sprite.Group()
+        self.enemies = pygame.sprite.Group()
+        self.coins = pygame.sprite.Group()
+        self.platform_grid = SpatialHash()
+        self.projectiles = ProjectilePool()
+        self.bounds = pygame.Rect(0, 0, self.width, self.height)
+        self.camera = Camera(self.width, self.height)
+        self.camera.snap(self.player.rect)
+        self.particles = ParticleSystem()
+        self.particles.clear()  # эффекты прошлого уровня
+        # Граф навигации строится по всем платформам уровня сразу, без спрайтов
+        self.nav = nav if nav is not None else NavGraph(self.data.all_colliders())
+        
+        self.loaded = {}  # чанк -> его платформы
+        self.dormant = {}  # чанк -> объекты, ждущие загрузки (состояние врагов сохраняется)
+        self.visited = set()  # чанки, объекты которых уже взяты из файла
+        self.stream_key = None
+        
+        # Большие толпы врагов обновляются векторно
+        self.enemy_engine = None
+        if np is not None and ENEMY_ENGINE_THRESHOLD is not None and self.data.enemy_count() >= ENEMY_ENGINE_THRESHOLD:
+            self.enemy_engine = EnemyEngine([])
+        
+        self.stream()
     
-    # Создание уровня
-    player = Player(100, 300, game_state.player_class)
-    platforms = pygame.sprite.Group()
-    enemies = pygame.sprite.Group()
-    coins = pygame.sprite.Group()
+    def build(self, number):
+        return load_level_data(*self.game_state.level_key(number))
     
-    # Базовый пол
-    platforms.add(Platform(0, HEIGHT - 50, WIDTH, 50))
+    @property
+    def layout_version(self):
+        return self.platform_grid.version
     
-    # Генерация уровня
-    if game_state.current_level == 1:
-        platforms.add(Platform(100, 500, 200, 20))
-        platforms.add(Platform(400, 400, 200, 20))
-        platforms.add(Platform(200, 300, 100, 20))
+    def stream(self):
+        # Подгрузить чанки вокруг игрока и выгрузить дальние. Дёшево, пока игрок в том же чанке
+        step = self.data.chunk_pixels
+        key = (self.player.rect.centerx // step, self.player.rect.centery // step)
+        if key == self.stream_key:
+            return False
+        self.stream_key = key
         
-        coins.add(Coin(200, 450))
-        coins.add(Coin(500, 350))
+        margin_x, margin_y = STREAM_MARGIN
+        area = self.player.rect.inflate(margin_x * 2, margin_y * 2)
+        wanted = self.data.chunk_keys_in(area)
+        for chunk_key in list(self.loaded):
+            if chunk_key not in wanted:
+                self.unload_chunk(chunk_key)
+        for chunk_key in wanted:
+            if chunk_key not in self.loaded:
+                self.load_chunk(chunk_key)
         
-        enemies.add(Enemy(300, 450))
+        # Враги, ушедшие в незагруженные чанки, засыпают там же
+        for enemy in list(self.enemies):
+            enemy_key = (enemy.rect.centerx // step, enemy.rect.centery // step)
+            if enemy_key not in self.loaded and enemy.alive:
+                self.park_enemy(enemy, enemy_key)
+        return True
     
-    elif game_state.current_level == 2:
-        # ... аналогично для других уровней
-        pass
+    def load_platforms(self, key):
+        platforms = []
+        for rect in self.data.colliders(key):
+            platform = Platform(rect.x, rect.y, rect.w, rect.h)
+            self.platforms.add(platform)
+            self.platform_grid.insert(platform)
+            platforms.append(platform)
+        self.loaded[key] = platforms
+    
+    def unload_platforms(self, key):
+        for platform in self.loaded.pop(key):
+            self.platform_grid.remove(platform)
+            platform.kill()
+    
+    def load_chunk(self, key):
+        self.load_platforms(key)
+        
+        # Объекты из файла берутся один раз, дальше чанк живёт своим сохранённым состоянием
+        objects = self.dormant.pop(key, [])
+        if key not in self.visited:
+            self.visited.add(key)
+            objects += self.data.objects(key)
+        for obj in objects:
+            if obj["type"] == "coin":
+                self.coins.add(Coin(obj["x"], obj["y"]))
+            elif obj["type"] == "enemy":
+                enemy = Enemy(obj["x"], obj["y"], obj.get("enemy_type", "slime"))
+                enemy.health = obj.get("health", enemy.health)
+                enemy.direction = obj.get("direction", enemy.direction)
+                self.enemies.add(enemy)
+                if self.enemy_engine is not None:
+                    self.enemy_engine.add(enemy)
+    
+    def unload_chunk(self, key):
+        self.unload_platforms(key)
+        
+        step = self.data.chunk_pixels
+        dormant = self.dormant.setdefault(key, [])
+        for coin in list(self.coins):
+            if (coin.rect.centerx // step, coin.rect.centery // step) == key:
+                dormant.append({"type": "coin", "x": coin.rect.centerx, "y": coin.rect.centery})
+                coin.kill()
+        for enemy in list(self.enemies):
+            if (enemy.rect.centerx // step, enemy.rect.centery // step) == key:
+                if enemy.alive:
+                    self.park_enemy(enemy, key)
+                else:
+                    enemy.kill()
+    
+    def park_enemy(self, enemy, key):
+        enemy.kill()  # движок сначала запишет состояние обратно в спрайт
+        self.dormant.setdefault(key, []).append({
+            "type": "enemy", "x": enemy.rect.x, "y": enemy.rect.y, "enemy_type": enemy.enemy_type,
+            "health": enemy.health, "direction": enemy.direction
+        })
+    
+    def unload(self):
+        # Разорвать ссылки спрайтов на группы, чтобы уровень освободился целиком
+        for group in (self.platforms, self.enemies, self.coins):
+            group.empty()
+        self.projectiles.clear()
+        self.player.kill()
+        self.platform_grid = None
+        self.enemy_engine = None
+        self.loaded = {}
+    
+    def state_hash(self):
+        # Отпечаток всего состояния уровня - для сверки записи и повтора
+        if self.enemy_engine is not None:
+            self.enemy_engine.flush()
+        player = self.player
+        state = [
+            player.rect.topleft, player.velocity.x, player.velocity.y, player.health,
+            player.coins, player.score, player.alive, player.attack_cooldown,
+            sorted((enemy.rect.topleft, enemy.health, enemy.direction, enemy.alive, enemy.velocity.y, enemy.grounded)
+                   for enemy in self.enemies),
+            sorted(coin.rect.center for coin in self.coins),
+            [(projectile.x, projectile.y, projectile.vx, projectile.vy, projectile.ttl) for projectile in self.projectiles],
+            sorted((key, sorted(json.dumps(obj, sort_keys=True) for obj in objects))
+                   for key, objects in self.dormant.items())
+        ]
+        return hashlib.sha256(repr(state).encode()).digest()
+    
+    def snapshot(self):
+        return LevelSnapshot.capture(self)
     
-    all_sprites = pygame.sprite.Group()
-    all_sprites.add(platforms)
-    all_sprites.add(coins)
-    all_sprites.add(enemies)
-    all_sprites.add(player)
-    
-    clock = pygame.time.Clock()
-    running = True
-    
-    while running:
-        # Обработка событий
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == KEYDOWN:
-                if event.key == K_SPACE:
-                    player.jump()
-                if event.key == K_f:
-                    player.attack()
-                if event.key == K_ESCAPE:
-                    return
+    def restore(self, blob):
+        LevelSnapshot.restore(self, blob)
+    
+    def handle_key(self, key):
+        if key == K_SPACE:
+            self.player.jump()
+        if key == K_f:
+            if self.player.attack():
+                self.projectiles.fire_from(self.player)
+    
+    def step(self, keys, timer=NULL_TIMER):
+        # Один тик симуляции. Возвращает "dead", "exit" или None
+        player = self.player
         
         # Управление
-        keys = pygame.key.get_pressed()
         player.velocity.x = 0
         if keys[K_LEFT]:
             player.velocity.x = -PLAYER_SPEED
@@ -619,181 +2917,1303 @@ def game_loop(game_state):
         if keys[K_RIGHT]:
             player.velocity.x = PLAYER_SPEED
             player.facing_right = True
+        timer.mark("input")
         
         # Обновление
-        player.update(platforms, enemies)
-        enemies.update(platforms, player)
+        player.begin_step()
+        player.update(self.platform_grid, self.enemies)
+        timer.mark("player")
+        # Обновляются только враги рядом с экраном; умирающие доигрывают анимацию везде
+        node = self.nav.node_at(player.rect.centerx, player.rect.bottom)
+        if node >= 0:
+            self.nav.set_target(node)
+        area = self.camera.active_area()
+        if self.enemy_engine is None:
+            for enemy in self.enemies:
+                if not enemy.alive or area.colliderect(enemy.rect):
+                    enemy.begin_step()
+                    enemy.update(self.platform_grid, player, self.nav)
+        else:
+            self.enemy_engine.update(self.platform_grid, player, area, self.nav)
+        timer.mark("enemies")
+        
+        for enemy in player.melee(self.enemies, self.enemy_engine):
+            player.add_kill()
+        timer.mark("combat")
+        
+        for enemy in self.projectiles.update(self.platform_grid, self.enemies, self.bounds):
+            player.add_kill()
+        timer.mark("projectiles")
         
         # Коллизия с монетами
-        collected = pygame.sprite.spritecollide(player, coins, True)
+        collected = pygame.sprite.spritecollide(player, self.coins, True)
         for coin in collected:
             player.add_coin()
+            self.particles.emit("coin", *coin.rect.center)
+        timer.mark("coins")
         
-        # Отрисовка
-        screen.fill(BLACK)
-        all_sprites.draw(screen)
-        
-        # UI
-        health_text = font_medium.render(f"HP: {player.health}", True, WHITE)
-        coin_text = font_medium.render(f"Монеты: {player.coins}", True, YELLOW)
-        score_text = font_medium.render(f"Счёт: {player.score}", True, WHITE)
-        level_text = font_medium.render(f"Уровень: {game_state.current_level}", True, WHITE)
-        
-        screen.blit(health_text, (10, 10))
-        screen.blit(coin_text, (10, 50))
-        screen.blit(score_text, (10, 90))
-        screen.blit(level_text, (WIDTH - level_text.get_width() - 10, 10))
-        
-        pygame.display.flip()
-        clock.tick(FPS)
+        self.particles.update()
+        timer.mark("particles")
         
         # Проверка условий уровня
         if not player.alive:
-            game_over_screen(game_state, player.score)
-            return
+            return "dead"
         
-        if player.rect.y > HEIGHT:  # Упал за экран
+        if player.rect.y > self.height:  # Упал за экран
             player.take_damage(10)
             player.rect.y = 100
+            player.begin_step()
+            self.camera.snap(player.rect)
+        
+        self.camera.follow(player.rect)
+        self.stream()
         
         # Переход на следующий уровень
-        if player.rect.x > WIDTH - 50:
-            if game_state.next_level():
-                game_loop(game_state)
+        if player.rect.x > self.width - 50:
+            return "exit"
+        return None
+
+class LevelSnapshot:
+    # Полное состояние идущего уровня в компактном двоичном виде (struct/array):
+    # GameState, random, камера, цель навигации врагов, подгруженные и спящие чанки,
+    # игрок, враги (с кулдаунами и курсорами анимаций), монеты и снаряды. Восстанавливается в тот же
+    # уровень или в заново созданный по тем же данным - без сборки уровня: спрайты
+    # переиспользуются, новые создаются только недостающие
+    MAGIC = b"SNP2"
+    # Метка, уровень, зерно генерации, класс, имя, есть ли gauss_next у random, gauss_next
+    HEADER = struct.Struct("<4sHI16s64s?d")
+    CAMERA = struct.Struct("<iiii")  # view.topleft, prev_position
+    # Узел, к которому ведут маршруты врагов: его меняет только игрок, стоящий на узле,
+    # так что после отката в прыжке враги иначе шли бы к цели из "будущего"
+    NAV = struct.Struct("<i")
+    # Позиция, прошлая позиция, скорость, HP, жив, кулдаун, прыжок, атака, монеты, счёт,
+    # взгляд вправо, анимация, кадр, доиграна, сколько врагов уже получили текущий удар
+    PLAYER = struct.Struct("<iiiiddi?d??ii?Bd?H")
+    # Позиция, прошлая позиция, скорость, направление, HP, жив, кулдаун, на опоре,
+    # взгляд вправо, анимация, кадр, доиграна, тип
+    ENEMY = struct.Struct("<iiiiddbi?d??Bd?B")
+    # Вид, x, y, vx, vy, гравитация, время жизни, урон, прошлая позиция
+    PROJECTILE = struct.Struct("<Bddddddiii")
+    # Монета (0) или враг (1), какие необязательные поля есть (тип врага, HP, направление),
+    # x, y, HP, направление, тип врага
+    DORMANT = struct.Struct("<BBiiibB")
+    DORMANT_KEYS = {"type", "x", "y", "enemy_type", "health", "direction"}
+    COUNT = struct.Struct("<I")
+    CHUNK = struct.Struct("<iiI")  # ключ чанка и число его объектов
+    
+    @staticmethod
+    def _animation_index(entity):
+        for index, animation in enumerate(entity.animations.values()):
+            if animation is entity.current_animation:
+                return index
+        return 0
+    
+    @classmethod
+    def capture(cls, level):
+        if level.enemy_engine is not None:
+            level.enemy_engine.flush()
+        game_state = level.game_state
+        player = level.player
+        enemies = list(level.enemies)
+        enemy_index = {enemy: i for i, enemy in enumerate(enemies)}
+        types = sorted({enemy.enemy_type for enemy in enemies}
+                       | {obj["enemy_type"] for objects in level.dormant.values()
+                          for obj in objects if "enemy_type" in obj})
+        type_index = {name: i for i, name in enumerate(types)}
+        _, random_state, gauss_next = random.getstate()
+        
+        parts = [cls.HEADER.pack(cls.MAGIC, game_state.current_level, game_state.world_seed,
+                                 game_state.player_class.encode(), game_state.player_name.encode()[:64],
+                                 gauss_next is not None, gauss_next or 0.0),
+                 cls.COUNT.pack(len(random_state)) + array.array("I", random_state).tobytes()]
+        names = "\0".join(types).encode()
+        parts.append(cls.COUNT.pack(len(names)) + names)
+        
+        camera = level.camera
+        parts.append(cls.CAMERA.pack(*camera.view.topleft, *camera.prev_position))
+        stream_key = level.stream_key or (0, 0)
+        parts.append(struct.pack("<?ii", level.stream_key is not None, *stream_key))
+        parts.append(cls.NAV.pack(level.nav.target))
+        for keys in (level.loaded, level.visited):
+            flat = array.array("i", [value for key in keys for value in key])
+            parts.append(cls.COUNT.pack(len(keys)) + flat.tobytes())
+        parts.append(cls.COUNT.pack(len(level.dormant)))
+        for key, objects in level.dormant.items():
+            parts.append(cls.CHUNK.pack(*key, len(objects)))
+            for obj in objects:
+                if not obj.keys() <= cls.DORMANT_KEYS:
+                    raise ValueError(f"unsupported object in snapshot: {obj}")
+                flags = ("enemy_type" in obj) | ("health" in obj) << 1 | ("direction" in obj) << 2
+                parts.append(cls.DORMANT.pack(obj["type"] == "enemy", flags, obj["x"], obj["y"],
+                                              obj.get("health", 0), obj.get("direction", 0),
+                                              type_index.get(obj.get("enemy_type"), 0)))
+        
+        struck = [enemy_index[enemy] for enemy in player.struck if enemy in enemy_index]
+        parts.append(cls.PLAYER.pack(
+            *player.rect.topleft, *player.prev_position, player.velocity.x, player.velocity.y,
+            player.health, player.alive, player.attack_cooldown, player.jumping, player.attacking,
+            player.coins, player.score, player.facing_right, cls._animation_index(player),
+            player.current_animation.current_frame, player.current_animation.done, len(struck)))
+        parts.append(array.array("I", struck).tobytes())
+        
+        parts.append(cls.COUNT.pack(len(enemies)))
+        for enemy in enemies:
+            parts.append(cls.ENEMY.pack(
+                *enemy.rect.topleft, *enemy.prev_position, enemy.velocity.x, enemy.velocity.y,
+                enemy.direction, enemy.health, enemy.alive, enemy.attack_cooldown, enemy.grounded,
+                enemy.facing_right, cls._animation_index(enemy), enemy.current_animation.current_frame,
+                enemy.current_animation.done, type_index[enemy.enemy_type]))
+        
+        coins = array.array("i", [value for coin in level.coins for value in coin.rect.center])
+        parts.append(cls.COUNT.pack(len(level.coins)) + coins.tobytes())
+        
+        pool = level.projectiles
+        kind_index = {id(image): i for i, image in enumerate(pool.images.values())}
+        parts.append(cls.COUNT.pack(len(pool.active)))
+        for projectile in pool.active:
+            parts.append(cls.PROJECTILE.pack(
+                kind_index[id(projectile.image)], projectile.x, projectile.y, projectile.vx, projectile.vy,
+                projectile.gravity, projectile.ttl, projectile.damage, *projectile.prev_position))
+        return b"".join(parts)
+    
+    @classmethod
+    def restore(cls, level, blob):
+        view = memoryview(blob)
+        magic, number, world_seed, player_class, player_name, has_gauss, gauss_next = cls.HEADER.unpack_from(view)
+        if magic != cls.MAGIC:
+            raise ValueError("not a level snapshot")
+        game_state = level.game_state
+        if number != game_state.current_level or (number > HANDMADE_LEVELS and world_seed != game_state.world_seed):
+            raise ValueError(f"snapshot of another level: {number}")
+        # Выбор игрока снимок не переписывает: чужой персонаж - ошибка, как и чужой уровень
+        player_class = player_class.rstrip(b"\0").decode()
+        if player_class != game_state.player_class:
+            raise ValueError(f"snapshot of another character: {player_class}")
+        pos = cls.HEADER.size
+        
+        def read_array(typecode, count):
+            nonlocal pos
+            values = array.array(typecode)
+            end = pos + count * values.itemsize
+            values.frombytes(view[pos:end])
+            pos = end
+            return values
+        
+        def read_count():
+            nonlocal pos
+            (count,) = cls.COUNT.unpack_from(view, pos)
+            pos += cls.COUNT.size
+            return count
+        
+        def read_records(record):
+            nonlocal pos
+            count = read_count()
+            end = pos + count * record.size
+            records = record.iter_unpack(view[pos:end])
+            pos = end
+            return records
+        
+        random_state = read_array("I", read_count())
+        random.setstate((3, tuple(random_state), gauss_next if has_gauss else None))
+        names_size = read_count()
+        types = bytes(view[pos:pos + names_size]).decode().split("\0")
+        pos += names_size
+        
+        camera = level.camera
+        x, y, prev_x, prev_y = cls.CAMERA.unpack_from(view, pos)
+        pos += cls.CAMERA.size
+        camera.view.topleft = (x, y)
+        camera.prev_position = (prev_x, prev_y)
+        has_key, key_x, key_y = struct.unpack_from("<?ii", view, pos)
+        pos += struct.calcsize("<?ii")
+        level.stream_key = (key_x, key_y) if has_key else None
+        level.nav.set_target(cls.NAV.unpack_from(view, pos)[0])
+        pos += cls.NAV.size
+        flat = read_array("i", read_count() * 2)
+        loaded = list(zip(flat[::2], flat[1::2]))
+        if list(level.loaded) != loaded:
+            # Платформы - заново в том же порядке, что и были: от него зависит порядок в сетке
+            for key in list(level.loaded):
+                level.unload_platforms(key)
+            for key in loaded:
+                level.load_platforms(key)
+        flat = read_array("i", read_count() * 2)
+        level.visited = set(zip(flat[::2], flat[1::2]))
+        level.dormant = {}
+        for _ in range(read_count()):
+            key_x, key_y, count = cls.CHUNK.unpack_from(view, pos)
+            pos += cls.CHUNK.size
+            objects = level.dormant[(key_x, key_y)] = []
+            for _ in range(count):
+                enemy, flags, x, y, health, direction, type_id = cls.DORMANT.unpack_from(view, pos)
+                pos += cls.DORMANT.size
+                obj = {"type": "enemy" if enemy else "coin", "x": x, "y": y}
+                if flags & 1:
+                    obj["enemy_type"] = types[type_id]
+                if flags & 2:
+                    obj["health"] = health
+                if flags & 4:
+                    obj["direction"] = direction
+                objects.append(obj)
+        
+        player = level.player
+        (x, y, prev_x, prev_y, vx, vy, player.health, player.alive, player.attack_cooldown, player.jumping,
+         player.attacking, player.coins, player.score, facing, anim, frame, done, struck) = cls.PLAYER.unpack_from(view, pos)
+        pos += cls.PLAYER.size
+        struck = read_array("I", struck)
+        if player.char_type != game_state.player_class:
+            player.char_type = game_state.player_class
+            player.load_animations()
+        cls._restore_entity(player, x, y, prev_x, prev_y, vx, vy, facing, anim, frame, done)
+        
+        # Враги: существующие спрайты переиспользуются, недостающие создаются
+        spare = list(level.enemies)
+        for enemy in spare:
+            enemy.engine = None  # движок собирается заново, состояние из него не нужно
+            enemy.engine_index = -1
+            pygame.sprite.Sprite.kill(enemy)
+        engine = level.enemy_engine = EnemyEngine([]) if level.enemy_engine is not None else None
+        enemies = []
+        for (x, y, prev_x, prev_y, vx, vy, direction, health, alive, cooldown, grounded,
+             facing, anim, frame, done, type_id) in read_records(cls.ENEMY):
+            enemy_type = types[type_id]
+            if spare:
+                enemy = spare.pop()
+                if enemy.enemy_type != enemy_type:
+                    enemy.enemy_type = enemy_type
+                    enemy.load_animations()
+            else:
+                enemy = Enemy(x, y, enemy_type)
+            enemy.direction = direction
+            enemy.health = health
+            enemy.alive = alive
+            enemy.attack_cooldown = cooldown
+            enemy.grounded = grounded
+            cls._restore_entity(enemy, x, y, prev_x, prev_y, vx, vy, facing, anim, frame, done)
+            level.enemies.add(enemy)
+            if engine is not None:
+                engine.add(enemy)
+            enemies.append(enemy)
+        player.struck.clear()
+        player.struck.update(enemies[i] for i in struck)
+        
+        spare = list(level.coins)
+        for coin in spare:
+            coin.kill()
+        flat = read_array("i", read_count() * 2)
+        for i in range(0, len(flat), 2):
+            coin = spare.pop() if spare else Coin(flat[i], flat[i + 1])
+            coin.rect.center = (flat[i], flat[i + 1])
+            level.coins.add(coin)
+        
+        pool = level.projectiles
+        pool.clear()
+        kinds = list(PROJECTILES)
+        for kind, x, y, vx, vy, gravity, ttl, damage, prev_x, prev_y in read_records(cls.PROJECTILE):
+            projectile = pool.free.pop()
+            projectile.image = pool.images[kinds[kind]]
+            projectile.rect.size = PROJECTILES[kinds[kind]]["size"]
+            projectile.rect.center = (int(x), int(y))
+            projectile.x, projectile.y, projectile.vx, projectile.vy = x, y, vx, vy
+            projectile.gravity, projectile.ttl, projectile.damage = gravity, ttl, damage
+            projectile.prev_position = (prev_x, prev_y)
+            pool.active.append(projectile)
+        
+        level.particles.clear()
+    
+    @staticmethod
+    def _restore_entity(entity, x, y, prev_x, prev_y, vx, vy, facing, anim, frame, done):
+        entity.rect.topleft = (x, y)
+        entity.prev_position = (prev_x, prev_y)
+        entity.velocity.update(vx, vy)
+        entity.facing_right = facing
+        animation = list(entity.animations.values())[anim]
+        animation.current_frame = frame
+        animation.done = done
+        entity.current_animation = animation
+        entity.image = animation.get_current_frame(facing)
+
+class HighscoreStore:
+    # Таблицы рекордов: общая, по классу ("class:mage") и по уровню ("level:2").
+    # В памяти у каждой таблицы куча из HIGHSCORE_TOP лучших, добавление - O(log N).
+    # На диск пишет фоновый поток: строка в журнал, а время от времени - сжатие
+    # журнала в снимок через временный файл и os.replace, так что сбой посреди
+    # записи не теряет старые рекорды. Снимок хранит все результаты, а не только
+    # попавшие в таблицы: по нему можно собрать и таблицу, которой раньше не было
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._init()
+        return cls._instance
+    
+    def _init(self):
+        self.boards = {}  # таблица -> куча (счёт, -id, запись), наверху худший
+        self.sorted_boards = {}  # таблица -> записи от лучшей к худшей
+        self.history = []  # все результаты по порядку id - для снимка
+        self.last_id = 0
+        self.torn = False  # журнал кончается оборванной строкой
+        self.lock = threading.Lock()
+        self.write_queue = queue.Queue()
+        self.log_lines = 0
+        self._load()
+        threading.Thread(target=self._writer, daemon=True).start()
+        atexit.register(self.flush)
+    
+    @staticmethod
+    def board_names(entry):
+        return ("all", f"class:{entry['class']}", f"level:{entry['level']}")
+    
+    def _push(self, entry):
+        # Вызывать под self.lock
+        # При равном счёте выше тот, кто поставил рекорд раньше
+        item = (entry["score"], -entry["id"], entry)
+        self.history.append(entry)
+        for name in self.board_names(entry):
+            heap = self.boards.setdefault(name, [])
+            if len(heap) < HIGHSCORE_TOP:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
             else:
-                victory_screen(game_state, player.score)
+                continue
+            self.sorted_boards.pop(name, None)
+        self.last_id = max(self.last_id, entry["id"])
+    
+    def _load(self):
+        snapshot_id = 0
+        try:
+            with open(HIGHSCORE_FILE, "r") as f:
+                data = json.load(f)
+            if isinstance(data, list):  # старый формат - просто топ-10
+                data = {"last_id": 0, "entries": data}
+            snapshot_id = data["last_id"]
+            self.last_id = snapshot_id
+            for entry in data["entries"]:
+                if "id" not in entry:
+                    entry = dict(entry, id=self.last_id + 1)
+                self._push(entry)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        
+        # Журнал: записи новее снимка. Оборванная последняя строка - след сбоя, пропускаем
+        try:
+            with open(HIGHSCORE_LOG, "r") as f:
+                for line in f:
+                    self.log_lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        self.torn = True
+                        continue
+                    if entry.get("id", 0) > snapshot_id:
+                        self._push(entry)
+        except OSError:
+            pass
+        if self.torn:
+            # Иначе следующая запись приклеится к оборванной строке. Сжимает фоновый
+            # поток: недоступный для записи каталог не должен ронять игру на старте
+            self.write_queue.put(None)
+    
+    def add(self, name, char_class, score, level):
+        with self.lock:
+            entry = {"id": self.last_id + 1, "name": name, "class": char_class, "score": score, "level": level}
+            self._push(entry)
+        self.write_queue.put(entry)
+        return entry
+    
+    def top(self, board="all"):
+        with self.lock:
+            entries = self.sorted_boards.get(board)
+            if entries is None:
+                entries = [item[2] for item in sorted(self.boards.get(board, []), reverse=True)]
+                self.sorted_boards[board] = entries
+            return entries
+    
+    def flush(self):
+        # Дождаться, пока фоновый поток допишет всё поставленное в очередь
+        self.write_queue.join()
+    
+    def _writer(self):
+        while True:
+            entry = self.write_queue.get()
+            try:
+                if entry is None:
+                    self._compact()
+                    continue
+                with open(HIGHSCORE_LOG, "a") as f:
+                    # Сжать оборванный журнал не вышло - запись хотя бы начнётся с новой строки
+                    f.write(("\n" if self.torn else "") + json.dumps(entry, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.torn = False
+                self.log_lines += 1
+                if self.log_lines >= HIGHSCORE_COMPACT_EVERY:
+                    self._compact()
+            except OSError as e:
+                print(f"Error saving highscore: {e}")
+            finally:
+                self.write_queue.task_done()
+    
+    def _compact(self):
+        with self.lock:
+            data = {"version": 1, "last_id": self.last_id, "entries": list(self.history)}
+        tmp_path = HIGHSCORE_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, HIGHSCORE_FILE)
+        # Сбой здесь безопасен: записи журнала не новее last_id снимка и при загрузке пропустятся
+        with open(HIGHSCORE_LOG, "w"):
+            pass
+        self.log_lines = 0
+        self.torn = False
+
+class Replay:
+    # Запись ввода одного уровня: на каждый тик - маска зажатых REPLAY_KEYS
+    # и клавиши, нажатые (KEYDOWN) перед этим тиком. Вместе с зерном random,
+    # номером уровня, зерном генерации, классом и SIM_RATE этого хватает,
+    # чтобы повторить симуляцию тик в тик и сверить итоговый отпечаток состояния
+    MAGIC = b"RPL2"
+    # Метка, зерно, зерно генерации, SIM_RATE, уровень, класс, CRC данных уровня, тиков, отпечаток
+    HEADER = struct.Struct("<4sIIHB16sII32s")
+    
+    def __init__(self, seed, level, player_class, sim_rate=None, level_crc=0, world_seed=0):
+        self.seed = seed
+        self.world_seed = world_seed
+        self.level = level
+        self.player_class = player_class
+        self.sim_rate = SIM_RATE if sim_rate is None else sim_rate  # текущая, если не задана
+        self.level_crc = level_crc
+        self.ticks = 0
+        self.data = bytearray()  # маска, число нажатий, индексы нажатых клавиш
+        self.final_hash = bytes(32)
+    
+    @staticmethod
+    def level_checksum(level_data):
+        return zlib.crc32(json.dumps(level_data.to_dict(), sort_keys=True).encode())
+    
+    def record(self, keys, events):
+        mask = 0
+        for bit, key in enumerate(REPLAY_KEYS):
+            if keys[key]:
+                mask |= 1 << bit
+        events = [REPLAY_KEYS.index(key) for key in events if key in REPLAY_KEYS]
+        self.data.append(mask)
+        self.data.append(len(events))
+        self.data.extend(events)
+        self.ticks += 1
+    
+    def __iter__(self):
+        # (состояние клавиш, нажатия) по тикам - в том же виде, что даёт живой ввод
+        data = self.data
+        pos = 0
+        for _ in range(self.ticks):
+            mask, count = data[pos], data[pos + 1]
+            keys = defaultdict(bool)
+            for bit, key in enumerate(REPLAY_KEYS):
+                keys[key] = bool(mask >> bit & 1)
+            events = [REPLAY_KEYS[index] for index in data[pos + 2:pos + 2 + count]]
+            pos += 2 + count
+            yield keys, events
+    
+    def save(self, path):
+        header = self.HEADER.pack(self.MAGIC, self.seed, self.world_seed, self.sim_rate, self.level,
+                                  self.player_class.encode(), self.level_crc, self.ticks, self.final_hash)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(zlib.compress(bytes(self.data), 9))
+        os.replace(tmp_path, path)
+    
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            blob = f.read()
+        magic, seed, world_seed, sim_rate, level, player_class, level_crc, ticks, final_hash = cls.HEADER.unpack_from(blob)
+        if magic != cls.MAGIC:
+            raise ValueError(f"not a replay: {path}")
+        replay = cls(seed, level, player_class.rstrip(b"\0").decode(), sim_rate, level_crc, world_seed)
+        replay.ticks = ticks
+        replay.data = bytearray(zlib.decompress(blob[cls.HEADER.size:]))
+        replay.final_hash = final_hash
+        return replay
+    
+    def start_level(self, game_state):
+        # Состояние на начало записи: частота симуляции, зерна, уровень и класс
+        set_sim_rate(self.sim_rate)
+        random.seed(self.seed)
+        game_state.world_seed = self.world_seed
+        game_state.current_level = self.level
+        game_state.player_class = self.player_class
+        level = Level(game_state)
+        if self.level_crc and self.level_checksum(level.data) != self.level_crc:
+            print(f"Warning: level {self.level} differs from the recorded one")
+        return level
+
+def run_replay(replay, timer=NULL_TIMER):
+    # Повтор без окна и без ограничения скорости. Возвращает (отпечаток, тиков)
+    level = replay.start_level(GameState())
+    ticks = 0
+    for keys, events in replay:
+        timer.begin()
+        for key in events:
+            level.handle_key(key)
+        ticks += 1
+        if level.step(keys, timer) is not None:
+            break
+    return level.state_hash(), ticks
+
+class GameState:
+    def __init__(self):
+        self.current_level = 1
+        self.max_level = HANDMADE_LEVELS + GENERATED_LEVELS
+        self.world_seed = random.SystemRandom().randrange(1 << 32)  # зерно генерируемых уровней этой игры
+        self.player_name = "Player"
+        self.player_class = "warrior"
+        self.highscore_store = HighscoreStore()
+        # (уровень 1, его снимок на старте, зерно random) - "Заново" откатывает его, а не строит.
+        # Живёт, пока идёт эта игра: выход в меню или выбор персонажа его освобождает
+        self.checkpoint = None
+    
+    @property
+    def highscores(self):
+        return self.highscore_store.top()
+    
+    def save_highscore(self, score):
+        # Запись на диск идёт в фоне - экран победы не ждёт
+        self.highscore_store.add(self.player_name, self.player_class, score, self.current_level)
+    
+    def level_key(self, number=None):
+        # (номер, зерно, сложность) - всё, от чего зависят данные уровня
+        number = self.current_level if number is None else number
+        if number <= HANDMADE_LEVELS:
+            return number, None, 0
+        return number, zlib.crc32(struct.pack("<II", self.world_seed, number)), number - HANDMADE_LEVELS
+    
+    def drop_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint[0].unload()
+            self.checkpoint = None
+    
+    def next_level(self):
+        if self.current_level < self.max_level:
+            self.current_level += 1
+            return True
+        return False
+
+class Widget:
+    # Элемент экрана меню, который живёт между кадрами. Рисуется заново, только
+    # когда помечен invalidate(): UIScene закрашивает его старое и новое место
+    # и обновляет на дисплее лишь эти прямоугольники
+    def __init__(self, rect):
+        self.rect = pygame.Rect(rect)
+        self.dirty = True
+        self.drawn_rect = None  # где виджет нарисован сейчас
+    
+    def invalidate(self):
+        self.dirty = True
+    
+    def draw(self, surface):
+        pass
+
+class Label(Widget):
+    # Строка текста: x - её центр (align="center") или левый край (align="left")
+    def __init__(self, x, y, text, font, color=WHITE, align="center"):
+        super().__init__((x, y, 0, 0))
+        self.x = x
+        self.y = y
+        self.font = font
+        self.color = color
+        self.align = align
+        self.text = None
+        self.set_text(text)
+    
+    def set_text(self, text):
+        if text == self.text:
             return
+        self.text = text
+        self.image = render_text(self.font, text, self.color)
+        width, height = self.image.get_size()
+        left = self.x - width // 2 if self.align == "center" else self.x
+        self.rect = pygame.Rect(left, self.y, width, height)
+        self.invalidate()
+    
+    def draw(self, surface):
+        surface.blit(self.image, self.rect)
 
-def game_over_screen(game_state, score):
-    asset_manager = AssetManager()
-    asset_manager.play_music("menu")
+class Button(Widget):
+    def __init__(self, x, y, width, height, text, color, hover_color):
+        super().__init__((x, y, width, height))
+        self.text = text
+        self.color = color
+        self.hover_color = hover_color
+        self.is_hovered = False
     
-    title = font_large.render("Игра окончена", True, RED)
-    score_text = font_medium.render(f"Ваш счёт: {score}", True, WHITE)
+    def set_text(self, text):
+        if text != self.text:
+            self.text = text
+            self.invalidate()
     
-    buttons = [
-        Button(WIDTH//2 - 100, HEIGHT//2 + 50, 200, 50, "Заново", BLUE, (0, 100, 255)),
-        Button(WIDTH//2 - 100, HEIGHT//2 + 120, 200, 50, "В меню", GREEN, (0, 200, 100))
-    ]
+    def draw(self, surface):
+        color = self.hover_color if self.is_hovered else self.color
+        pygame.draw.rect(surface, color, self.rect, border_radius=10)
+        pygame.draw.rect(surface, WHITE, self.rect, 2, border_radius=10)
+        
+        text_surf = render_text(font_medium, self.text, WHITE)
+        text_rect = text_surf.get_rect(center=self.rect.center)
+        surface.blit(text_surf, text_rect)
     
-    running = True
-    while running:
-        mouse_pos = pygame.mouse.get_pos()
-        mouse_click = False
-        
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == MOUSEBUTTONDOWN:
-                if event.button == 1:
-                    mouse_click = True
-        
-        screen.fill(BLACK)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
-        screen.blit(score_text, (WIDTH//2 - score_text.get_width()//2, 200))
-        
-        for button in buttons:
-            button.check_hover(mouse_pos)
-            button.draw(screen)
-            
-            if button.is_clicked(mouse_pos, mouse_click):
-                if button.text == "Заново":
-                    game_state.current_level = 1
-                    game_loop(game_state)
-                else:
-                    main_menu()
+    def check_hover(self, pos):
+        hovered = bool(self.rect.collidepoint(pos))
+        if hovered != self.is_hovered:
+            self.is_hovered = hovered
+            self.invalidate()
+        return hovered
+    
+    def is_clicked(self, pos, click):
+        return self.rect.collidepoint(pos) and click
+
+class Scene:
+    # Экран игры. SceneManager вызывает on_enter при попадании в стек
+    # и on_exit при снятии с него - там сцена освобождает свои ресурсы
+    def __init__(self, manager):
+        self.manager = manager
+    
+    def on_enter(self):
+        pass
+    
+    def on_exit(self):
+        pass
+    
+    def handle_event(self, event):
+        pass
+    
+    def update(self):
+        pass
+    
+    def draw(self, surface):
+        pass
+    
+    def invalidate(self):
+        # Экран испорчен чем-то поверх сцены - следующий кадр рисуется целиком
+        pass
+    
+    def idle(self):
+        # True - кадру нечего делать, пока не придёт событие
+        return False
+
+class UIScene(Scene):
+    # Экран из виджетов в retained mode: виджеты создаются один раз, кадр
+    # перерисовывает только помеченные invalidate(), а когда помеченных нет,
+    # ничего не рисует, и SceneManager ждёт событий вместо холостых кадров
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.widgets = []
+        self.full_redraw = True
+    
+    def elements(self):
+        return self.widgets
+    
+    def invalidate(self):
+        self.full_redraw = True
+    
+    def idle(self):
+        return not self.full_redraw and not any(widget.dirty for widget in self.elements())
+    
+    def draw(self, surface):
+        widgets = self.elements()
+        if self.full_redraw:
+            self.full_redraw = False
+            surface.fill(BLACK)
+            for widget in widgets:
+                widget.draw(surface)
+            pygame.display.flip()
+            damaged = None
+        else:
+            damaged = [widget.rect.union(widget.drawn_rect) if widget.drawn_rect else widget.rect
+                       for widget in widgets if widget.dirty]
+            if not damaged:
                 return
-        
-        pygame.display.flip()
-        pygame.time.Clock().tick(FPS)
+            # Закрасить испорченное место и нарисовать всё, что в него попадает
+            for area in damaged:
+                surface.set_clip(area)
+                surface.fill(BLACK)
+                for widget in widgets:
+                    if widget.rect.colliderect(area):
+                        widget.draw(surface)
+            surface.set_clip(None)
+            pygame.display.update(damaged)
+        for widget in widgets:
+            widget.dirty = False
+            widget.drawn_rect = widget.rect.copy()
 
-def victory_screen(game_state, score):
-    asset_manager = AssetManager()
-    asset_manager.play_music("menu")
-    asset_manager.get_sound("victory").play()
+class SceneManager:
+    # Стек сцен и единственный главный цикл вместо рекурсивных вызовов экранов
+    def __init__(self, profiler=None, record_dir=None):
+        self.stack = []
+        self.profiler = profiler if profiler is not None else FrameProfiler()
+        self.record_dir = record_dir  # писать ли записи уровней (Replay) и куда
+        self.exit_code = 0
+        self.clock = pygame.time.Clock()
+        self.running = False
+        self.memory_log = []  # заполняется, если включён tracemalloc (PYTHONTRACEMALLOC=1)
     
-    game_state.save_highscore(score)
+    @property
+    def top(self):
+        return self.stack[-1] if self.stack else None
     
-    title = font_large.render("Победа!", True, GREEN)
-    score_text = font_medium.render(f"Финальный счёт: {score}", True, WHITE)
+    def push(self, scene):
+        if tracemalloc.is_tracing():
+            scene.memory_at_enter = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.stack.append(scene)
+        scene.on_enter()
     
-    buttons = [
-        Button(WIDTH//2 - 100, HEIGHT//2 + 50, 200, 50, "Заново", BLUE, (0, 100, 255)),
-        Button(WIDTH//2 - 100, HEIGHT//2 + 120, 200, 50, "В меню", GREEN, (0, 200, 100))
-    ]
+    def pop(self):
+        scene = self._remove_top()
+        if not self.stack:
+            self.quit()
+        else:
+            self.top.invalidate()  # открывшаяся сцена рисуется поверх снятой целиком
+        return scene
     
-    running = True
-    while running:
-        mouse_pos = pygame.mouse.get_pos()
-        mouse_click = False
-        
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == MOUSEBUTTONDOWN:
-                if event.button == 1:
-                    mouse_click = True
-        
-        screen.fill(BLACK)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
-        screen.blit(score_text, (WIDTH//2 - score_text.get_width()//2, 200))
-        
-        for button in buttons:
-            button.check_hover(mouse_pos)
-            button.draw(screen)
+    def replace(self, scene):
+        self._remove_top()
+        self.push(scene)
+    
+    def reset(self, scene):
+        while self.stack:
+            self._remove_top()
+        self.push(scene)
+    
+    def _remove_top(self):
+        scene = self.stack.pop()
+        peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+        scene.on_exit()
+        if tracemalloc.is_tracing():
+            self._log_memory(scene, peak)
+        return scene
+    
+    def _log_memory(self, scene, peak):
+        gc.collect()
+        current = tracemalloc.get_traced_memory()[0]
+        # peak - прирост над уровнем входа в сцену, retained - что осталось после её снятия
+        record = {
+            "scene": type(scene).__name__,
+            "at_enter": scene.memory_at_enter,
+            "peak": peak - scene.memory_at_enter,
+            "retained": current - scene.memory_at_enter
+        }
+        self.memory_log.append(record)
+        print(f"Scene {record['scene']}: peak {record['peak'] // 1024:+d} KB, retained {record['retained'] // 1024:+d} KB")
+    
+    def quit(self):
+        self.running = False
+    
+    def run(self, scene):
+        self.running = True
+        self.push(scene)
+        profiler = self.profiler
+        while self.running:
+            profiler.begin_frame()
+            scene = self.top
+            events = pygame.event.get()
+            if not events and scene.idle():
+                # Меню без изменений не крутит кадры, а спит до события (или до таймаута)
+                event = pygame.event.wait(UI_IDLE_TIMEOUT)
+                if event.type != NOEVENT:
+                    events = [event] + pygame.event.get()
+                profiler.mark("idle")
+            for event in events:
+                if event.type == QUIT:
+                    self.quit()
+                    break
+                if event.type == KEYDOWN and event.key == PROFILER_OVERLAY_KEY:
+                    if not profiler.toggle_overlay():
+                        scene.invalidate()
+                    continue
+                if event.type == KEYDOWN and event.key == PROFILER_EXPORT_KEY:
+                    profiler.export_chrome_trace("profile_trace.json")
+                    continue
+                scene.handle_event(event)
+                if self.top is not scene:
+                    break
+            profiler.mark("events")
             
+            if self.running and self.top is scene:
+                scene.update()
+                profiler.mark("update")
+            # Если сцена сменилась, новая нарисует себя в следующем кадре
+            if self.running and self.top is scene:
+                scene.draw(screen)
+                profiler.mark("draw")
+                overlay = profiler.draw_overlay(screen)
+                if overlay is not None:
+                    pygame.display.update(overlay)
+                    profiler.mark("overlay")
+            self.clock.tick(FPS)
+            profiler.mark("wait")
+            profiler.end_frame()
+        
+        while self.stack:
+            self._remove_top()
+        profiler.close()
+        pygame.quit()
+        sys.exit(self.exit_code)
+
+class MenuScene(UIScene):
+    # Экран с кнопками: клик левой кнопкой мыши передаётся в on_click
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.buttons = []
+        self.mouse_click = False
+    
+    def handle_event(self, event):
+        if event.type == MOUSEBUTTONDOWN:
+            if event.button == 1:
+                self.mouse_click = True
+    
+    def update(self):
+        mouse_pos = pygame.mouse.get_pos()
+        mouse_click = self.mouse_click
+        self.mouse_click = False
+        for button in self.buttons:
+            self.on_hover(button, button.check_hover(mouse_pos))
             if button.is_clicked(mouse_pos, mouse_click):
-                if button.text == "Заново":
-                    game_state.current_level = 1
-                    game_loop(game_state)
-                else:
-                    main_menu()
+                self.on_click(button)
                 return
+    
+    def on_hover(self, button, hovered):
+        pass
+    
+    def on_click(self, button):
+        pass
+    
+    def elements(self):
+        return self.widgets + self.buttons
+    
+    def idle(self):
+        return not self.mouse_click and super().idle()
+
+class MainMenuScene(MenuScene):
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.game_state = GameState()
         
-        pygame.display.flip()
-        pygame.time.Clock().tick(FPS)
+        self.widgets = [
+            Label(WIDTH//2, 100, "EPIC PLATFORMER", font_large, PURPLE),
+            Label(WIDTH//2, 200, "Выберите действие:", font_medium)
+        ]
+        
+        self.buttons = [
+            Button(WIDTH//2 - 100, HEIGHT//2 - 50, 200, 50, "Играть", BLUE, (0, 100, 255)),
+            Button(WIDTH//2 - 100, HEIGHT//2 + 20, 200, 50, "Рекорды", GREEN, (0, 200, 100)),
+            Button(WIDTH//2 - 100, HEIGHT//2 + 90, 200, 50, "Выход", RED, (200, 0, 0))
+        ]
+    
+    def on_enter(self):
+        AssetManager().play_music("menu")
+    
+    def on_click(self, button):
+        if button.text == "Играть":
+            self.manager.push(CharacterSelectScene(self.manager, self.game_state))
+        elif button.text == "Рекорды":
+            self.manager.push(HighscoresScene(self.manager, self.game_state))
+        elif button.text == "Выход":
+            self.manager.quit()
 
-def show_highscores(game_state):
-    title = font_large.render("Рекорды", True, WHITE)
+class CharacterSelectScene(MenuScene):
+    CLASSES = [
+        {"name": "Воин", "type": "warrior", "desc": "Сильный и выносливый"},
+        {"name": "Маг", "type": "mage", "desc": "Мощные атаки"},
+        {"name": "Лучник", "type": "archer", "desc": "Быстрый и ловкий"}
+    ]
     
-    back_button = Button(50, HEIGHT - 70, 150, 50, "Назад", RED, (200, 0, 0))
+    def __init__(self, manager, game_state):
+        super().__init__(manager)
+        self.game_state = game_state
+        self.widgets = [Label(WIDTH//2, 50, "Выберите персонажа", font_large)]
+        
+        self.class_buttons = {}
+        for i, cls in enumerate(self.CLASSES):
+            button = Button(
+                WIDTH//2 - 150, 
+                200 + i*120, 
+                300, 
+                100, 
+                cls["name"], 
+                (50, 50, 150), 
+                (100, 100, 255)
+            )
+            self.class_buttons[button] = cls
+            self.widgets.append(Label(WIDTH//2, button.rect.bottom + 5, cls["desc"], font_small))
+        
+        self.back_button = Button(50, HEIGHT - 70, 150, 50, "Назад", RED, (200, 0, 0))
+        self.buttons = list(self.class_buttons) + [self.back_button]
+        self.prefetched = set()
     
-    running = True
-    while running:
-        mouse_pos = pygame.mouse.get_pos()
-        mouse_click = False
-        
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == MOUSEBUTTONDOWN:
-                if event.button == 1:
-                    mouse_click = True
-        
-        screen.fill(BLACK)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 50))
-        
-        if not game_state.highscores:
-            no_scores = font_medium.render("Рекордов пока нет!", True, WHITE)
-            screen.blit(no_scores, (WIDTH//2 - no_scores.get_width()//2, 200))
+    def on_hover(self, button, hovered):
+        # Наведение на класс - подсказка подгрузить его спрайты заранее
+        cls = self.class_buttons.get(button)
+        if hovered and cls and cls["type"] not in self.prefetched:
+            AssetManager().prefetch_character(cls["type"])
+            self.prefetched.add(cls["type"])
+    
+    def on_click(self, button):
+        if button is self.back_button:
+            self.manager.pop()
+        else:
+            self.game_state.drop_checkpoint()  # новая игра - прежний первый уровень не нужен
+            self.game_state.player_class = self.class_buttons[button]["type"]
+            self.manager.push(NameInputScene(self.manager, self.game_state))
+
+class NameInputScene(UIScene):
+    def __init__(self, manager, game_state):
+        super().__init__(manager)
+        self.game_state = game_state
+        self.name = ""
+        
+        self.name_label = Label(WIDTH//2, 250, "", font_medium)
+        self.widgets = [
+            Label(WIDTH//2, 100, "Введите имя", font_large),
+            Label(WIDTH//2, 200, "Имя персонажа:", font_medium),
+            self.name_label,
+            Label(WIDTH//2, 350, "Нажмите ENTER для продолжения", font_small)
+        ]
+    
+    def handle_event(self, event):
+        if event.type == KEYDOWN:
+            if event.key == K_RETURN:
+                self.game_state.player_name = self.name if self.name else "Player"
+                # Выход из игры по ESC вернёт к выбору персонажа, как и раньше
+                self.manager.replace(GameScene(self.manager, self.game_state))
+            elif event.key == K_BACKSPACE:
+                self.name = self.name[:-1]
+            else:
+                if len(self.name) < 15:
+                    self.name += event.unicode
+            self.name_label.set_text(self.name)
+
+class GameScene(Scene):
+    def __init__(self, manager, game_state):
+        super().__init__(manager)
+        self.game_state = game_state
+        self.level = None
+    
+    def on_enter(self):
+        number = self.game_state.current_level
+        AssetManager().play_music(f"level{(number - 1) % HANDMADE_LEVELS + 1}")
+        AudioManager().play(f"round_{number}")
+        
+        # Создание уровня
+        self.level = self.create_level()
+        self.player = self.level.player
+        self.pending_keys = []  # нажатия с прошлого тика - достаются следующему
+        self.checkpoint = self.level.snapshot()  # начало уровня - для мгновенного перезапуска
+        self.quicksave = None
+        
+        renderer_class = DirtyRenderer if RENDER_MODE == "dirty" else FullRenderer
+        self.renderer = renderer_class(screen, self.level.platform_grid,
+                                       [self.level.coins, self.level.enemies, self.player, self.level.projectiles],
+                                       self.level.camera)
+        self.hud = Hud()
+        self.layout_version = self.level.layout_version
+        
+        self.step_time = 1.0 / SIM_RATE
+        self.accumulator = 0.0
+        self.previous_time = time.perf_counter()
+    
+    def create_level(self):
+        loader = LevelLoader()
+        checkpoint = self.game_state.checkpoint
+        if checkpoint is not None and checkpoint[0].player.char_type != self.game_state.player_class:
+            # Персонаж выбран заново - снимок прежнего не годится
+            self.game_state.drop_checkpoint()
+            checkpoint = None
+        if self.game_state.current_level == 1 and checkpoint is not None:
+            # Повтор с первого уровня: тот же уровень откатывается к снимку своего начала.
+            # Состояние random в снимке - сразу после random.seed(seed), так что запись с seed верна
+            level, blob, seed = checkpoint
+            level.restore(blob)
         else:
-            for i, score in enumerate(game_state.highscores[:10]):
-                score_text = font_medium.render(
-                    f"{i+1}. {score['name']} ({score['class']}): {score['score']} (ур. {score['level']})", 
-                    True, WHITE
-                )
-                screen.blit(score_text, (WIDTH//2 - 250, 150 + i * 40))
-        
-        back_button.check_hover(mouse_pos)
-        back_button.draw(screen)
-        if back_button.is_clicked(mouse_pos, mouse_click):
+            # Зерно random задаётся явно - с ним и вводом по тикам уровень повторяем
+            seed = random.SystemRandom().randrange(1 << 32)
+            random.seed(seed)
+            # Данные уровня обычно уже готовы, а следующий тем временем готовится в фоне
+            level = Level(self.game_state, *loader.take(self.game_state.level_key()))
+            if self.game_state.current_level == 1:
+                self.game_state.checkpoint = (level, level.snapshot(), seed)
+        if self.game_state.current_level < self.game_state.max_level:
+            loader.prefetch(self.game_state.level_key(self.game_state.current_level + 1))
+        self.recording = None
+        if self.manager.record_dir is not None:
+            self.recording = Replay(seed, self.game_state.current_level, self.game_state.player_class,
+                                    level_crc=Replay.level_checksum(level.data),
+                                    world_seed=self.game_state.world_seed)
+        return level
+    
+    def read_input(self):
+        # Ввод на один тик: (состояние клавиш, нажатия) или None, если ввод кончился
+        keys = pygame.key.get_pressed()
+        events = self.pending_keys
+        self.pending_keys = []
+        if self.recording is not None:
+            self.recording.record(keys, events)
+        return keys, events
+    
+    def on_exit(self):
+        # Сцена снята со стека - отпускаем уровень, фон и спрайты
+        if self.recording is not None:
+            self.save_recording()
+        # Первый уровень остаётся жить в GameState ради "Заново"
+        checkpoint = self.game_state.checkpoint
+        if checkpoint is None or checkpoint[0] is not self.level:
+            self.level.unload()
+        self.level = None
+        self.player = None
+        self.renderer = None
+        self.hud = None
+    
+    def save_recording(self):
+        self.recording.final_hash = self.level.state_hash()
+        os.makedirs(self.manager.record_dir, exist_ok=True)
+        path = os.path.join(self.manager.record_dir,
+                            f"level{self.recording.level}_{time.strftime('%Y%m%d_%H%M%S')}.rpl")
+        self.recording.save(path)
+        print(f"Replay saved to {path} ({self.recording.ticks} ticks)")
+    
+    def handle_event(self, event):
+        if event.type == KEYDOWN:
+            if event.key == K_ESCAPE:
+                self.game_state.drop_checkpoint()
+                self.manager.pop()
+                return
+            if event.key == QUICKSAVE_KEY:
+                self.quicksave = self.level.snapshot()
+                return
+            if event.key == QUICKLOAD_KEY:
+                self.load_snapshot(self.quicksave or self.checkpoint)
+                return
+            self.pending_keys.append(event.key)
+    
+    def load_snapshot(self, blob):
+        # Запись ввода после отката уже не повторить с начала - её прекращаем
+        if self.recording is not None:
+            print("Recording stopped: level state restored from snapshot")
+            self.recording = None
+        self.level.restore(blob)
+        self.pending_keys = []
+        self.accumulator = 0.0
+        self.invalidate()
+    
+    def update(self):
+        # Реальное время кадра копится и расходуется тиками фиксированной длины
+        now = time.perf_counter()
+        self.accumulator += min(now - self.previous_time, self.step_time * MAX_CATCHUP_STEPS)
+        self.previous_time = now
+        
+        while self.accumulator >= self.step_time:
+            self.accumulator -= self.step_time
+            tick_input = self.read_input()
+            if tick_input is None:
+                self.on_input_end()
+                return
+            keys, events = tick_input
+            for key in events:
+                self.level.handle_key(key)
+            result = self.level.step(keys, self.manager.profiler)
+            if result is not None:
+                self.on_level_end(result)
+                return
+    
+    def draw(self, surface):
+        # Подгрузились или выгрузились чанки - фон с платформами собирается заново
+        if self.level.layout_version != self.layout_version:
+            self.layout_version = self.level.layout_version
+            self.renderer.rebuild_static()
+        
+        # Отрисовка с интерполяцией между двумя последними тиками
+        profiler = self.manager.profiler
+        self.hud.update(self.player, self.game_state)
+        profiler.mark("hud")
+        self.renderer.draw(self.hud, self.accumulator / self.step_time, profiler)
+    
+    def invalidate(self):
+        self.renderer.rebuild_static()
+    
+    def on_input_end(self):
+        pass
+    
+    def on_level_end(self, result):
+        if result == "dead":
+            self.manager.replace(GameOverScene(self.manager, self.game_state, self.player.score))
             return
         
-        pygame.display.flip()
-        pygame.time.Clock().tick(FPS)
+        # Переход на следующий уровень
+        if self.game_state.next_level():
+            self.manager.replace(GameScene(self.manager, self.game_state))
+        else:
+            self.manager.replace(VictoryScene(self.manager, self.game_state, self.player.score))
+
+class ReplayScene(GameScene):
+    # Повтор записи в реальном времени, с отрисовкой. В конце сверяется отпечаток
+    def __init__(self, manager, replay):
+        super().__init__(manager, GameState())
+        self.replay = replay
+    
+    def create_level(self):
+        self.recording = None
+        self.inputs = iter(self.replay)
+        self.ticks = 0
+        return self.replay.start_level(self.game_state)
+    
+    def handle_event(self, event):
+        if event.type == KEYDOWN and event.key == K_ESCAPE:
+            self.manager.pop()
+    
+    def read_input(self):
+        tick_input = next(self.inputs, None)
+        if tick_input is not None:
+            self.ticks += 1
+        return tick_input
+    
+    def on_input_end(self):
+        self.finish()
+    
+    def on_level_end(self, result):
+        self.finish()
+    
+    def finish(self):
+        matched = self.level.state_hash() == self.replay.final_hash
+        print(f"Replay {'OK' if matched else 'MISMATCH'}: {self.ticks} ticks")
+        self.manager.exit_code = 0 if matched else 1
+        self.manager.pop()
+
+class ResultScene(MenuScene):
+    # Общий экран конца игры: счёт и кнопки "Заново" / "В меню"
+    def __init__(self, manager, game_state, score, title, title_color):
+        super().__init__(manager)
+        self.game_state = game_state
+        self.score = score
+        self.widgets = [
+            Label(WIDTH//2, 100, title, font_large, title_color),
+            Label(WIDTH//2, 200, self.score_label(score), font_medium)
+        ]
+        
+        self.buttons = [
+            Button(WIDTH//2 - 100, HEIGHT//2 + 50, 200, 50, "Заново", BLUE, (0, 100, 255)),
+            Button(WIDTH//2 - 100, HEIGHT//2 + 120, 200, 50, "В меню", GREEN, (0, 200, 100))
+        ]
+    
+    def score_label(self, score):
+        return f"Ваш счёт: {score}"
+    
+    def on_enter(self):
+        AssetManager().play_music("menu")
+    
+    def on_click(self, button):
+        if button.text == "Заново":
+            # Первый уровень не перестраивается: GameScene откатит его к снимку начала
+            self.game_state.current_level = 1
+            self.manager.replace(GameScene(self.manager, self.game_state))
+        else:
+            self.game_state.drop_checkpoint()
+            self.manager.reset(MainMenuScene(self.manager))
+
+class GameOverScene(ResultScene):
+    def __init__(self, manager, game_state, score):
+        super().__init__(manager, game_state, score, "Игра окончена", RED)
+    
+    def on_enter(self):
+        super().on_enter()
+        AudioManager().play("game_over")
+
+class VictoryScene(ResultScene):
+    def __init__(self, manager, game_state, score):
+        super().__init__(manager, game_state, score, "Победа!", GREEN)
+    
+    def score_label(self, score):
+        return f"Финальный счёт: {score}"
+    
+    def on_enter(self):
+        AssetManager().play_music("menu")
+        AudioManager().play("victory")
+        self.game_state.save_highscore(self.score)
+
+class HighscoresScene(MenuScene):
+    BOARDS = [("all", "Все")] + [(f"class:{cls['type']}", cls["name"]) for cls in CharacterSelectScene.CLASSES]
+    
+    def __init__(self, manager, game_state):
+        super().__init__(manager)
+        self.game_state = game_state
+        self.back_button = Button(50, HEIGHT - 70, 150, 50, "Назад", RED, (200, 0, 0))
+        self.board_button = Button(WIDTH - 250, HEIGHT - 70, 200, 50, "", (50, 50, 150), (100, 100, 255))
+        self.buttons = [self.back_button, self.board_button]
+        # Общая таблица, по классам и по уровням - переключаются по кругу
+        self.boards = self.BOARDS + [(f"level:{n}", f"Уровень {n}") for n in range(1, game_state.max_level + 1)]
+        self.board_index = 0
+        # Строки таблицы создаются один раз, при смене таблицы меняется только текст
+        self.empty_label = Label(WIDTH//2, 200, "", font_medium)
+        self.rows = [Label(WIDTH//2 - 250, 150 + i * 40, "", font_medium, align="left") for i in range(10)]
+        self.widgets = [Label(WIDTH//2, 50, "Рекорды", font_large), self.empty_label] + self.rows
+        self.show_board()
+    
+    def show_board(self):
+        key, name = self.boards[self.board_index]
+        self.board_button.set_text(name)
+        scores = self.game_state.highscore_store.top(key)[:10]
+        self.empty_label.set_text("" if scores else "Рекордов пока нет!")
+        for i, row in enumerate(self.rows):
+            if i < len(scores):
+                score = scores[i]
+                row.set_text(f"{i+1}. {score['name']} ({score['class']}): {score['score']} (ур. {score['level']})")
+            else:
+                row.set_text("")
+    
+    def on_click(self, button):
+        if button is self.board_button:
+            self.board_index = (self.board_index + 1) % len(self.boards)
+            self.show_board()
+            return
+        self.manager.pop()
 
 if __name__ == "__main__":
-    main_menu()
\ No newline at end of file
+    # --profile-trace=PATH - выгрузить трассу кадров при выходе,
+    # --cprofile=START:END - cProfile кадров с START по END,
+    # --record - писать ввод каждого уровня в REPLAY_DIR,
+    # --replay=PATH - повторить запись без окна и сверить итог (с --realtime - в окне),
+    # --sim-rate=N - тиков симуляции в секунду (меньше 60 - для слабого железа; запись хранит свою)
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+    if "sim-rate" in options:
+        try:
+            set_sim_rate(int(options["sim-rate"]))
+        except ValueError:
+            print(f"Error: bad --sim-rate: {options['sim-rate']}")
+    init_display()
+    if "--bake" in sys.argv:
+        AssetManager().bake_images()
+    elif "replay" in options and "--realtime" not in sys.argv:
+        replay = Replay.load(options["replay"])
+        start = time.perf_counter()
+        final_hash, ticks = run_replay(replay)
+        elapsed = time.perf_counter() - start
+        matched = final_hash == replay.final_hash
+        print(f"Replay {'OK' if matched else 'MISMATCH'}: {ticks} ticks in {elapsed:.3f} s "
+              f"({ticks / max(elapsed, 1e-9):.0f} ticks/s)")
+        sys.exit(0 if matched else 1)
+    else:
+        LevelLoader()  # процесс-помощник запускается заранее, пока открыто меню
+        AudioManager().preload()
+        cprofile_range = None
+        if "cprofile" in options:
+            first, last = options["cprofile"].split(":")
+            cprofile_range = (int(first), int(last))
+        profiler = FrameProfiler(cprofile_range=cprofile_range, trace_path=options.get("profile-trace"))
+        manager = SceneManager(profiler, REPLAY_DIR if "--record" in sys.argv else None)
+        if "replay" in options:
+            manager.run(ReplayScene(manager, Replay.load(options["replay"])))
+        else:
+            manager.run(MainMenuScene(manager))
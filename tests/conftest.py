@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# Тесты импортируют main.py и bench.py из корня репозитория
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bench  # без окна и звука: bench выставляет драйверы SDL до импорта main
+import main
+
+
+@pytest.fixture(scope="session", autouse=True)
+def display():
+    return main.init_display()
+
+
+@pytest.fixture(autouse=True)
+def repo_cwd(monkeypatch):
+    # Уровни и ресурсы ищутся от корня репозитория
+    monkeypatch.chdir(ROOT)
@@ -0,0 +1,31 @@
+# Общие для тестов сценарии: уровень из bench.GeneratedLevel и проигрывание ввода
+import random
+
+import main
+from bench import GeneratedLevel, ScriptedInput
+
+
+def build(player_class, scale, seed=0):
+    random.seed(seed)
+    game_state = main.GameState()
+    game_state.player_class = player_class
+    return GeneratedLevel(game_state, scale, seed)
+
+
+def play(level, first, last):
+    # Тики first..last-1 со сценарием ввода; отпечатки каждые 50 тиков и в конце
+    script = ScriptedInput(level)
+    hashes = []
+    for tick in range(first, last):
+        script.events(tick)
+        result = level.step(script.keys(tick))
+        if result == "dead":
+            level.player.health = level.player.max_health
+            level.player.alive = True
+        elif result == "exit":
+            level.player.rect.x = 100
+            level.player.begin_step()
+        if tick % 50 == 0:
+            hashes.append(level.state_hash())
+    hashes.append(level.state_hash())
+    return hashes
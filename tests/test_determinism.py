@@ -0,0 +1,119 @@
+import pytest
+
+import main
+from scenario import build, play
+
+TICKS = 400
+CLASSES = ["warrior", "mage", "archer"]
+
+
+@pytest.fixture(params=[None, 0], ids=["scalar", "engine"])
+def engine_threshold(request, monkeypatch):
+    monkeypatch.setattr(main, "ENEMY_ENGINE_THRESHOLD", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("player_class", CLASSES)
+@pytest.mark.parametrize("scale", [1, 5])
+def test_restore_then_rerun_matches(player_class, scale, engine_threshold):
+    level = build(player_class, scale)
+    assert (level.enemy_engine is not None) == (engine_threshold is not None and main.np is not None)
+    play(level, 0, 100)
+    blob = level.snapshot()
+    start = level.state_hash()
+    original = play(level, 100, 100 + TICKS)
+    
+    level.restore(blob)
+    assert level.state_hash() == start
+    assert play(level, 100, 100 + TICKS) == original
+
+
+@pytest.mark.parametrize("player_class", CLASSES)
+@pytest.mark.parametrize("scale", [1, 5])
+def test_restore_into_fresh_level(player_class, scale, engine_threshold):
+    level = build(player_class, scale)
+    play(level, 0, 100)
+    blob = level.snapshot()
+    start = level.state_hash()
+    original = play(level, 100, 100 + TICKS)
+    
+    fresh = build(player_class, scale)
+    fresh.restore(blob)
+    assert fresh.state_hash() == start
+    assert play(fresh, 100, 100 + TICKS) == original
+
+
+@pytest.mark.parametrize("scale, seed", [(1, 0), (3, 0), (3, 1)])
+def test_restore_in_the_air_matches(scale, seed):
+    # Цель маршрутов врагов меняется, только пока игрок стоит на узле, - снимок в прыжке
+    # должен вернуть и её
+    level = build("warrior", scale, seed)
+    tick = 20
+    play(level, 0, tick)
+    while level.nav.node_at(level.player.rect.centerx, level.player.rect.bottom) >= 0:
+        play(level, tick, tick + 1)
+        tick += 1
+    blob = level.snapshot()
+    original = play(level, tick, tick + TICKS)
+    
+    level.restore(blob)
+    assert play(level, tick, tick + TICKS) == original
+
+
+def test_restore_rejects_other_level():
+    level = build("warrior", 1)
+    level.game_state.current_level = 2
+    blob = level.snapshot()
+    with pytest.raises(ValueError):
+        build("warrior", 1).restore(blob)
+
+
+def test_restore_rejects_other_character():
+    level = build("warrior", 1)
+    blob = level.snapshot()
+    fresh = build("mage", 1)
+    with pytest.raises(ValueError):
+        fresh.restore(blob)
+    assert fresh.game_state.player_class == "mage"
+
+
+def choose_character(manager, button_index, name):
+    # С экрана выбора: класс, имя, ENTER - наверху стека GameScene
+    select = manager.top
+    select.on_click(select.buttons[button_index])
+    name_input = manager.top
+    for letter in name:
+        name_input.handle_event(main.pygame.event.Event(main.KEYDOWN, key=0, unicode=letter))
+    name_input.handle_event(main.pygame.event.Event(main.KEYDOWN, key=main.K_RETURN, unicode=""))
+    return manager.top
+
+
+def test_checkpoint_follows_character_choice():
+    manager = main.SceneManager()
+    menu = main.MainMenuScene(manager)
+    manager.push(menu)
+    menu.on_click(menu.buttons[0])
+    game = choose_character(manager, 0, "Alice")
+    first_level = game.level
+    assert menu.game_state.checkpoint[0] is first_level
+    
+    # "Заново" откатывает тот же первый уровень
+    game.on_level_end("dead")
+    result = manager.top
+    result.on_click(result.buttons[0])
+    assert manager.top.level is first_level
+    
+    # Выход по ESC и другой персонаж: прежний уровень освобождён, выбор не переписан
+    manager.top.handle_event(main.pygame.event.Event(main.KEYDOWN, key=main.K_ESCAPE, unicode=""))
+    assert menu.game_state.checkpoint is None
+    assert first_level.platform_grid is None
+    game = choose_character(manager, 1, "Bob")
+    assert game.level is not first_level
+    assert game.player.char_type == "mage"
+    assert (menu.game_state.player_class, menu.game_state.player_name) == ("mage", "Bob")
+    
+    # Выход в меню с экрана результата тоже освобождает первый уровень
+    game.on_level_end("dead")
+    result = manager.top
+    result.on_click(result.buttons[1])
+    assert menu.game_state.checkpoint is None
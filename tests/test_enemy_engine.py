@@ -0,0 +1,16 @@
+import pytest
+
+import main
+from scenario import build, play
+
+
+@pytest.mark.skipif(main.np is None, reason="NumPy не установлен")
+@pytest.mark.parametrize("scale", [5, 20])
+def test_enemy_engine_matches_scalar(scale, monkeypatch):
+    # Векторный движок и поштучный Enemy.update дают одни и те же отпечатки тик в тик
+    traces = []
+    for threshold in (None, 0):
+        monkeypatch.setattr(main, "ENEMY_ENGINE_THRESHOLD", threshold)
+        level = build("warrior", scale, seed=3)
+        traces.append(play(level, 0, 1000))
+    assert traces[0] == traces[1]
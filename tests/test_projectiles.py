@@ -0,0 +1,37 @@
+import pygame
+import pytest
+
+import main
+
+BOUNDS = pygame.Rect(0, 0, 1000, 400)
+
+
+def wall(x, width=2):
+    sprite = pygame.sprite.Sprite()
+    sprite.rect = pygame.Rect(x, 0, width, 400)
+    return sprite
+
+
+def fly(pool, platforms):
+    # Обновлять, пока снаряд в полёте
+    while pool.active:
+        pool.update(platforms, [], BOUNDS)
+
+
+@pytest.mark.parametrize("step", [1.0, 2.0], ids=["60hz", "30hz"])
+@pytest.mark.parametrize("kind", ["mage", "archer"])
+@pytest.mark.parametrize("wall_x", [126, 300])  # на границе ячеек сетки и внутри ячейки
+@pytest.mark.parametrize("direction", [1, -1])
+def test_fast_projectile_does_not_tunnel(kind, wall_x, step, direction, monkeypatch):
+    # Стена тоньше шага снаряда за тик: по одной точке центра он перепрыгнул бы её
+    # при большинстве начальных смещений
+    monkeypatch.setattr(main, "STEP", step)
+    platforms = main.SpatialHash([wall(wall_x)])
+    speed = main.PROJECTILES[kind]["speed"] * step
+    for offset in range(int(speed)):
+        pool = main.ProjectilePool(1)
+        start = wall_x - direction * (40 + offset)
+        projectile = pool.fire(kind, start, 200, direction)
+        fly(pool, platforms)
+        # Снаряд погас на том тике, когда пересёк стену, а не у края уровня
+        assert abs(projectile.x - start) < 40 + offset + speed + 2, offset
@@ -0,0 +1,30 @@
+from collections import defaultdict
+
+import pytest
+
+import main
+
+TICKS = 400
+CLASSES = ["warrior", "mage", "archer"]
+
+
+@pytest.mark.parametrize("player_class", CLASSES)
+def test_replay_reproduces_final_hash(player_class, tmp_path):
+    replay = main.Replay(1234, 1, player_class, world_seed=5)
+    level = replay.start_level(main.GameState())
+    replay.level_crc = main.Replay.level_checksum(level.data)
+    for tick in range(TICKS):
+        keys = defaultdict(bool)
+        keys[main.K_RIGHT if tick % 240 < 120 else main.K_LEFT] = True
+        events = [key for key, every in ((main.K_SPACE, 45), (main.K_f, 30)) if tick % every == 0]
+        replay.record(keys, events)
+        for key in events:
+            level.handle_key(key)
+        if level.step(keys) is not None:
+            break
+    replay.final_hash = level.state_hash()
+    
+    path = str(tmp_path / "level1.rpl")
+    replay.save(path)
+    loaded = main.Replay.load(path)
+    assert main.run_replay(loaded) == (replay.final_hash, replay.ticks)